@@ -1,15 +1,28 @@
 import argparse
 from pathlib import Path
 import glob
+import time
 from PIL import Image
-import ttach as tta
 import cv2
 import numpy as np
 import torch
 import albumentations as albu
 from catalyst.dl import SupervisedRunner
-from skimage.morphology import remove_small_holes, remove_small_objects
+from tools.aoi import find_per_image, load_aoi, tile_index
+from tools.autotune import DEFAULT_CACHE, autotune, parse_sizes
 from tools.cfg import py2cfg
+from tools.cascade import CascadeModel
+from tools.cog import read_geotags
+from tools.coarse_to_fine import predict_coarse, refine_zone
+from tools.cpu_pool import CPUWorkerPool, tile_coords
+from tools.label_codec import GT_PALETTES, OUTPUT_MODES, PALETTES, write_mask
+from tools.metric import Evaluator
+from tools.polygonize import polygonize, read_geotransform
+from tools.postprocess import parse_min_area, remove_small_regions
+from tools.stream_eval import evaluate_streaming
+from tools.tta import AdaptiveTTA, TTAEngine, geometry_product
+from tools.tile_cache import TileSkipper, tile_hash
+from tools.tile_manifest import IncrementalState, JobManifest
 from torch import nn
 from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
@@ -28,56 +41,6 @@ def seed_everything(seed):
     torch.backends.cudnn.benchmark = True
 
 
-def building_to_rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [0, 0, 0]
-    return mask_rgb
-
-
-def pv2rgb(mask):  # Potsdam and vaihingen
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [0, 255, 0]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [255, 0, 0]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [255, 255, 0]
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = [0, 204, 255]
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = [0, 0, 255]
-    return mask_rgb
-
-
-def landcoverai_to_rgb(mask):
-    w, h = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(w, h, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [233, 193, 133]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [255, 0, 0]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [0, 255, 0]
-    mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_RGB2BGR)
-    return mask_rgb
-
-
-def uavid2rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [128, 0, 0]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [128, 64, 128]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [0, 128, 0]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [128, 128, 0]
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = [64, 0, 128]
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = [192, 0, 192]
-    mask_rgb[np.all(mask_convert == 6, axis=0)] = [64, 64, 0]
-    mask_rgb[np.all(mask_convert == 7, axis=0)] = [0, 0, 0]
-    mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_RGB2BGR)
-    return mask_rgb
-
-
 def get_args():
     parser = argparse.ArgumentParser()
     arg = parser.add_argument
@@ -88,10 +51,78 @@ def get_args():
     arg("-ph", "--patch-height", help="height of patch size", type=int, default=512)
     arg("-pw", "--patch-width", help="width of patch size", type=int, default=512)
     arg("-b", "--batch-size", help="batch size", type=int, default=2)
+    arg("--tta-budget-mb", help="activation memory cap of one batched TTA forward", type=float, default=None)
+    arg("--tta-threshold", help="only augment tiles whose plain-forward uncertainty is above this", type=float,
+        default=None)
+    arg("--tta-metric", help="per-tile uncertainty used by --tta-threshold", default="entropy",
+        choices=["entropy", "margin"])
+    arg("--cascade-config", type=Path, default=None,
+        help="config of a larger model that re-predicts the tiles the -c model is unsure about")
+    arg("--cascade-threshold", help="uncertainty above which a tile/window is escalated", type=float, default=0.3)
+    arg("--cascade-metric", help="uncertainty used by the cascade", default="entropy", choices=["entropy", "margin"])
+    arg("--cascade-window", help="escalate windows of this size instead of whole tiles, 0 for tiles",
+        type=int, default=0)
+    arg("--cascade-context", help="context pixels around an escalated window", type=int, default=0)
+    arg("--coarse-scale", help="predict the scene at this scale first and refine only boundary/uncertain tiles "
+                               "at full resolution, e.g. 0.5", type=float, default=None)
+    arg("--coarse-thresh", help="coarse uncertainty above which a pixel is refined", type=float, default=0.5)
+    arg("--coarse-margin", help="full-resolution pixels around coarse class boundaries that are refined",
+        type=int, default=16)
+    arg("--coarse-metric", help="uncertainty used by the coarse pass", default="entropy", choices=["entropy", "margin"])
+    arg("--min-area", help="relabel regions smaller than this many pixels to their main neighbour class, "
+                           "N for every class or class:N,...", default=None)
+    arg("--vector", help="also write the regions of each mask as polygons to <name>.geojsonl "
+                         "(line-delimited GeoJSON, georeferenced for GeoTIFF input)", action='store_true')
+    arg("--vector-classes", help="comma separated classes to vectorize, all by default", default=None)
+    arg("--output-mode", default="rgb", choices=OUTPUT_MODES,
+        help="rgb: color masks, palette: single-channel PNG/TIFF with the palette embedded, "
+             "label: label image plus a palette.json sidecar, "
+             "cog: tiled GeoTIFF with overviews and the input's georeferencing")
+    arg("--autotune", help="benchmark batch/tile candidates on synthetic tiles and use the fastest, "
+                           "overriding -b/-ph/-pw", action='store_true')
+    arg("--autotune-tiles", help="tile candidates, HxW or N for NxN", default="512,768,1024")
+    arg("--autotune-batches", help="batch size candidates", default="1,2,4,8")
+    arg("--memory-cap-mb", help="peak CUDA memory allowed to an autotune candidate", type=float, default=None)
+    arg("--autotune-cache", help="file caching autotune results per model, host and thread count",
+        default=DEFAULT_CACHE)
+    arg("--workers", help="number of forked CPU workers, 0 runs on the configured GPU", type=int, default=0)
+    arg("--threads", help="intra-op threads per CPU worker", type=int, default=1)
     arg("-d", "--dataset", help="dataset", default="pv", choices=["pv", "landcoverai", "uavid", "building"])
+    arg("--nodata-value", help="pixel value marking nodata, tiles covered by it skip the model", type=int, default=None)
+    arg("--nodata-thresh", help="nodata coverage from which a tile is skipped", type=float, default=1.0)
+    arg("--nodata-class", help="label written for skipped nodata tiles", type=int, default=0)
+    arg("--tile-cache", help="number of tile predictions kept in the content-hash LRU, 0 disables it",
+        type=int, default=0)
+    arg("--resume", help="keep a tile manifest in the output folder and continue an interrupted run",
+        action='store_true')
+    arg("--incremental", help="keep tile hashes and predictions in the output folder and, on later runs over "
+                              "updated images, re-infer only the tiles that changed", action='store_true')
+    arg("--incremental-halo", help="tiles around a changed tile that are re-inferred too", type=int, default=1)
+    arg("--aoi-mask", help="area of interest: a raster mask (nonzero inside), GeoJSON polygons in pixel or, for "
+                           "GeoTIFFs, map coordinates, or a folder of per-image masks named like the images; "
+                           "only tiles intersecting it are inferred", type=Path, default=None)
+    arg("--aoi-fill", help="label written outside the area of interest", type=int, default=255)
+    arg("--eval-gt", help="ground-truth mask, or folder of masks named like the images, to score the output "
+                          "against band by band (color masks use the dataset's ground-truth colors)",
+        type=Path, default=None)
+    arg("--eval-ignore", help="raster (or folder) whose nonzero pixels are left out of the evaluation",
+        type=Path, default=None)
+    arg("--eval-boundary", help="leave out pixels within this many pixels of a ground-truth class boundary",
+        type=int, default=0)
     return parser.parse_args()
 
 
+def load_model(config, on_cpu=False):
+    ckpt_path = os.path.join(config.weights_path, config.test_weights_name+'.ckpt')
+    if on_cpu:
+        model = Supervision_Train.load_from_checkpoint(ckpt_path, config=config, map_location='cpu')
+    else:
+        model = Supervision_Train.load_from_checkpoint(ckpt_path, config=config)
+        model.cuda(config.gpus[0])
+    model.eval()
+    return model
+
+
 def get_img_padded(image, patch_size):
     oh, ow = image.shape[0], image.shape[1]
     rh, rw = oh % patch_size[0], ow % patch_size[1]
@@ -147,70 +178,216 @@ def main():
     seed_everything(42)
     patch_size = (args.patch_height, args.patch_width)
     config = py2cfg(args.config_path)
-    model = Supervision_Train.load_from_checkpoint(os.path.join(config.weights_path, config.test_weights_name+'.ckpt'), config=config)
-
-    model.cuda(config.gpus[0])
-    model.eval()
+    model = load_model(config, on_cpu=args.workers > 0)
+    if args.cascade_config is not None:
+        large_model = load_model(py2cfg(args.cascade_config), on_cpu=args.workers > 0)
+        model = CascadeModel(model, large_model, args.cascade_threshold, metric=args.cascade_metric,
+                             window=args.cascade_window or None, context=args.cascade_context,
+                             large_batch_size=args.batch_size)
 
     if args.tta == "lr":
-        transforms = tta.Compose(
-            [
-                tta.HorizontalFlip(),
-                tta.VerticalFlip()
-            ]
-        )
-        model = tta.SegmentationTTAWrapper(model, transforms)
+        model = TTAEngine(model, geometries=geometry_product(hflip=True, vflip=True),
+                          memory_budget_mb=args.tta_budget_mb)
     elif args.tta == "d4":
-        transforms = tta.Compose(
-            [
-                tta.HorizontalFlip(),
-                # tta.VerticalFlip(),
-                # tta.Rotate90(angles=[0, 90, 180, 270]),
-                tta.Scale(scales=[0.75, 1, 1.25, 1.5, 1.75]),
-                # tta.Multiply(factors=[0.8, 1, 1.2])
-            ]
-        )
-        model = tta.SegmentationTTAWrapper(model, transforms)
+        model = TTAEngine(model, geometries=geometry_product(hflip=True), scales=[0.75, 1, 1.25, 1.5, 1.75],
+                          memory_budget_mb=args.tta_budget_mb)
+    if args.tta is not None and args.tta_threshold is not None:
+        model = AdaptiveTTA(model, args.tta_threshold, metric=args.tta_metric)
+
+    if args.autotune:
+        num_threads = torch.get_num_threads()
+        if args.workers > 0:
+            torch.set_num_threads(args.threads)
+        args.batch_size, patch_size = autotune(
+            model, parse_sizes(args.autotune_tiles), [int(b) for b in args.autotune_batches.split(',')],
+            device='cpu' if args.workers > 0 else 'cuda:{}'.format(config.gpus[0]),
+            memory_cap_mb=args.memory_cap_mb, cache_path=args.autotune_cache,
+            name='{}:{}:tta={}'.format(config.test_weights_name, args.config_path, args.tta))
+        torch.set_num_threads(num_threads)
+        print('autotune: batch size {}, tile {}x{}'.format(args.batch_size, patch_size[0], patch_size[1]))
+
+    pool = None
+    if args.workers > 0:
+        pool = CPUWorkerPool(model, num_workers=args.workers, num_threads=args.threads,
+                             batch_size=args.batch_size)
+
+    skipper = TileSkipper(nodata_value=args.nodata_value, nodata_threshold=args.nodata_thresh,
+                          nodata_class=args.nodata_class, cache_size=args.tile_cache)
+
+    device = torch.device('cpu') if args.workers > 0 else torch.device('cuda:{}'.format(config.gpus[0]))
+    coarse_candidates, coarse_refined, coarse_forwards, coarse_time, refine_time = 0, 0, 0, 0.0, 0.0
 
     img_paths = []
     if not os.path.exists(args.output_path):
         os.makedirs(args.output_path)
+    manifest = None
+    signature = dict(config=str(args.config_path), weights=config.test_weights_name, tta=args.tta,
+                     tta_threshold=args.tta_threshold, tta_metric=args.tta_metric,
+                     cascade=None if args.cascade_config is None else dict(
+                         config=str(args.cascade_config), threshold=args.cascade_threshold,
+                         metric=args.cascade_metric, window=args.cascade_window,
+                         context=args.cascade_context),
+                     coarse=None if args.coarse_scale is None else dict(
+                         scale=args.coarse_scale, thresh=args.coarse_thresh, margin=args.coarse_margin,
+                         metric=args.coarse_metric),
+                     patch_size=patch_size, dataset=args.dataset, nodata_value=args.nodata_value,
+                     nodata_thresh=args.nodata_thresh, nodata_class=args.nodata_class,
+                     aoi=None if args.aoi_mask is None else dict(path=str(args.aoi_mask), fill=args.aoi_fill))
+    if args.resume:
+        # finished images are not written again, so the manifest also pins how the masks were written;
+        # the incremental state keeps raw predictions and only needs `signature`
+        output_settings = dict(min_area=args.min_area, output_mode=args.output_mode, vector=args.vector,
+                               vector_classes=args.vector_classes)
+        manifest = JobManifest(os.path.join(args.output_path, '.manifest'),
+                               dict(signature, output=output_settings))
     for ext in ('*.tif', '*.png', '*.jpg'):
         img_paths.extend(glob.glob(os.path.join(args.image_path, ext)))
     img_paths.sort()
     # print(img_paths)
+    incremental_tiles, incremental_recomputed = 0, 0
+    aoi_tiles, aoi_inferred = 0, 0
+    evaluator, eval_time = None, 0.0
+    if args.eval_gt is not None:
+        evaluator = Evaluator(num_class=config.num_classes)
+        # counts of images finished by an earlier --resume run are only reused with the same settings
+        eval_settings = dict(gt=str(args.eval_gt), boundary=args.eval_boundary,
+                             ignore=None if args.eval_ignore is None else str(args.eval_ignore))
     for img_path in img_paths:
         img_name = img_path.split('/')[-1]
+        if manifest is not None and manifest.is_done(img_name):
+            if evaluator is not None:
+                saved = manifest.eval_state(img_name)
+                if saved is not None and saved['settings'] == eval_settings:
+                    evaluator.merge(Evaluator.from_state_dict(saved['state']))
+                    print('{}: finished by an earlier run, evaluation restored from the manifest'.format(img_name))
+                else:
+                    print('{}: finished by an earlier run without these --eval-* settings, not evaluated'.format(
+                        img_name))
+            continue
+        aoi_path = None
+        if args.aoi_mask is not None:
+            aoi_path = find_per_image(args.aoi_mask, img_path)
+            if aoi_path is None:
+                print('{}: no AOI mask in {}, skipped'.format(img_name, args.aoi_mask))
+                continue
         # print('origin mask', original_mask.shape)
         dataset, width_pad, height_pad, output_width, output_height, img_pad, img_shape = \
             make_dataset_for_one_huge_image(img_path, patch_size)
         # print('img_padded', img_pad.shape)
+        tiles = dataset.tile_list
+        coords = tile_coords(output_height, output_width, patch_size)
+        aoi, inside = None, None
+        if aoi_path is not None:
+            aoi = load_aoi(aoi_path, img_shape[:2], transform=read_geotransform(img_path))
+            # the padding sits at the top-left, outside the AOI
+            aoi_pad = np.zeros((output_height, output_width), dtype=bool)
+            aoi_pad[-img_shape[0]:, -img_shape[1]:] = aoi
+            inside = tile_index(aoi_pad, patch_size)
+            aoi_tiles += len(tiles)
+            aoi_inferred += int(inside.sum())
+        output_tiles, pending = skipper.plan(tiles, include=inside)
+        if inside is not None:
+            for k in np.flatnonzero(~inside):
+                output_tiles[k] = np.full(patch_size, args.aoi_fill, dtype=np.uint8)
+        store = None
+        uncached = set()
+        if manifest is not None:
+            store = manifest.open_image(img_name, (output_height, output_width), len(coords))
+            for k in pending:
+                if store.done[k]:
+                    output_tiles[k] = store.load(coords[k], patch_size)
+            if args.coarse_scale is not None:
+                # the store (and the incremental state below) does not tell coarse tiles from refined ones
+                uncached.update(k for k in pending if store.done[k])
+            pending = [k for k in pending if not store.done[k]]
+        incremental = None
+        if args.incremental:
+            incremental = IncrementalState(os.path.join(args.output_path, '.incremental'), img_name, signature)
+            hashes = np.stack([np.frombuffer(tile_hash(tile), dtype=np.uint8) for tile in tiles])
+            grid = (output_height // patch_size[0], output_width // patch_size[1])
+            previous, unchanged = incremental.reusable(hashes, (output_height, output_width), grid,
+                                                       halo=args.incremental_halo)
+            for k in pending:
+                if unchanged[k]:
+                    m, n = coords[k]
+                    output_tiles[k] = np.array(previous[m:m + patch_size[0], n:n + patch_size[1]])
+            if args.coarse_scale is not None:
+                uncached.update(k for k in pending if unchanged[k])
+            pending = [k for k in pending if not unchanged[k]]
+            incremental_tiles += len(tiles)
+            incremental_recomputed += len(pending)
+        if args.coarse_scale is not None and pending:
+            t0 = time.time()
+            # only the tiles still to predict, grown by the boundary margin the zone looks at
+            grow = args.coarse_margin + 1
+            regions = [(max(0, m - grow), max(0, n - grow), min(output_height, m + patch_size[0] + grow),
+                        min(output_width, n + patch_size[1] + grow)) for (m, n) in (coords[k] for k in pending)]
+            coarse_labels, coarse_uncertainty, num_forwards = predict_coarse(
+                model, img_pad, args.coarse_scale, patch_size, batch_size=args.batch_size, device=device,
+                metric=args.coarse_metric, regions=regions)
+            coarse_forwards += num_forwards
+            valid = np.zeros((output_height, output_width), dtype=bool)
+            valid[height_pad:, width_pad:] = True
+            zone = refine_zone(coarse_labels, coarse_uncertainty, args.coarse_thresh, args.coarse_margin, valid)
+            coarse_tiles = {}
+            for k in pending:
+                m, n = coords[k]
+                if not zone[m:m + patch_size[0], n:n + patch_size[1]].any():
+                    coarse_tiles[k] = coarse_labels[m:m + patch_size[0], n:n + patch_size[1]]
+                    output_tiles[k] = coarse_tiles[k]
+            coarse_candidates += len(pending)
+            pending = [k for k in pending if k not in coarse_tiles]
+            uncached.update(coarse_tiles)
+            coarse_refined += len(pending)
+            if store is not None:
+                store.save(coarse_tiles, coords, patch_size)
+            coarse_time += time.time() - t0
+        t0 = time.time()
+        if pool is not None:
+            callback = None
+            if store is not None:
+                coord_index = {c: k for k, c in enumerate(coords)}
+
+                def callback(finished_coords, out):
+                    store.save({coord_index[(m, n)]: out[m:m + patch_size[0], n:n + patch_size[1]]
+                                for (m, n) in finished_coords}, coords, patch_size)
+
+            pool_mask = pool.predict(img_pad, patch_size, coords=[coords[k] for k in pending], callback=callback)
+            for k in pending:
+                m, n = coords[k]
+                output_tiles[k] = pool_mask[m:m + patch_size[0], n:n + patch_size[1]]
+        else:
+            with torch.no_grad():
+                dataloader = DataLoader(dataset=InferenceDataset(tile_list=[tiles[k] for k in pending]),
+                                        batch_size=args.batch_size, drop_last=False, shuffle=False)
+                for input in tqdm(dataloader):
+                    # raw_prediction NxCxHxW
+                    raw_predictions = model(input['img'].cuda(config.gpus[0]))
+                    # print('raw_pred shape:', raw_predictions.shape)
+                    raw_predictions = nn.Softmax(dim=1)(raw_predictions)
+                    # input_images['features'] NxCxHxW C=3
+                    predictions = raw_predictions.argmax(dim=1)
+                    image_ids = input['img_id']
+                    # print('prediction', predictions.shape)
+                    # print(np.unique(predictions))
+
+                    batch_tiles = {}
+                    for i in range(predictions.shape[0]):
+                        mask = predictions[i].cpu().numpy()
+                        output_tiles[pending[int(image_ids[i])]] = mask
+                        batch_tiles[pending[int(image_ids[i])]] = mask
+                    if store is not None:
+                        store.save(batch_tiles, coords, patch_size)
+        if args.coarse_scale is not None:
+            refine_time += time.time() - t0
+        # coarse tiles must not answer later full-resolution lookups of the same content
+        skipper.finish(output_tiles, exclude=uncached)
+
         output_mask = np.zeros(shape=(output_height, output_width), dtype=np.uint8)
-        output_tiles = []
-        k = 0
-        with torch.no_grad():
-            dataloader = DataLoader(dataset=dataset, batch_size=args.batch_size,
-                                    drop_last=False, shuffle=False)
-            for input in tqdm(dataloader):
-                # raw_prediction NxCxHxW
-                raw_predictions = model(input['img'].cuda(config.gpus[0]))
-                # print('raw_pred shape:', raw_predictions.shape)
-                raw_predictions = nn.Softmax(dim=1)(raw_predictions)
-                # input_images['features'] NxCxHxW C=3
-                predictions = raw_predictions.argmax(dim=1)
-                image_ids = input['img_id']
-                # print('prediction', predictions.shape)
-                # print(np.unique(predictions))
-
-                for i in range(predictions.shape[0]):
-                    mask = predictions[i].cpu().numpy()
-                    output_tiles.append((mask, image_ids[i].cpu().numpy()))
-
-        for m in range(0, output_height, patch_size[0]):
-            for n in range(0, output_width, patch_size[1]):
-                output_mask[m:m + patch_size[0], n:n + patch_size[1]] = output_tiles[k][0]
-                # print(output_tiles[k][1])
-                k = k + 1
+        for k, (m, n) in enumerate(coords):
+            output_mask[m:m + patch_size[0], n:n + patch_size[1]] = output_tiles[k]
+        if incremental is not None:
+            incremental.save(hashes, output_mask)
 
         output_mask = output_mask[-img_shape[0]:, -img_shape[1]:]
 
@@ -228,19 +405,76 @@ def main():
         #     output_mask = output_mask
 
         # print('mask', output_mask.shape)
-        if args.dataset == 'landcoverai':
-            output_mask = landcoverai_to_rgb(output_mask)
-        elif args.dataset == 'pv':
-            output_mask = pv2rgb(output_mask)
-        elif args.dataset == 'uavid':
-            output_mask = uavid2rgb(output_mask)
-        elif args.dataset == 'building':
-            output_mask = building_to_rgb(output_mask)
-        else:
-            output_mask = output_mask
+        if args.min_area is not None:
+            output_mask = remove_small_regions(output_mask, parse_min_area(args.min_area), band_rows=patch_size[0],
+                                               ignore_label=None if aoi is None else args.aoi_fill)
+        geotags = read_geotags(img_path)
+        if aoi is not None:
+            output_mask[~aoi] = args.aoi_fill
+            if not aoi.all():
+                # GDAL_NODATA, so viewers show the area outside the AOI as transparent
+                geotags = geotags + [(42113, 's', 0, str(args.aoi_fill), True)]
         # print(img_shape, output_mask.shape)
         # assert img_shape == output_mask.shape
-        cv2.imwrite(os.path.join(args.output_path, img_name), output_mask)
+        write_mask(os.path.join(args.output_path, img_name), output_mask, PALETTES[args.dataset],
+                   mode=args.output_mode, bgr=args.dataset in ('landcoverai', 'uavid'), geotags=geotags)
+        if args.vector:
+            t0 = time.time()
+            classes = None if args.vector_classes is None else [int(c) for c in args.vector_classes.split(',')]
+            if classes is None and aoi is not None:
+                classes = [c for c in range(256) if c != args.aoi_fill]
+            with open(os.path.join(args.output_path, os.path.splitext(img_name)[0] + '.geojsonl'), 'w') as f:
+                num_features = polygonize(output_mask, f, band_rows=patch_size[0], classes=classes,
+                                          class_names=getattr(config, 'classes', None),
+                                          transform=read_geotransform(img_path))
+            print('{}: {} polygons, vectorization spends: {} s'.format(img_name, num_features, time.time() - t0))
+        eval_state = None
+        if evaluator is not None:
+            gt_path = find_per_image(args.eval_gt, img_path)
+            if gt_path is None:
+                print('{}: no ground truth in {}, not evaluated'.format(img_name, args.eval_gt))
+            else:
+                t0 = time.time()
+                image_evaluator = evaluate_streaming(
+                    Evaluator(num_class=config.num_classes), output_mask, gt_path, band_rows=patch_size[0],
+                    ignore_path=None if args.eval_ignore is None else find_per_image(args.eval_ignore, img_path),
+                    boundary=args.eval_boundary, palette=GT_PALETTES.get(args.dataset))
+                evaluator.merge(image_evaluator)
+                eval_state = dict(settings=eval_settings, state=image_evaluator.state_dict())
+                eval_time += time.time() - t0
+                print('{}: mIOU:{}, OA:{}'.format(img_name, np.nanmean(image_evaluator.Intersection_over_Union()),
+                                                 image_evaluator.OA()))
+        if manifest is not None:
+            manifest.mark_done(img_name, store, eval_state=eval_state)
+
+    if pool is not None:
+        pool.close()
+    else:
+        for module in model.modules():
+            if isinstance(module, (AdaptiveTTA, CascadeModel)):
+                print(module.summary())
+    if skipper.enabled:
+        print(skipper.summary())
+    if args.incremental:
+        print('incremental: {} of {} tiles recomputed ({:.1%})'.format(
+            incremental_recomputed, incremental_tiles, incremental_recomputed / max(incremental_tiles, 1)))
+    if args.aoi_mask is not None:
+        print('aoi: {} of {} tiles intersect the area of interest ({:.1%})'.format(
+            aoi_inferred, aoi_tiles, aoi_inferred / max(aoi_tiles, 1)))
+    if evaluator is not None:
+        iou_per_class = evaluator.Intersection_over_Union()
+        f1_per_class = evaluator.F1()
+        class_names = getattr(config, 'classes', range(config.num_classes))
+        for class_name, class_iou, class_f1 in zip(class_names, iou_per_class, f1_per_class):
+            print('F1_{}:{}, IOU_{}:{}'.format(class_name, class_f1, class_name, class_iou))
+        print('F1:{}, mIOU:{}, OA:{}'.format(np.nanmean(f1_per_class), np.nanmean(iou_per_class), evaluator.OA()))
+        print('evaluation spends: {} s'.format(eval_time))
+    if args.coarse_scale is not None and coarse_candidates:
+        # an estimate from the number of model forwards (coarse and full tiles have the same size), not a timing
+        print('coarse-to-fine: {} of {} tiles refined at full resolution after {} coarse tiles, estimated speedup '
+              '{:.2f}x'.format(coarse_refined, coarse_candidates, coarse_forwards,
+                               coarse_candidates / max(coarse_forwards + coarse_refined, 1)))
+        print('coarse pass spends: {} s, full-resolution pass spends: {} s'.format(coarse_time, refine_time))
 
 
 if __name__ == "__main__":
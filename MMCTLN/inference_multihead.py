@@ -0,0 +1,85 @@
+import argparse
+from pathlib import Path
+import glob
+import time
+import cv2
+import numpy as np
+import torch
+from tools.cfg import py2cfg
+from tools.cpu_pool import tile_coords
+from tools.label_codec import OUTPUT_MODES, PALETTES, write_mask
+from mmctln_main.models.MMCTLN import MMCTLNMultiHead
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from train_supervision import *
+from inference_huge_image import load_model, make_dataset_for_one_huge_image, seed_everything
+import os
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-i", "--image_path", type=Path, required=True, help="Path to  huge image folder")
+    arg("-c", "--config_path", type=Path, nargs='+', required=True,
+        help="configs of the heads, fine-tuned on the same frozen backbone")
+    arg("-o", "--output_path", type=Path, help="Path to save resulting masks, one folder per head.", required=True)
+    arg("-n", "--names", nargs='+', default=None, help="head names, the config folder names by default")
+    arg("-d", "--dataset", nargs='+', default=None, choices=["pv", "landcoverai", "uavid", "building", "loveda"],
+        help="palette of every head, label masks are written when omitted")
+    arg("--output-mode", default="rgb", choices=OUTPUT_MODES, help="how masks of heads with a -d palette are written")
+    arg("-ph", "--patch-height", help="height of patch size", type=int, default=512)
+    arg("-pw", "--patch-width", help="width of patch size", type=int, default=512)
+    arg("-b", "--batch-size", help="batch size", type=int, default=2)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    seed_everything(42)
+    patch_size = (args.patch_height, args.patch_width)
+    names = args.names or [p.resolve().parent.name for p in args.config_path]
+    if len(names) != len(args.config_path) or (args.dataset and len(args.dataset) != len(names)):
+        raise ValueError('give one name and one dataset per config')
+    if len(set(names)) != len(names):
+        raise ValueError('head names must be unique, got {}; pass them with -n'.format(names))
+    configs = [py2cfg(p) for p in args.config_path]
+    model = MMCTLNMultiHead.from_models({name: load_model(config).net for name, config in zip(names, configs)})
+    model.eval()
+    for name in names:
+        os.makedirs(os.path.join(args.output_path, name), exist_ok=True)
+
+    img_paths = []
+    for ext in ('*.tif', '*.png', '*.jpg'):
+        img_paths.extend(glob.glob(os.path.join(args.image_path, ext)))
+    img_paths.sort()
+    t0 = time.time()
+    for img_path in img_paths:
+        img_name = img_path.split('/')[-1]
+        dataset, width_pad, height_pad, output_width, output_height, img_pad, img_shape = \
+            make_dataset_for_one_huge_image(img_path, patch_size)
+        coords = tile_coords(output_height, output_width, patch_size)
+        output_masks = {name: np.zeros(shape=(output_height, output_width), dtype=np.uint8) for name in names}
+        with torch.no_grad():
+            dataloader = DataLoader(dataset=dataset, batch_size=args.batch_size, drop_last=False, shuffle=False)
+            for input in tqdm(dataloader):
+                raw_predictions = model(input['img'].cuda(configs[0].gpus[0]))
+                image_ids = input['img_id']
+                for name, logits in raw_predictions.items():
+                    predictions = logits.argmax(dim=1).cpu().numpy()
+                    for i in range(predictions.shape[0]):
+                        m, n = coords[int(image_ids[i])]
+                        output_masks[name][m:m + patch_size[0], n:n + patch_size[1]] = predictions[i]
+
+        for k, name in enumerate(names):
+            output_mask = output_masks[name][-img_shape[0]:, -img_shape[1]:]
+            output_file = os.path.join(args.output_path, name, img_name)
+            if args.dataset:
+                write_mask(output_file, output_mask, PALETTES[args.dataset[k]], mode=args.output_mode,
+                           bgr=args.dataset[k] in ('landcoverai', 'uavid', 'loveda'))
+            else:
+                cv2.imwrite(output_file, output_mask)
+    print('{} heads on {} images spends: {} s'.format(len(names), len(img_paths), time.time() - t0))
+
+
+if __name__ == "__main__":
+    main()
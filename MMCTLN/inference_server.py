@@ -0,0 +1,211 @@
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+import cv2
+import numpy as np
+import torch
+import albumentations as albu
+from tools.cfg import py2cfg
+from tools.cpu_pool import tile_coords
+from tools.tta import TTAEngine, geometry_product
+from train_supervision import *
+from inference_huge_image import get_img_padded
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-c", "--config_path", type=Path, required=True, help="Path to  config")
+    arg("-t", "--tta", help="Test time augmentation.", default=None, choices=[None, "d4", "lr"])
+    arg("-ph", "--patch-height", help="height of patch size", type=int, default=512)
+    arg("-pw", "--patch-width", help="width of patch size", type=int, default=512)
+    arg("-b", "--batch-size", help="largest batch formed from concurrent requests", type=int, default=8)
+    arg("--max-latency-ms", help="how long the first tile of a batch waits for others", type=float, default=10)
+    arg("--host", default="127.0.0.1")
+    arg("--port", type=int, default=8000)
+    arg("--unix-socket", help="listen on this unix socket instead of host:port", default=None)
+    return parser.parse_args()
+
+
+class DynamicBatcher(object):
+    """Groups tiles from concurrent requests into one forward.
+
+    A batch closes when it is full or when its first tile has waited `max_latency` seconds.
+    Forwards run one at a time on a worker thread, so the event loop keeps accepting requests.
+    """
+
+    def __init__(self, model, device, max_batch_size=8, max_latency=0.01):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.normalize = albu.Normalize()
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.num_batches = 0
+        self.num_tiles = 0
+        self.busy_time = 0.0
+
+    async def predict(self, tile):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tile, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for item in items:
+                groups.setdefault(item[0].shape, []).append(item)
+            for group in groups.values():
+                try:
+                    masks = await loop.run_in_executor(self.executor, self._forward, [t for t, _ in group])
+                except Exception as e:
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), mask in zip(group, masks):
+                    if not future.done():
+                        future.set_result(mask)
+
+    def _forward(self, tiles):
+        t0 = time.time()
+        x = np.stack([self.normalize(image=tile)['image'] for tile in tiles])
+        x = torch.from_numpy(x).permute(0, 3, 1, 2).float().to(self.device)
+        with torch.no_grad():
+            predictions = self.model(x).argmax(dim=1).to(torch.uint8).cpu().numpy()
+        self.num_batches += 1
+        self.num_tiles += len(tiles)
+        self.busy_time += time.time() - t0
+        return list(predictions)
+
+    def stats(self):
+        return {'batches': self.num_batches, 'tiles': self.num_tiles,
+                'mean_batch_size': self.num_tiles / max(self.num_batches, 1),
+                'busy_seconds': self.busy_time}
+
+
+class InferenceServer(object):
+    """Minimal HTTP/1.1 front end.
+
+    POST /predict takes an encoded image (png/jpg/tif) of any size and answers with a
+    single-channel PNG of labels; GET /stats reports batching counters.
+    """
+
+    def __init__(self, batcher, patch_size):
+        self.batcher = batcher
+        self.patch_size = patch_size
+        self.num_requests = 0
+
+    async def predict_image(self, image):
+        img_pad, _, _ = get_img_padded(image, self.patch_size)
+        ph, pw = self.patch_size
+        coords = tile_coords(img_pad.shape[0], img_pad.shape[1], self.patch_size)
+        masks = await asyncio.gather(*[self.batcher.predict(img_pad[m:m + ph, n:n + pw]) for (m, n) in coords])
+        output_mask = np.zeros(img_pad.shape[:2], dtype=np.uint8)
+        for (m, n), mask in zip(coords, masks):
+            output_mask[m:m + ph, n:n + pw] = mask
+        return output_mask[-image.shape[0]:, -image.shape[1]:]
+
+    async def dispatch(self, method, path, body):
+        if method == 'POST' and path == '/predict':
+            image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                return 400, 'text/plain', b'could not decode image'
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            self.num_requests += 1
+            output_mask = await self.predict_image(image)
+            return 200, 'image/png', cv2.imencode('.png', output_mask)[1].tobytes()
+        if method == 'GET' and path == '/stats':
+            stats = dict(self.batcher.stats(), requests=self.num_requests)
+            return 200, 'application/json', json.dumps(stats).encode()
+        return 404, 'text/plain', b'not found'
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                try:
+                    status, content_type, payload = await self.dispatch(method, urlparse(target).path, body)
+                except Exception as e:
+                    # a failed request must not drop the connection without an answer
+                    print('{} {} failed: {!r}'.format(method, target, e))
+                    status, content_type, payload = 500, 'text/plain', '{}: {}'.format(
+                        type(e).__name__, e).encode('utf-8', 'replace')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, 'OK' if status == 200 else 'Error', content_type, len(payload)).encode('latin-1'))
+                writer.write(payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args, model, device):
+    batcher = DynamicBatcher(model, device, max_batch_size=args.batch_size,
+                             max_latency=args.max_latency_ms / 1000.0)
+    server = InferenceServer(batcher, (args.patch_height, args.patch_width))
+    batch_task = asyncio.ensure_future(batcher.run())
+    if args.unix_socket:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix_socket)
+        print('serving on {}'.format(args.unix_socket))
+    else:
+        listener = await asyncio.start_server(server.handle, host=args.host, port=args.port)
+        print('serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+def main():
+    args = get_args()
+    config = py2cfg(args.config_path)
+    device = torch.device('cuda:{}'.format(config.gpus[0]) if torch.cuda.is_available() else 'cpu')
+    model = Supervision_Train.load_from_checkpoint(
+        os.path.join(config.weights_path, config.test_weights_name + '.ckpt'), config=config, map_location=device)
+    model.to(device)
+    model.eval()
+
+    if args.tta == "lr":
+        model = TTAEngine(model, geometries=geometry_product(hflip=True, vflip=True))
+    elif args.tta == "d4":
+        model = TTAEngine(model, geometries=geometry_product(hflip=True), scales=[0.75, 1, 1.25, 1.5, 1.75])
+
+    asyncio.run(serve(args, model, device))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,20 @@ import argparse
 from pathlib import Path
 import glob
 from PIL import Image
-import ttach as tta
 import cv2
 import numpy as np
 import torch
 import albumentations as albu
 from catalyst.dl import SupervisedRunner
-from skimage.morphology import remove_small_holes, remove_small_objects
+from tools.autotune import DEFAULT_CACHE, autotune, parse_sizes
+from tools.cascade import CascadeModel
 from tools.cfg import py2cfg
+from tools.cpu_pool import CPUWorkerPool, tile_coords
+from tools.label_codec import OUTPUT_MODES, PALETTES, write_mask
+from tools.postprocess import parse_min_area, remove_small_regions
+from tools.temporal import KeyframeFeatureCache
+from tools.tile_cache import FrameDiffGate
+from tools.tta import AdaptiveTTA, TTAEngine, geometry_product
 from torch import nn
 from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
@@ -28,48 +34,6 @@ def seed_everything(seed):
     torch.backends.cudnn.benchmark = True
 
 
-def pv2rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [0, 255, 0]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [255, 0, 0]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [255, 255, 0]
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = [0, 204, 255]
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = [0, 0, 255]
-    mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_RGB2BGR)
-    return mask_rgb
-
-
-def landcoverai_to_rgb(mask):
-    w, h = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(w, h, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [233, 193, 133]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [255, 0, 0]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [0, 255, 0]
-    mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_RGB2BGR)
-    return mask_rgb
-
-
-def uavid2rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [128, 0, 0]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [128, 64, 128]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [0, 128, 0]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [128, 128, 0]
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = [64, 0, 128]
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = [192, 0, 192]
-    mask_rgb[np.all(mask_convert == 6, axis=0)] = [64, 64, 0]
-    mask_rgb[np.all(mask_convert == 7, axis=0)] = [0, 0, 0]
-    mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_RGB2BGR)
-    return mask_rgb
-
-
 def get_args():
     parser = argparse.ArgumentParser()
     arg = parser.add_argument
@@ -80,8 +44,50 @@ def get_args():
     arg("-ph", "--patch-height", help="height of patch size", type=int, default=1152)
     arg("-pw", "--patch-width", help="width of patch size", type=int, default=1024)
     arg("-b", "--batch-size", help="batch size", type=int, default=2)
+    arg("--tta-budget-mb", help="activation memory cap of one batched TTA forward", type=float, default=None)
+    arg("--tta-threshold", help="only augment tiles whose plain-forward uncertainty is above this", type=float,
+        default=None)
+    arg("--tta-metric", help="per-tile uncertainty used by --tta-threshold", default="entropy",
+        choices=["entropy", "margin"])
+    arg("--cascade-config", type=Path, default=None,
+        help="config of a larger model that re-predicts the tiles the -c model is unsure about")
+    arg("--cascade-threshold", help="uncertainty above which a tile/window is escalated", type=float, default=0.3)
+    arg("--cascade-metric", help="uncertainty used by the cascade", default="entropy", choices=["entropy", "margin"])
+    arg("--cascade-window", help="escalate windows of this size instead of whole tiles, 0 for tiles",
+        type=int, default=0)
+    arg("--cascade-context", help="context pixels around an escalated window", type=int, default=0)
+    arg("--keyframe-interval", help="run the whole backbone every N frames of a sequence and reuse its deep "
+                                    "features on the frames in between, 1 disables reuse", type=int, default=1)
+    arg("--reuse-stages", help="number of last backbone stages reused from the keyframe (2: res3/res4)",
+        type=int, default=2, choices=[1, 2, 3])
+    arg("--keyframe-drift", help="run the whole backbone on a tile whose shallow features changed more than "
+                                 "this since the keyframe, e.g. 0.3", type=float, default=None)
+    arg("--frame-gate-thresh", help="reuse the previous frame's prediction for tiles that changed less than this, "
+                                    "e.g. 0.02 (diff) or 0.05 (phash)", type=float, default=None)
+    arg("--frame-gate-method", help="tile change measure: mean abs difference of downsampled gray tiles, "
+                                    "or perceptual hash", default="diff", choices=["diff", "phash"])
+    arg("--frame-gate-max-skip", help="frames a tile prediction is reused at most", type=int, default=10)
+    arg("--min-area", help="relabel regions smaller than this many pixels to their main neighbour class, "
+                           "N for every class or class:N,...", default=None)
+    arg("--output-mode", default="rgb", choices=OUTPUT_MODES,
+        help="rgb: color masks, palette: single-channel PNG/TIFF with the palette embedded, "
+             "label: label image plus a palette.json sidecar")
+    arg("--autotune", help="benchmark batch/tile candidates on synthetic tiles and use the fastest, "
+                           "overriding -b/-ph/-pw", action='store_true')
+    arg("--autotune-tiles", help="tile candidates, HxW or N for NxN", default="1152x1024,1024,768")
+    arg("--autotune-batches", help="batch size candidates", default="1,2,4,8")
+    arg("--memory-cap-mb", help="peak CUDA memory allowed to an autotune candidate", type=float, default=None)
+    arg("--autotune-cache", help="file caching autotune results per model, host and thread count",
+        default=DEFAULT_CACHE)
+    arg("--workers", help="number of forked CPU workers, 0 runs on the configured GPU", type=int, default=0)
+    arg("--threads", help="intra-op threads per CPU worker", type=int, default=1)
     arg("-d", "--dataset", help="dataset", default="uavid", choices=["pv", "landcoverai", "uavid"])
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.keyframe_interval > 1 and (args.workers > 0 or args.tta_threshold is not None
+                                       or args.frame_gate_thresh is not None):
+        parser.error('--keyframe-interval needs the same forwards on every frame, '
+                     'it cannot be combined with --workers, --tta-threshold or --frame-gate-thresh')
+    return args
 
 
 def load_checkpoint(checkpoint_path, model):
@@ -94,6 +100,17 @@ def load_checkpoint(checkpoint_path, model):
     return model
 
 
+def load_model(config, on_cpu=False):
+    ckpt_path = os.path.join(config.weights_path, config.test_weights_name+'.ckpt')
+    if on_cpu:
+        model = Supervision_Train.load_from_checkpoint(ckpt_path, config=config, map_location='cpu')
+    else:
+        model = Supervision_Train.load_from_checkpoint(ckpt_path, config=config)
+        model.cuda(config.gpus[0])
+    model.eval()
+    return model
+
+
 def get_img_padded(image, patch_size):
     oh, ow = image.shape[0], image.shape[1]
     rh, rw = oh % patch_size[0], ow % patch_size[1]
@@ -152,30 +169,47 @@ def main():
     # print(img_paths)
     patch_size = (args.patch_height, args.patch_width)
     config = py2cfg(args.config_path)
-    model = Supervision_Train.load_from_checkpoint(os.path.join(config.weights_path, config.test_weights_name+'.ckpt'), config=config)
-
-    model.cuda(config.gpus[0])
-    model.eval()
+    model = load_model(config, on_cpu=args.workers > 0)
+    temporal = None
+    if args.keyframe_interval > 1:
+        model = temporal = KeyframeFeatureCache(model, args.keyframe_interval, reuse_stages=args.reuse_stages,
+                                                drift_threshold=args.keyframe_drift)
+    if args.cascade_config is not None:
+        large_model = load_model(py2cfg(args.cascade_config), on_cpu=args.workers > 0)
+        model = CascadeModel(model, large_model, args.cascade_threshold, metric=args.cascade_metric,
+                             window=args.cascade_window or None, context=args.cascade_context,
+                             large_batch_size=args.batch_size)
 
     if args.tta == "lr":
-        transforms = tta.Compose(
-            [
-                tta.HorizontalFlip(),
-                tta.VerticalFlip()
-            ]
-        )
-        model = tta.SegmentationTTAWrapper(model, transforms)
+        model = TTAEngine(model, geometries=geometry_product(hflip=True, vflip=True),
+                          memory_budget_mb=args.tta_budget_mb)
     elif args.tta == "d4":
-        transforms = tta.Compose(
-            [
-                tta.HorizontalFlip(),
-                # tta.VerticalFlip(),
-                # tta.Rotate90(angles=[0, 90, 180, 270]),
-                tta.Scale(scales=[0.75, 1, 1.25, 1.5, 1.75]),
-                # tta.Multiply(factors=[0.8, 1, 1.2])
-            ]
-        )
-        model = tta.SegmentationTTAWrapper(model, transforms)
+        model = TTAEngine(model, geometries=geometry_product(hflip=True), scales=[0.75, 1, 1.25, 1.5, 1.75],
+                          memory_budget_mb=args.tta_budget_mb)
+    if args.tta is not None and args.tta_threshold is not None:
+        model = AdaptiveTTA(model, args.tta_threshold, metric=args.tta_metric)
+
+    if args.autotune:
+        num_threads = torch.get_num_threads()
+        if args.workers > 0:
+            torch.set_num_threads(args.threads)
+        args.batch_size, patch_size = autotune(
+            model, parse_sizes(args.autotune_tiles), [int(b) for b in args.autotune_batches.split(',')],
+            device='cpu' if args.workers > 0 else 'cuda:{}'.format(config.gpus[0]),
+            memory_cap_mb=args.memory_cap_mb, cache_path=args.autotune_cache,
+            name='{}:{}:tta={}'.format(config.test_weights_name, args.config_path, args.tta))
+        torch.set_num_threads(num_threads)
+        print('autotune: batch size {}, tile {}x{}'.format(args.batch_size, patch_size[0], patch_size[1]))
+
+    pool = None
+    if args.workers > 0:
+        pool = CPUWorkerPool(model, num_workers=args.workers, num_threads=args.threads,
+                             batch_size=args.batch_size)
+
+    gate = None
+    if args.frame_gate_thresh is not None:
+        gate = FrameDiffGate(args.frame_gate_thresh, method=args.frame_gate_method,
+                             max_skip=args.frame_gate_max_skip)
 
     for seq in seqs:
         img_paths = []
@@ -186,52 +220,72 @@ def main():
             img_paths.extend(glob.glob(os.path.join(args.image_path, str(seq), 'Images', ext)))
         img_paths.sort()
         # print(img_paths)
+        if temporal is not None:
+            temporal.start_sequence()
+        if gate is not None:
+            gate.reset()
         for img_path in img_paths:
             img_name = img_path.split('/')[-1]
+            if temporal is not None:
+                temporal.start_frame()
             # print('origin mask', original_mask.shape)
             dataset, width_pad, height_pad, output_width, output_height, img_pad, img_shape = \
                 make_dataset_for_one_huge_image(img_path, patch_size)
             # print('img_padded', img_pad.shape)
+            tiles = dataset.tile_list
+            coords = tile_coords(output_height, output_width, patch_size)
+            if gate is not None:
+                output_tiles, pending = gate.plan(tiles)
+            else:
+                output_tiles, pending = [None] * len(tiles), list(range(len(tiles)))
+            if pool is not None:
+                if pending:
+                    pool_mask = pool.predict(img_pad, patch_size, coords=[coords[k] for k in pending])
+                    for k in pending:
+                        m, n = coords[k]
+                        output_tiles[k] = pool_mask[m:m + patch_size[0], n:n + patch_size[1]]
+            else:
+                with torch.no_grad():
+                    dataloader = DataLoader(dataset=InferenceDataset(tile_list=[tiles[k] for k in pending]),
+                                            batch_size=args.batch_size, drop_last=False, shuffle=False)
+                    for input in tqdm(dataloader):
+                        # raw_prediction NxCxHxW
+                        raw_predictions = model(input['img'].cuda(config.gpus[0]))
+                        # print('raw_pred shape:', raw_predictions.shape)
+                        raw_predictions = nn.Softmax(dim=1)(raw_predictions)
+                        # input_images['features'] NxCxHxW C=3
+                        predictions = raw_predictions.argmax(dim=1)
+                        image_ids = input['img_id']
+                        # print('prediction', predictions.shape)
+                        # print(np.unique(predictions))
+
+                        for i in range(predictions.shape[0]):
+                            output_tiles[pending[int(image_ids[i])]] = predictions[i].cpu().numpy()
+            if gate is not None:
+                gate.finish(output_tiles)
+
             output_mask = np.zeros(shape=(output_height, output_width), dtype=np.uint8)
-            output_tiles = []
-            k = 0
-            with torch.no_grad():
-                dataloader = DataLoader(dataset=dataset, batch_size=args.batch_size,
-                                        drop_last=False, shuffle=False)
-                for input in tqdm(dataloader):
-                    # raw_prediction NxCxHxW
-                    raw_predictions = model(input['img'].cuda(config.gpus[0]))
-                    # print('raw_pred shape:', raw_predictions.shape)
-                    raw_predictions = nn.Softmax(dim=1)(raw_predictions)
-                    # input_images['features'] NxCxHxW C=3
-                    predictions = raw_predictions.argmax(dim=1)
-                    image_ids = input['img_id']
-                    # print('prediction', predictions.shape)
-                    # print(np.unique(predictions))
-
-                    for i in range(predictions.shape[0]):
-                        raw_mask = predictions[i].cpu().numpy()
-                        mask = raw_mask
-                        output_tiles.append((mask, image_ids[i].cpu().numpy()))
-
-            for m in range(0, output_height, patch_size[0]):
-                for n in range(0, output_width, patch_size[1]):
-                    output_mask[m:m + patch_size[0], n:n + patch_size[1]] = output_tiles[k][0]
-                    k = k + 1
+            for k, (m, n) in enumerate(coords):
+                output_mask[m:m + patch_size[0], n:n + patch_size[1]] = output_tiles[k]
 
             output_mask = output_mask[-img_shape[0]:, -img_shape[1]:]
 
             # print('mask', output_mask.shape)
-            if args.dataset == 'landcoverai':
-                output_mask = landcoverai_to_rgb(output_mask)
-            elif args.dataset == 'pv':
-                output_mask = pv2rgb(output_mask)
-            elif args.dataset == 'uavid':
-                output_mask = uavid2rgb(output_mask)
-            else:
-                output_mask = output_mask
-            assert img_shape == output_mask.shape
-            cv2.imwrite(os.path.join(output_path, img_name), output_mask)
+            if args.min_area is not None:
+                output_mask = remove_small_regions(output_mask, parse_min_area(args.min_area),
+                                                   band_rows=patch_size[0])
+            assert img_shape[:2] == output_mask.shape
+            write_mask(os.path.join(output_path, img_name), output_mask, PALETTES[args.dataset],
+                       mode=args.output_mode, bgr=True)
+
+    if pool is not None:
+        pool.close()
+    else:
+        for module in model.modules():
+            if isinstance(module, (AdaptiveTTA, CascadeModel, KeyframeFeatureCache)):
+                print(module.summary())
+    if gate is not None:
+        print(gate.summary())
 
 
 if __name__ == "__main__":
@@ -1,44 +1,28 @@
 import ttach as tta
-import multiprocessing.pool as mpp
-import multiprocessing as mp
-import time
 from train_supervision import *
+from tools.label_codec import OUTPUT_MODES, PALETTES, write_mask
+from tools.mask_writer import MaskWriterPool
+from tools.metric import TorchEvaluator
 import argparse
+import json
 from pathlib import Path
 import cv2
 import numpy as np
 import torch
 
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 
 
-def label2rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [255, 0, 0]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [255, 255, 0]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [0, 0, 255]
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = [159, 129, 183]
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = [0, 255, 0]
-    mask_rgb[np.all(mask_convert == 6, axis=0)] = [255, 195, 128]
-    return mask_rgb
-
-
 def img_writer(inp):
-    (mask,  mask_id, rgb) = inp
-    if rgb:
-        mask_name_tif = mask_id + '.png'
-        mask_tif = label2rgb(mask)
-        mask_tif = cv2.cvtColor(mask_tif, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(mask_name_tif, mask_tif)
-    else:
+    (mask,  mask_id, output_mode) = inp
+    if output_mode is None:
         mask_png = mask.astype(np.uint8)
         mask_name_png = mask_id + '.png'
         cv2.imwrite(mask_name_png, mask_png)
+    else:
+        write_mask(mask_id + '.png', mask, PALETTES['loveda'], mode=output_mode, bgr=True)
 
 
 def get_args():
@@ -48,12 +32,23 @@ def get_args():
     arg("-o", "--output_path", type=Path, help="Path where to save resulting masks.", required=True)
     arg("-t", "--tta", help="Test time augmentation.", default=None, choices=[None, "d4", "lr"]) ## lr is flip TTA, d4 is multi-scale TTA
     arg("--rgb", help="whether output rgb masks", action='store_true')
+    arg("--output-mode", default=None, choices=OUTPUT_MODES,
+        help="rgb: color masks (as --rgb), palette: single-channel PNG with the palette embedded, "
+             "label: label PNG plus a palette.json sidecar")
+    arg("--write-workers", help="processes writing masks during inference, all CPUs by default", type=int,
+        default=None)
+    arg("--write-queue", help="masks waiting for or being written at most, 2 per writer by default", type=int,
+        default=None)
+    arg("--shard", help="only run shard K of N (K/N, K from 0) of the test set, e.g. one per machine", default=None)
+    arg("--eval-state", help="save the confusion matrix to this JSON file, shards are combined with "
+                             "tools/merge_eval.py", default=None)
     arg("--val", help="whether eval validation set", action='store_true')
     return parser.parse_args()
 
 
 def main():
     args = get_args()
+    output_mode = args.output_mode or ('rgb' if args.rgb else None)
     config = py2cfg(args.config_path)
     args.output_path.mkdir(exist_ok=True, parents=True)
 
@@ -82,11 +77,16 @@ def main():
 
     test_dataset = config.test_dataset
     if args.val:
-        evaluator = Evaluator(num_class=config.num_classes)
+        evaluator = TorchEvaluator(num_class=config.num_classes)
         evaluator.reset()
         test_dataset = config.val_dataset
 
-    with torch.no_grad():
+    if args.shard is not None:
+        shard, num_shards = (int(v) for v in args.shard.split('/'))
+        test_dataset = Subset(test_dataset, range(shard, len(test_dataset), num_shards))
+
+    writer = MaskWriterPool(img_writer, num_workers=args.write_workers, max_pending=args.write_queue)
+    with torch.no_grad(), writer:
         test_loader = DataLoader(
             test_dataset,
             batch_size=2,
@@ -94,7 +94,6 @@ def main():
             pin_memory=True,
             drop_last=False,
         )
-        results = []
         for input in tqdm(test_loader):
             # raw_prediction NxCxHxW
             raw_predictions = model(input['img'].cuda(config.gpus[0]))
@@ -108,17 +107,19 @@ def main():
             raw_predictions = nn.Softmax(dim=1)(raw_predictions)
             predictions = raw_predictions.argmax(dim=1)
 
+            if args.val:
+                evaluator.add_batch(pre_image=predictions, gt_image=masks_true)
+            masks = predictions.cpu().numpy().astype(np.uint8)
             for i in range(raw_predictions.shape[0]):
-                mask = predictions[i].cpu().numpy()
+                mask = masks[i]
                 mask_name = image_ids[i]
                 mask_type = img_type[i]
                 if args.val:
                     if not os.path.exists(os.path.join(args.output_path, mask_type)):
                         os.mkdir(os.path.join(args.output_path, mask_type))
-                    evaluator.add_batch(pre_image=mask, gt_image=masks_true[i].cpu().numpy())
-                    results.append((mask, str(args.output_path / mask_type / mask_name), args.rgb))
+                    writer.submit((mask, str(args.output_path / mask_type / mask_name), output_mode))
                 else:
-                    results.append((mask, str(args.output_path / mask_name), args.rgb))
+                    writer.submit((mask, str(args.output_path / mask_name), output_mode))
     if args.val:
         iou_per_class = evaluator.Intersection_over_Union()
         f1_per_class = evaluator.F1()
@@ -126,12 +127,12 @@ def main():
         for class_name, class_iou, class_f1 in zip(config.classes, iou_per_class, f1_per_class):
             print('F1_{}:{}, IOU_{}:{}'.format(class_name, class_f1, class_name, class_iou))
         print('F1:{}, mIOU:{}, OA:{}'.format(np.nanmean(f1_per_class), np.nanmean(iou_per_class), OA))
+        if args.eval_state is not None:
+            with open(args.eval_state, 'w') as f:
+                json.dump(evaluator.state_dict(), f)
 
-    t0 = time.time()
-    mpp.Pool(processes=mp.cpu_count()).map(img_writer, results)
-    t1 = time.time()
-    img_write_time = t1 - t0
-    print('images writing spends: {} s'.format(img_write_time))
+    print('images writing spends: {} s ({} masks, written during inference)'.format(writer.wait_time,
+                                                                                   writer.num_written))
 
 
 if __name__ == "__main__":
@@ -580,8 +580,8 @@ class SwinTransformer(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
-    def forward(self, x):
-        """Forward function."""
+    def forward(self, x, num_stages=None):
+        """Forward function. `num_stages` runs only the first stages and returns their outputs."""
         # print('input size', x.size())
         x = self.patch_embed(x)
         # print('patch_embed', x.size())
@@ -596,7 +596,7 @@ class SwinTransformer(nn.Module):
         x = self.pos_drop(x)
 
         outs = []
-        for i in range(self.num_layers):
+        for i in range(self.num_layers if num_stages is None else num_stages):
             layer = self.layers[i]
             x_out, H, W, x, Wh, Ww = layer(x, Wh, Ww)
 
@@ -1266,6 +1266,38 @@ class MMCTLN(nn.Module):
         return x
 
 
+class MMCTLNMultiHead(nn.Module):
+    """One SwinTransformer backbone shared by several Decoder heads.
+
+    For heads fine-tuned on different datasets with a frozen backbone: the backbone runs once
+    per input and forward returns {head name: logits}.
+    """
+
+    def __init__(self, backbone, decoders):
+        super().__init__()
+        self.backbone = backbone
+        self.decoders = nn.ModuleDict(decoders)
+
+    @classmethod
+    def from_models(cls, models):
+        """Build from {head name: MMCTLN}; all backbones must hold the same weights."""
+        names = list(models)
+        backbone = models[names[0]].backbone
+        reference = backbone.state_dict()
+        for name in names[1:]:
+            state = models[name].backbone.state_dict()
+            if state.keys() != reference.keys() or \
+                    any(not torch.equal(state[k], reference[k].to(state[k].device)) for k in reference):
+                raise ValueError('backbone of head {} differs from head {}, heads can only share a backbone '
+                                 'that was frozen during fine-tuning'.format(name, names[0]))
+        return cls(backbone, {name: models[name].decoder for name in names})
+
+    def forward(self, x):
+        h, w = x.size()[-2:]
+        res1, res2, res3, res4 = self.backbone(x)
+        return {name: decoder(res1, res2, res3, res4, h, w) for name, decoder in self.decoders.items()}
+
+
 def mmctln_base(pretrained=True, num_classes=6, freeze_stages=-1, decoder_channels=256,
                   weight_path='pretrain_weights/stseg_base.pth'):
     model = MMCTLN(num_classes=num_classes,
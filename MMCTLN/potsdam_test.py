@@ -1,16 +1,17 @@
-import ttach as tta
-import multiprocessing.pool as mpp
-import multiprocessing as mp
-import time
 from train_supervision import *
+from tools.label_codec import OUTPUT_MODES, PALETTES, write_mask
+from tools.mask_writer import MaskWriterPool
+from tools.metric import TorchEvaluator
+from tools.tta import AdaptiveTTA, TTACostCurve, TTAEngine, geometry_product, tile_uncertainty
 import argparse
+import json
 from pathlib import Path
 import cv2
 import numpy as np
 import torch
 
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 
 
@@ -24,29 +25,14 @@ def seed_everything(seed):
     torch.backends.cudnn.benchmark = True
 
 
-def label2rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [0, 255, 0]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [255, 0, 0]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [255, 255, 0]
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = [0, 204, 255]
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = [0, 0, 255]
-    return mask_rgb
-
-
 def img_writer(inp):
-    (mask,  mask_id, rgb) = inp
-    if rgb:
-        mask_name_tif = mask_id + '.png'
-        mask_tif = label2rgb(mask)
-        cv2.imwrite(mask_name_tif, mask_tif)
-    else:
+    (mask,  mask_id, output_mode) = inp
+    if output_mode is None:
         mask_png = mask.astype(np.uint8)
         mask_name_png = mask_id + '.png'
         cv2.imwrite(mask_name_png, mask_png)
+    else:
+        write_mask(mask_id + '.png', mask, PALETTES['pv'], mode=output_mode)
 
 
 def get_args():
@@ -55,12 +41,29 @@ def get_args():
     arg("-c", "--config_path", type=Path, required=True, help="Path to  config",default='/data/xyc/cp/GeoSeg/config/potsdam/unetformer.py')
     arg("-o", "--output_path", type=Path, help="Path where to save resulting masks.", required=True,default='/data/xyc/cp/fig_results/pots')
     arg("-t", "--tta", help="Test time augmentation.", default=None, choices=[None, "d4", "lr"])
+    arg("--tta-threshold", help="only augment tiles whose plain-forward uncertainty is above this", type=float,
+        default=None)
+    arg("--tta-metric", help="per-tile uncertainty used by --tta-threshold", default="entropy",
+        choices=["entropy", "margin"])
+    arg("--tta-curve", help="predict every tile with and without TTA and report accuracy against TTA cost",
+        action='store_true')
     arg("--rgb", help="whether output rgb images", action='store_true')
+    arg("--output-mode", default=None, choices=OUTPUT_MODES,
+        help="rgb: color masks (as --rgb), palette: single-channel PNG with the palette embedded, "
+             "label: label PNG plus a palette.json sidecar")
+    arg("--write-workers", help="processes writing masks during inference, all CPUs by default", type=int,
+        default=None)
+    arg("--write-queue", help="masks waiting for or being written at most, 2 per writer by default", type=int,
+        default=None)
+    arg("--shard", help="only run shard K of N (K/N, K from 0) of the test set, e.g. one per machine", default=None)
+    arg("--eval-state", help="save the confusion matrix to this JSON file, shards are combined with "
+                             "tools/merge_eval.py", default=None)
     return parser.parse_args()
 
 
 def main():
     args = get_args()
+    output_mode = args.output_mode or ('rgb' if args.rgb else None)
     seed_everything(42)
 
     config = py2cfg(args.config_path)
@@ -69,31 +72,31 @@ def main():
     model = Supervision_Train.load_from_checkpoint(
         os.path.join(config.weights_path, config.test_weights_name + '.ckpt'), config=config)
     model.cuda(config.gpus[0])
-    evaluator = Evaluator(num_class=config.num_classes)
+    evaluator = TorchEvaluator(num_class=config.num_classes)
     evaluator.reset()
     model.eval()
+    engine = None
     if args.tta == "lr":
-        transforms = tta.Compose(
-            [
-                tta.HorizontalFlip(),
-                tta.VerticalFlip()
-            ]
-        )
-        model = tta.SegmentationTTAWrapper(model, transforms)
+        engine = TTAEngine(model, geometries=geometry_product(hflip=True, vflip=True))
     elif args.tta == "d4":
-        transforms = tta.Compose(
-            [
-                tta.HorizontalFlip(),
-                tta.VerticalFlip(),
-                # tta.Rotate90(angles=[90]),
-                tta.Scale(scales=[0.75, 1.0, 1.25, 1.5], interpolation='bicubic', align_corners=False)
-            ]
-        )
-        model = tta.SegmentationTTAWrapper(model, transforms)
+        engine = TTAEngine(model, geometries=geometry_product(hflip=True, vflip=True),
+                           scales=[0.75, 1.0, 1.25, 1.5], interpolation='bicubic', align_corners=False)
+    curve = None
+    if engine is not None and args.tta_curve:
+        curve = TTACostCurve(config.num_classes, engine.relative_cost)
+    elif engine is not None and args.tta_threshold is not None:
+        model = AdaptiveTTA(engine, args.tta_threshold, metric=args.tta_metric)
+    elif engine is not None:
+        model = engine
 
     test_dataset = config.test_dataset
 
-    with torch.no_grad():
+    if args.shard is not None:
+        shard, num_shards = (int(v) for v in args.shard.split('/'))
+        test_dataset = Subset(test_dataset, range(shard, len(test_dataset), num_shards))
+
+    writer = MaskWriterPool(img_writer, num_workers=args.write_workers, max_pending=args.write_queue)
+    with torch.no_grad(), writer:
         test_loader = DataLoader(
             test_dataset,
             batch_size=2,
@@ -101,33 +104,52 @@ def main():
             pin_memory=True,
             drop_last=False,
         )
-        results = []
         for input in tqdm(test_loader):
             # raw_prediction NxCxHxW
-            raw_predictions = model(input['img'].cuda(config.gpus[0]))
-
             image_ids = input["img_id"]
             masks_true = input['gt_semantic_seg']
+            if curve is not None:
+                x = input['img'].cuda(config.gpus[0])
+                plain_predictions = model(x)
+                tta_predictions = engine(x, base=plain_predictions)
+                uncertainty = tile_uncertainty(plain_predictions, args.tta_metric)
+                for i in range(x.shape[0]):
+                    curve.add(uncertainty[i], masks_true[i].numpy(), plain_predictions[i].argmax(dim=0).cpu().numpy(),
+                              tta_predictions[i].argmax(dim=0).cpu().numpy())
+                raw_predictions = tta_predictions
+                if args.tta_threshold is not None:
+                    gated = (uncertainty > args.tta_threshold).view(-1, 1, 1, 1)
+                    raw_predictions = torch.where(gated, tta_predictions, plain_predictions)
+            else:
+                raw_predictions = model(input['img'].cuda(config.gpus[0]))
 
             raw_predictions = nn.Softmax(dim=1)(raw_predictions)
             predictions = raw_predictions.argmax(dim=1)
 
+            evaluator.add_batch(pre_image=predictions, gt_image=masks_true)
+            masks = predictions.cpu().numpy().astype(np.uint8)
             for i in range(raw_predictions.shape[0]):
-                mask = predictions[i].cpu().numpy()
-                evaluator.add_batch(pre_image=mask, gt_image=masks_true[i].cpu().numpy())
+                mask = masks[i]
                 mask_name = image_ids[i]
-                results.append((mask, str(args.output_path / mask_name), args.rgb))
+                writer.submit((mask, str(args.output_path / mask_name), output_mode))
     iou_per_class = evaluator.Intersection_over_Union()
     f1_per_class = evaluator.F1()
     OA = evaluator.OA()
     for class_name, class_iou, class_f1 in zip(config.classes, iou_per_class, f1_per_class):
         print('F1_{}:{}, IOU_{}:{}'.format(class_name, class_f1, class_name, class_iou))
     print('F1:{}, mIOU:{}, OA:{}'.format(np.nanmean(f1_per_class[:-1]), np.nanmean(iou_per_class[:-1]), OA))
-    t0 = time.time()
-    mpp.Pool(processes=mp.cpu_count()).map(img_writer, results)
-    t1 = time.time()
-    img_write_time = t1 - t0
-    print('images writing spends: {} s'.format(img_write_time))
+    if args.eval_state is not None:
+        with open(args.eval_state, 'w') as f:
+            json.dump(evaluator.state_dict(), f)
+    if isinstance(model, AdaptiveTTA):
+        print(model.summary())
+    if curve is not None:
+        for fraction, threshold, cost, curve_evaluator in curve.rows():
+            print('TTA on top {:.0%} uncertain tiles (--tta-threshold {:.4f}): cost {:.2f}x, '
+                  'F1:{}, mIOU:{}, OA:{}'.format(fraction, threshold, cost, np.nanmean(curve_evaluator.F1()[:-1]),
+                np.nanmean(curve_evaluator.Intersection_over_Union()[:-1]), curve_evaluator.OA()))
+    print('images writing spends: {} s ({} masks, written during inference)'.format(writer.wait_time,
+                                                                                   writer.num_written))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.postprocess import parse_min_area, remove_small_regions
+
+FILL = 255
+
+
+def aoi_mask():
+    """Left third outside the AOI (FILL), class 1 inside, with small class 2 and 3 regions."""
+    mask = np.ones((40, 60), dtype=np.uint8)
+    mask[:, :20] = FILL
+    # small region touching both the fill and class 1, mostly along the fill
+    mask[10:13, 18:21] = 2
+    # small region bordered only by the fill
+    mask[30:32, 5:7] = 3
+    # a small fill pocket inside the AOI
+    mask[35:37, 40:42] = FILL
+    return mask
+
+
+@pytest.mark.parametrize('band_rows', [4, 7, 64])
+@pytest.mark.parametrize('connectivity', [4, 8])
+def test_aoi_fill_is_ignored(band_rows, connectivity):
+    mask = aoi_mask()
+    out = remove_small_regions(mask, parse_min_area('10'), band_rows=band_rows, connectivity=connectivity,
+                               ignore_label=FILL)
+    # relabeled to its in-AOI neighbour, not merged into the fill
+    assert (out[10:13, 18:21] == 1).all()
+    # no voting neighbour, keeps its class
+    assert (out[30:32, 5:7] == 3).all()
+    # the fill is never relabeled, however small
+    assert (out[35:37, 40:42] == FILL).all()
+    assert (out[:, :20][mask[:, :20] == FILL] == FILL).all()
+
+
+def test_without_ignore_the_fill_votes():
+    mask = aoi_mask()
+    out = remove_small_regions(mask, parse_min_area('10'), band_rows=8)
+    assert (out[10:13, 18:21] == FILL).all()
+    assert (out[35:37, 40:42] == 1).all()
@@ -0,0 +1,69 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.label_codec import GT_PALETTES
+from tools.metric import Evaluator
+from tools.stream_eval import RowReader, evaluate_streaming
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# ISPRS ground-truth colors (RGB) and their labels
+ISPRS = [((255, 255, 255), 0), ((0, 0, 255), 1), ((0, 255, 255), 2), ((0, 255, 0), 3), ((255, 255, 0), 4),
+         ((255, 0, 0), 5)]
+
+
+def isprs_mask(h=96, w=80):
+    rgb = np.zeros((h, w, 3), dtype=np.uint8)
+    labels = np.zeros((h, w), dtype=np.uint8)
+    for i, (color, label) in enumerate(ISPRS):
+        rgb[i * 16:(i + 1) * 16] = color
+        labels[i * 16:(i + 1) * 16] = label
+    # a color outside the palette must be ignored, not counted as class 0
+    rgb[:4, :4] = (12, 34, 56)
+    return rgb, labels
+
+
+def write_variants(tmpdir, rgb):
+    paths = {}
+    paths['png'] = os.path.join(tmpdir, 'gt.png')
+    cv2.imwrite(paths['png'], cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+    if tifffile is not None:
+        paths['tif'] = os.path.join(tmpdir, 'gt.tif')
+        tifffile.imwrite(paths['tif'], rgb, photometric='rgb')
+        paths['tif_deflate'] = os.path.join(tmpdir, 'gt_deflate.tif')
+        tifffile.imwrite(paths['tif_deflate'], rgb, photometric='rgb', compression='deflate', rowsperstrip=8)
+    return paths
+
+
+def test_readers_return_rgb(tmp_path):
+    rgb, _ = isprs_mask()
+    paths = write_variants(str(tmp_path), rgb)
+    if tifffile is None:
+        pytest.skip('tifffile is not installed')
+    for name, path in paths.items():
+        reader = RowReader(path)
+        try:
+            rows = np.concatenate([reader.rows(y, y + 24) for y in range(0, rgb.shape[0], 24)])
+        finally:
+            reader.close()
+        assert np.array_equal(rows, rgb), name
+
+
+def test_isprs_color_ground_truth(tmp_path):
+    rgb, labels = isprs_mask()
+    for name, path in write_variants(str(tmp_path), rgb).items():
+        evaluator = evaluate_streaming(Evaluator(num_class=6), labels, path, band_rows=32,
+                                       palette=GT_PALETTES['pv'])
+        matrix = np.asarray(evaluator.confusion_matrix)
+        expected = np.bincount(labels.ravel(), minlength=6).astype(np.int64)
+        expected[0] -= 16
+        assert np.array_equal(np.diag(matrix), expected), name
+        assert matrix.sum() == expected.sum(), name
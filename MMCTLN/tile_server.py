@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import math
+import time
+from collections import deque
+from pathlib import Path
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from tools.cfg import py2cfg
+from tools.label_codec import PALETTES, display_palette
+from tools.tile_cache import DiskLRUCache, LRUCache
+from tools.tta import TTAEngine, geometry_product
+from train_supervision import *
+from inference_server import DynamicBatcher, InferenceServer
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-i", "--image_path", type=Path, required=True, help="source raster")
+    arg("-c", "--config_path", type=Path, required=True, help="Path to  config")
+    arg("-t", "--tta", help="Test time augmentation.", default=None, choices=[None, "d4", "lr"])
+    arg("-d", "--dataset", help="palette of the served tiles", default="pv", choices=list(PALETTES))
+    arg("--tile-size", help="size of a map tile", type=int, default=256)
+    arg("--margin", help="context pixels predicted around a tile, tile + 2 * margin must suit the model",
+        type=int, default=128)
+    arg("-b", "--batch-size", help="largest batch formed from concurrent tiles", type=int, default=8)
+    arg("--max-latency-ms", help="how long the first tile of a batch waits for others", type=float, default=10)
+    arg("--memory-tiles", help="encoded tiles kept in memory", type=int, default=4096)
+    arg("--disk-cache", help="directory of the on-disk tile cache, none by default", default=None)
+    arg("--disk-cache-mb", help="size limit of the on-disk tile cache", type=float, default=1024)
+    arg("--prefetch", help="neighbours within this many tiles of a requested tile are predicted ahead, 0 disables",
+        type=int, default=1)
+    arg("--host", default="127.0.0.1")
+    arg("--port", type=int, default=8001)
+    return parser.parse_args()
+
+
+def load_raster(path):
+    """HxWx3 RGB raster; uncompressed GeoTIFFs are memory-mapped instead of read."""
+    if tifffile is not None and str(path).lower().endswith(('.tif', '.tiff')):
+        try:
+            raster = tifffile.memmap(str(path), mode='r')
+        except ValueError:
+            raster = tifffile.imread(str(path))
+        return raster[..., :3]
+    return cv2.cvtColor(cv2.imread(str(path), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+
+class TileService(InferenceServer):
+    """Prediction tiles of one raster, computed on request: GET /tiles/{z}/{x}/{y}.png.
+
+    Tiles address the raster's pixel grid (a CRS.Simple map in Leaflet terms): at the deepest
+    zoom one tile is `tile_size` source pixels, every level up halves the resolution and zoom
+    0 holds the whole raster. Each tile is predicted from a window with `margin` context pixels
+    on every side; windows from concurrent requests are batched by the DynamicBatcher. Encoded
+    tiles go to an in-memory LRU and an optional on-disk LRU, and the neighbours of requested
+    tiles are predicted ahead. GET /stats reports hit rates and latencies.
+    """
+
+    def __init__(self, batcher, raster, palette, tile_size=256, margin=128, memory_tiles=4096, disk_cache=None,
+                 prefetch=1):
+        window = tile_size + 2 * margin
+        super().__init__(batcher, (window, window))
+        self.raster = raster
+        self.tile_size = tile_size
+        self.margin = margin
+        self.max_zoom = max(0, math.ceil(math.log2(max(raster.shape[:2]) / tile_size)))
+        self.palette = palette
+        self.memory = LRUCache(memory_tiles)
+        self.disk = disk_cache
+        self.prefetch = prefetch
+        self.pending = {}
+        self.num_requests = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.num_prefetched = 0
+        self.latencies = deque(maxlen=10000)
+        self.compute_latencies = deque(maxlen=10000)
+
+    def level_shape(self, z):
+        """Height and width of the raster at zoom `z`."""
+        scale = 2 ** (self.max_zoom - z)
+        h, w = self.raster.shape[:2]
+        return max(1, math.ceil(h / scale)), max(1, math.ceil(w / scale))
+
+    def contains(self, z, x, y):
+        if not 0 <= z <= self.max_zoom or x < 0 or y < 0:
+            return False
+        h, w = self.level_shape(z)
+        return x * self.tile_size < w and y * self.tile_size < h
+
+    def window(self, z, x, y):
+        """Context window of a tile, read and downsampled from the part of the raster it covers.
+
+        Only that part is read, so a memory-mapped raster is never loaded whole. At coarse zooms the
+        source is sampled with a stride of scale / 4 before the area resize.
+        """
+        scale = 2 ** (self.max_zoom - z)
+        h, w = self.level_shape(z)
+        size = self.tile_size + 2 * self.margin
+        y0, x0 = y * self.tile_size - self.margin, x * self.tile_size - self.margin
+        window = np.zeros((size, size, 3), dtype=np.uint8)
+        sy, sx = max(y0, 0), max(x0, 0)
+        ey, ex = min(y0 + size, h), min(x0 + size, w)
+        step = max(1, scale // 4)
+        source = np.asarray(self.raster[sy * scale:ey * scale:step, sx * scale:ex * scale:step])
+        if source.shape[:2] != (ey - sy, ex - sx):
+            source = cv2.resize(source, (ex - sx, ey - sy), interpolation=cv2.INTER_AREA)
+        window[sy - y0:ey - y0, sx - x0:ex - x0] = source
+        return window
+
+    def encode(self, labels):
+        image = Image.fromarray(labels, mode='P')
+        image.putpalette(self.palette.tobytes())
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', compress_level=1)
+        return buffer.getvalue()
+
+    async def _compute(self, key):
+        t0 = time.time()
+        z, x, y = key
+        # reading the raster may page in a large region, keep it off the event loop
+        window = await asyncio.get_event_loop().run_in_executor(None, self.window, z, x, y)
+        mask = await self.batcher.predict(window)
+        m, t = self.margin, self.tile_size
+        data = self.encode(np.ascontiguousarray(mask[m:m + t, m:m + t]))
+        self.compute_latencies.append(time.time() - t0)
+        return data
+
+    async def tile(self, key):
+        """Encoded tile and where it came from: 'memory', 'disk' or 'model'."""
+        data = self.memory.get(key)
+        if data is not None:
+            return data, 'memory'
+        name = '{}_{}_{}.png'.format(*key)
+        if self.disk is not None:
+            data = self.disk.get(name)
+            if data is not None:
+                self.memory.put(key, data)
+                return data, 'disk'
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self._compute(key))
+        future = self.pending[key]
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            if future.done():
+                self.pending.pop(key, None)
+        if self.memory.get(key) is None:
+            self.memory.put(key, data)
+            if self.disk is not None:
+                self.disk.put(name, data)
+        return data, 'model'
+
+    def schedule_prefetch(self, z, x, y):
+        for dy in range(-self.prefetch, self.prefetch + 1):
+            for dx in range(-self.prefetch, self.prefetch + 1):
+                key = (z, x + dx, y + dy)
+                if (dx or dy) and self.contains(*key) and key not in self.pending \
+                        and self.memory.get(key) is None:
+                    self.num_prefetched += 1
+                    asyncio.ensure_future(self.tile(key))
+
+    def stats(self):
+        def percentiles(values):
+            values = np.array(values) * 1000 if values else np.zeros(1)
+            return {'p50_ms': float(np.percentile(values, 50)), 'p99_ms': float(np.percentile(values, 99))}
+
+        hits = self.memory_hits + self.disk_hits
+        return {'requests': self.num_requests, 'hit_rate': hits / max(self.num_requests, 1),
+                'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'prefetched': self.num_prefetched,
+                'memory_tiles': len(self.memory), 'disk_tiles': 0 if self.disk is None else len(self.disk),
+                'latency': percentiles(list(self.latencies)), 'compute': percentiles(list(self.compute_latencies)),
+                'max_zoom': self.max_zoom, 'batcher': self.batcher.stats()}
+
+    async def dispatch(self, method, path, body):
+        parts = path.strip('/').split('/')
+        if method == 'GET' and len(parts) == 4 and parts[0] == 'tiles' and parts[3].endswith('.png'):
+            try:
+                z, x, y = int(parts[1]), int(parts[2]), int(parts[3][:-4])
+            except ValueError:
+                return 400, 'text/plain', b'bad tile address'
+            if not self.contains(z, x, y):
+                return 404, 'text/plain', b'outside the raster'
+            t0 = time.time()
+            self.num_requests += 1
+            data, source = await self.tile((z, x, y))
+            if source == 'memory':
+                self.memory_hits += 1
+            elif source == 'disk':
+                self.disk_hits += 1
+            self.latencies.append(time.time() - t0)
+            if self.prefetch > 0:
+                self.schedule_prefetch(z, x, y)
+            return 200, 'image/png', data
+        if method == 'GET' and path == '/stats':
+            return 200, 'application/json', json.dumps(self.stats()).encode()
+        return 404, 'text/plain', b'not found'
+
+
+def cache_name(args, config):
+    """Folder name of the on-disk cache: the raster name and a hash of everything that changes the tiles."""
+    ckpt_path = os.path.join(config.weights_path, config.test_weights_name + '.ckpt')
+    key = dict(config=str(args.config_path.resolve()), weights=config.test_weights_name,
+               ckpt_mtime=os.path.getmtime(ckpt_path) if os.path.exists(ckpt_path) else None,
+               tta=args.tta, dataset=args.dataset, tile_size=args.tile_size, margin=args.margin)
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    return '{}-{}'.format(args.image_path.stem, digest)
+
+
+async def serve(args, model, device, raster, cache_name):
+    batcher = DynamicBatcher(model, device, max_batch_size=args.batch_size,
+                             max_latency=args.max_latency_ms / 1000.0)
+    disk = None
+    if args.disk_cache is not None:
+        disk = DiskLRUCache(os.path.join(args.disk_cache, cache_name), int(args.disk_cache_mb * 2 ** 20))
+    palette = display_palette(PALETTES[args.dataset], bgr=args.dataset in ('landcoverai', 'uavid'))
+    server = TileService(batcher, raster, palette, tile_size=args.tile_size, margin=args.margin,
+                         memory_tiles=args.memory_tiles, disk_cache=disk, prefetch=args.prefetch)
+    batch_task = asyncio.ensure_future(batcher.run())
+    listener = await asyncio.start_server(server.handle, host=args.host, port=args.port)
+    print('serving {} ({}x{}, zoom 0-{}) on http://{}:{}/tiles/{{z}}/{{x}}/{{y}}.png'.format(
+        args.image_path, raster.shape[1], raster.shape[0], server.max_zoom, args.host, args.port))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+def main():
+    args = get_args()
+    config = py2cfg(args.config_path)
+    device = torch.device('cuda:{}'.format(config.gpus[0]) if torch.cuda.is_available() else 'cpu')
+    model = Supervision_Train.load_from_checkpoint(
+        os.path.join(config.weights_path, config.test_weights_name + '.ckpt'), config=config, map_location=device)
+    model.to(device)
+    model.eval()
+
+    if args.tta == "lr":
+        model = TTAEngine(model, geometries=geometry_product(hflip=True, vflip=True))
+    elif args.tta == "d4":
+        model = TTAEngine(model, geometries=geometry_product(hflip=True), scales=[0.75, 1, 1.25, 1.5, 1.75])
+
+    asyncio.run(serve(args, model, device, load_raster(args.image_path), cache_name(args, config)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import glob
+import json
+import os
+
+import cv2
+import numpy as np
+
+
+def read_polygons(path):
+    """Polygons of a GeoJSON file (FeatureCollection, Feature or geometry) or a line-delimited
+    .geojsonl as written by tools/polygonize.py; every polygon is a list of rings, exterior first."""
+    with open(path) as f:
+        if str(path).endswith(('.geojsonl', '.geojsons', '.jsonl')):
+            objects = [json.loads(line) for line in f if line.strip()]
+        else:
+            objects = [json.load(f)]
+    polygons = []
+    while objects:
+        obj = objects.pop()
+        if obj is None:
+            continue
+        if obj['type'] == 'FeatureCollection':
+            objects.extend(obj['features'])
+        elif obj['type'] == 'Feature':
+            objects.append(obj['geometry'])
+        elif obj['type'] == 'GeometryCollection':
+            objects.extend(obj['geometries'])
+        elif obj['type'] == 'Polygon':
+            polygons.append(obj['coordinates'])
+        elif obj['type'] == 'MultiPolygon':
+            polygons.extend(obj['coordinates'])
+    return polygons
+
+
+def rasterize_polygons(polygons, shape, transform=None):
+    """HxW bool mask of the pixels inside `polygons`, pixels on the boundary included as cv2 fills them.
+
+    Coordinates are pixel-corner coordinates, or map coordinates when `transform` = (x0, dx, y0, dy)
+    of the raster is given.
+    """
+    mask = np.zeros(shape, dtype=np.uint8)
+    for rings in polygons:
+        pixel_rings = []
+        for ring in rings:
+            ring = np.asarray(ring, dtype=np.float64)[:, :2]
+            if transform is not None:
+                x0, dx, y0, dy = transform
+                ring = np.stack([(ring[:, 0] - x0) / dx, (ring[:, 1] - y0) / dy], axis=1)
+            # cv2 puts vertices on pixel centers; 4 fractional bits keep sub-pixel vertices
+            pixel_rings.append(np.round((ring - 0.5) * 16).astype(np.int32))
+        cv2.fillPoly(mask, pixel_rings[:1], 1, shift=4)
+        if len(pixel_rings) > 1:
+            cv2.fillPoly(mask, pixel_rings[1:], 0, shift=4)
+    return mask.astype(bool)
+
+
+def load_aoi(path, shape, transform=None):
+    """Area of interest as an HxW bool mask, from a raster mask (nonzero inside, resized to `shape`
+    when needed) or from polygons rasterized on the fly."""
+    if str(path).lower().endswith(('.json', '.geojson', '.geojsonl', '.geojsons', '.jsonl')):
+        return rasterize_polygons(read_polygons(path), shape, transform)
+    mask = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if mask is None:
+        raise ValueError('could not read the AOI mask {}'.format(path))
+    if mask.ndim == 3:
+        mask = mask.max(axis=2)
+    if mask.shape != tuple(shape):
+        mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+    return mask > 0
+
+
+def find_per_image(path, img_path):
+    """The companion file of one image (AOI, ground truth): `path` itself, or the file with the
+    image's name in a `path` folder (None when missing)."""
+    if not os.path.isdir(path):
+        return path
+    stem = os.path.splitext(os.path.basename(img_path))[0]
+    matches = sorted(glob.glob(os.path.join(glob.escape(str(path)), glob.escape(stem) + '.*')))
+    return matches[0] if matches else None
+
+
+def tile_index(aoi, patch_size):
+    """Bool per tile (row-major over a mask padded to whole tiles): tile intersects the AOI."""
+    rows, cols = aoi.shape[0] // patch_size[0], aoi.shape[1] // patch_size[1]
+    return aoi.reshape(rows, patch_size[0], cols, patch_size[1]).any(axis=(1, 3)).ravel()
@@ -0,0 +1,102 @@
+import json
+import os
+import socket
+import time
+
+import torch
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'mmctln', 'autotune.json')
+
+
+def parse_sizes(text):
+    """'512,768,1152x1024' -> [(512, 512), (768, 768), (1152, 1024)] as (height, width)."""
+    sizes = []
+    for item in text.split(','):
+        h, _, w = item.strip().partition('x')
+        sizes.append((int(h), int(w or h)))
+    return sizes
+
+
+def _device_name(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return 'cpu'
+
+
+def benchmark(model, batch_size, tile, device, iters=3):
+    """(MP/s, peak MB) of `model` on random tiles, None when the setting fails (e.g. out of memory)."""
+    x = torch.randn(batch_size, 3, tile[0], tile[1], device=device)
+    try:
+        with torch.no_grad():
+            model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+            t0 = time.time()
+            for _ in range(iters):
+                model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            elapsed = time.time() - t0
+    except (RuntimeError, MemoryError):
+        # out of memory, or a tile size the model does not accept
+        return None
+    finally:
+        del x
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return batch_size * tile[0] * tile[1] * iters / 1e6 / elapsed, peak
+
+
+def _load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def autotune(model, tiles, batch_sizes, device, memory_cap_mb=None, cache_path=DEFAULT_CACHE, name='', iters=3):
+    """Pick the (batch size, tile) with the highest MP/s among the candidates.
+
+    Larger batches of a tile are only tried while the smaller one fits; peak CUDA memory above
+    `memory_cap_mb` counts as not fitting (on CPU only real allocation failures do). Results are
+    cached in `cache_path` per model, host, device, thread count and candidate set.
+    """
+    device = torch.device(device)
+    key = json.dumps(dict(model=name, params=sum(p.numel() for p in model.parameters()),
+                          host=socket.gethostname(), device=_device_name(device), threads=torch.get_num_threads(),
+                          tiles=[list(t) for t in tiles], batch_sizes=sorted(batch_sizes),
+                          memory_cap_mb=memory_cap_mb), sort_keys=True)
+    cache = _load_cache(cache_path)
+    if key in cache:
+        entry = cache[key]
+        return entry['batch_size'], tuple(entry['tile'])
+
+    best = None
+    for tile in tiles:
+        for batch_size in sorted(batch_sizes):
+            result = benchmark(model, batch_size, tile, device, iters=iters)
+            if result is None or (memory_cap_mb is not None and result[1] > memory_cap_mb):
+                print('autotune: batch {} tile {}x{}: {}'.format(
+                    batch_size, tile[0], tile[1], 'failed' if result is None else 'over the memory cap'))
+                break
+            print('autotune: batch {} tile {}x{}: {:.3f} MP/s, peak {:.0f} MB'.format(
+                batch_size, tile[0], tile[1], result[0], result[1]))
+            if best is None or result[0] > best[0]:
+                best = (result[0], batch_size, tile)
+    # the synthetic tiles must not show up in the cascade / adaptive TTA counters of the real run
+    for module in model.modules():
+        if hasattr(module, 'reset_stats'):
+            module.reset_stats()
+    if best is None:
+        raise RuntimeError('autotune: no (batch size, tile) candidate fits on {}'.format(_device_name(device)))
+
+    cache = _load_cache(cache_path)
+    cache[key] = {'batch_size': best[1], 'tile': list(best[2]), 'mp_per_s': best[0]}
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, cache_path)
+    return best[1], best[2]
@@ -0,0 +1,84 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from pathlib import Path
+import albumentations as albu
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.cascade import CascadeModel
+from tools.cfg import py2cfg
+from tools.cpu_pool import tile_coords
+from tools.metric import Evaluator
+from inference_huge_image import get_img_padded, load_model
+
+
+# cascade (-c small, --large-config large) against the large model alone on a folder of images;
+# mIoU is measured with the large model's labels as reference
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--image_path", type=Path, required=True)
+    parser.add_argument("-c", "--config_path", type=Path, required=True, help="small model config")
+    parser.add_argument("--large-config", type=Path, required=True)
+    parser.add_argument("-ph", "--patch-height", type=int, default=512)
+    parser.add_argument("-pw", "--patch-width", type=int, default=512)
+    parser.add_argument("-b", "--batch-size", type=int, default=2)
+    parser.add_argument("--thresholds", type=str, default="0.1,0.2,0.3,0.4,0.5")
+    parser.add_argument("--metric", default="entropy", choices=["entropy", "margin"])
+    parser.add_argument("--window", type=int, default=0)
+    parser.add_argument("--context", type=int, default=0)
+    return parser.parse_args()
+
+
+def load_tiles(image_path, patch_size):
+    normalize = albu.Normalize()
+    tiles = []
+    for img_path in sorted(glob.glob(os.path.join(image_path, '*'))):
+        img = cv2.imread(img_path, cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        img_pad, _, _ = get_img_padded(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), patch_size)
+        for (m, n) in tile_coords(img_pad.shape[0], img_pad.shape[1], patch_size):
+            tiles.append(normalize(image=img_pad[m:m + patch_size[0], n:n + patch_size[1]])['image'])
+    return torch.from_numpy(np.stack(tiles)).permute(0, 3, 1, 2).float()
+
+
+def predict(model, tiles, batch_size, device):
+    labels = []
+    with torch.no_grad():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t0 = time.time()
+        for i in range(0, len(tiles), batch_size):
+            labels.append(model(tiles[i:i + batch_size].to(device)).argmax(dim=1).cpu())
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return torch.cat(labels).numpy(), time.time() - t0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    small_config, large_config = py2cfg(args.config_path), py2cfg(args.large_config)
+    device = torch.device('cuda:{}'.format(small_config.gpus[0]) if torch.cuda.is_available() else 'cpu')
+    small = load_model(small_config, on_cpu=device.type == 'cpu')
+    large = load_model(large_config, on_cpu=device.type == 'cpu')
+    tiles = load_tiles(args.image_path, (args.patch_height, args.patch_width))
+    megapixels = tiles.shape[0] * tiles.shape[2] * tiles.shape[3] / 1e6
+
+    predict(large, tiles[:args.batch_size], args.batch_size, device)
+    reference, t_large = predict(large, tiles, args.batch_size, device)
+    print('{} tiles, large only: {:.3f} MP/s'.format(len(tiles), megapixels / t_large))
+    print('threshold  escalated  MP/s  speedup  mIoU vs large')
+    for threshold in [float(t) for t in args.thresholds.split(',')]:
+        cascade = CascadeModel(small, large, threshold, metric=args.metric, window=args.window or None,
+                               context=args.context, large_batch_size=args.batch_size)
+        labels, t_cascade = predict(cascade, tiles, args.batch_size, device)
+        evaluator = Evaluator(num_class=large_config.num_classes)
+        evaluator.add_batch(gt_image=reference, pre_image=labels)
+        print('{:9.3f} {:9.1%} {:6.3f} {:7.2f}x {:.4f}'.format(
+            threshold, cascade.escalation_rate, megapixels / t_cascade, t_large / t_cascade,
+            np.nanmean(evaluator.Intersection_over_Union())))
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mmctln_main.models.MMCTLN import mmctln_base, mmctln_small, mmctln_tiny
+from tools.cpu_pool import CPUWorkerPool
+
+ARCHS = {'tiny': mmctln_tiny, 'small': mmctln_small, 'base': mmctln_base}
+
+
+# scaling grid of CPUWorkerPool on a synthetic scene, weights are random
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", default="tiny", choices=list(ARCHS))
+    parser.add_argument("--num-classes", type=int, default=6)
+    parser.add_argument("--image-size", type=int, default=2048)
+    parser.add_argument("--patch-size", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--workers", type=str, default="1,2,4,8")
+    parser.add_argument("--threads", type=str, default="1,2,4,8")
+    parser.add_argument("--max-cores", type=int, default=os.cpu_count())
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    model = ARCHS[args.arch](pretrained=False, num_classes=args.num_classes)
+    image = np.random.RandomState(42).randint(0, 256, (args.image_size, args.image_size, 3), dtype=np.uint8)
+    patch_size = (args.patch_size, args.patch_size)
+    megapixels = image.shape[0] * image.shape[1] / 1e6
+
+    print('workers threads  MP/s')
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for threads in [int(t) for t in args.threads.split(',')]:
+            if workers * threads > args.max_cores:
+                continue
+            with CPUWorkerPool(model, num_workers=workers, num_threads=threads,
+                               batch_size=args.batch_size) as pool:
+                # warm up before timing
+                pool.predict(image[:args.patch_size * workers, :args.patch_size], patch_size)
+                t0 = time.time()
+                pool.predict(image, patch_size)
+                t1 = time.time()
+            print('{:7d} {:7d} {:6.3f}'.format(workers, threads, megapixels / (t1 - t0)))
@@ -0,0 +1,109 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from pathlib import Path
+import albumentations as albu
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.cfg import py2cfg
+from tools.cpu_pool import tile_coords
+from tools.label_codec import PALETTES, rgb2label
+from tools.metric import Evaluator
+from tools.tile_cache import FrameDiffGate
+from inference_uavid import get_img_padded, load_model
+
+
+# skip rate and accuracy drift of FrameDiffGate on UAVid-style sequences (seq*/Images, optional
+# seq*/Labels). Every tile is predicted once; a gated run differs only in which predictions it
+# reuses, so all thresholds are replayed from the same predictions
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--image_path", type=Path, default='data/uavid/uavid_val')
+    parser.add_argument("-c", "--config_path", type=Path, required=True)
+    parser.add_argument("-ph", "--patch-height", type=int, default=1152)
+    parser.add_argument("-pw", "--patch-width", type=int, default=1024)
+    parser.add_argument("-b", "--batch-size", type=int, default=2)
+    parser.add_argument("--thresholds", default="0.005,0.01,0.02,0.04")
+    parser.add_argument("--method", default="diff", choices=["diff", "phash"])
+    parser.add_argument("--max-skip", type=int, default=10)
+    return parser.parse_args()
+
+
+def predict_tiles(model, tiles, batch_size, device):
+    normalize = albu.Normalize()
+    x = torch.from_numpy(np.stack([normalize(image=t)['image'] for t in tiles])).permute(0, 3, 1, 2).float()
+    labels = []
+    with torch.no_grad():
+        for i in range(0, len(x), batch_size):
+            labels.append(model(x[i:i + batch_size].to(device)).argmax(dim=1).cpu())
+    return list(torch.cat(labels).numpy().astype(np.uint8))
+
+
+def stitch(tiles, coords, pad_shape, shape, patch_size):
+    mask = np.zeros(pad_shape, dtype=np.uint8)
+    for (m, n), tile in zip(coords, tiles):
+        mask[m:m + patch_size[0], n:n + patch_size[1]] = tile
+    return mask[-shape[0]:, -shape[1]:]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = py2cfg(args.config_path)
+    device = torch.device('cuda:{}'.format(config.gpus[0]) if torch.cuda.is_available() else 'cpu')
+    model = load_model(config, on_cpu=device.type == 'cpu')
+    patch_size = (args.patch_height, args.patch_width)
+    thresholds = [float(t) for t in args.thresholds.split(',')]
+    gates = [FrameDiffGate(t, method=args.method, max_skip=args.max_skip) for t in thresholds]
+    agreement = [Evaluator(num_class=config.num_classes) for _ in thresholds]
+    accuracy = [Evaluator(num_class=config.num_classes) for _ in [None] + thresholds]
+    gate_time = [0.0] * len(thresholds)
+    model_time = 0.0
+    has_labels = True
+
+    for seq in sorted(os.listdir(args.image_path)):
+        img_paths = sorted(glob.glob(os.path.join(args.image_path, seq, 'Images', '*.png')))
+        for gate in gates:
+            gate.reset()
+        for img_path in img_paths:
+            img = cv2.cvtColor(cv2.imread(img_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+            img_pad, _, _ = get_img_padded(img, patch_size)
+            coords = tile_coords(img_pad.shape[0], img_pad.shape[1], patch_size)
+            tiles = [img_pad[m:m + patch_size[0], n:n + patch_size[1]] for (m, n) in coords]
+            t0 = time.time()
+            predictions = predict_tiles(model, tiles, args.batch_size, device)
+            model_time += time.time() - t0
+            reference = stitch(predictions, coords, img_pad.shape[:2], img.shape[:2], patch_size)
+
+            gt_path = os.path.join(args.image_path, seq, 'Labels', os.path.basename(img_path))
+            has_labels = has_labels and os.path.exists(gt_path)
+            if has_labels:
+                gt = rgb2label(cv2.cvtColor(cv2.imread(gt_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB),
+                               PALETTES['uavid'])
+                accuracy[0].add_batch(pre_image=reference, gt_image=gt)
+            for j, gate in enumerate(gates):
+                t0 = time.time()
+                outputs, pending = gate.plan(tiles)
+                gate_time[j] += time.time() - t0
+                for k in pending:
+                    outputs[k] = predictions[k]
+                gated = stitch(gate.finish(outputs), coords, img_pad.shape[:2], img.shape[:2], patch_size)
+                agreement[j].add_batch(pre_image=gated, gt_image=reference)
+                if has_labels:
+                    accuracy[j + 1].add_batch(pre_image=gated, gt_image=gt)
+
+    num_tiles = max(gates[0].num_tiles, 1)
+    print('{} tiles, model: {:.3f} s/tile, method {}'.format(num_tiles, model_time / num_tiles, args.method))
+    print('threshold  skipped  est. speedup  pixel agreement  mIoU drift')
+    for j, (threshold, gate) in enumerate(zip(thresholds, gates)):
+        cost = (1 - gate.skip_rate()) * model_time + gate_time[j]
+        drift = '-'
+        if has_labels:
+            drift = '{:+.4f}'.format(np.nanmean(accuracy[j + 1].Intersection_over_Union()) -
+                                    np.nanmean(accuracy[0].Intersection_over_Union()))
+        print('{:9.4f}  {:7.1%}  {:11.2f}x  {:15.2%}  {}'.format(
+            threshold, gate.skip_rate(), model_time / cost, agreement[j].OA(), drift))
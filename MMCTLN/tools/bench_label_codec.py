@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.label_codec import PALETTES, label2rgb, rgb2label
+
+
+# the per-class np.all passes the scripts used before tools/label_codec.py
+def label2rgb_loop(mask, palette):
+    mask_rgb = np.zeros(shape=(mask.shape[0], mask.shape[1], 3), dtype=np.uint8)
+    mask_convert = mask[np.newaxis, :, :]
+    for label, color in enumerate(palette):
+        mask_rgb[np.all(mask_convert == label, axis=0)] = color
+    return mask_rgb
+
+
+def rgb2label_loop(mask_rgb, palette):
+    label_seg = np.zeros(mask_rgb.shape[:2], dtype=np.uint8)
+    for label, color in enumerate(palette):
+        label_seg[np.all(mask_rgb == np.array(color), axis=-1)] = label
+    return label_seg
+
+
+def timeit(fn, *args, **kwargs):
+    t0 = time.time()
+    out = fn(*args, **kwargs)
+    return out, time.time() - t0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=6000)
+    parser.add_argument("--dataset", default="pv", choices=list(PALETTES))
+    parser.add_argument("--threads", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    palette = PALETTES[args.dataset]
+    mask = np.random.RandomState(42).randint(0, len(palette), (args.size, args.size)).astype(np.uint8)
+    # warm the lookup tables so the timings only cover the conversion itself
+    rgb2label(label2rgb(mask[:8, :8], palette), palette)
+
+    rgb_ref, t_loop = timeit(label2rgb_loop, mask, palette)
+    rgb, t_lut = timeit(label2rgb, mask, palette, num_threads=args.threads)
+    assert np.array_equal(rgb, rgb_ref)
+    print('label2rgb {}x{}: np.all {:.3f} s, lut {:.3f} s ({:.1f}x)'.format(
+        args.size, args.size, t_loop, t_lut, t_loop / t_lut))
+
+    label_ref, t_loop = timeit(rgb2label_loop, rgb, palette)
+    label, t_lut = timeit(rgb2label, rgb, palette, num_threads=args.threads)
+    assert np.array_equal(label, label_ref)
+    print('rgb2label {}x{}: np.all {:.3f} s, lut {:.3f} s ({:.1f}x)'.format(
+        args.size, args.size, t_loop, t_lut, t_loop / t_lut))
@@ -0,0 +1,68 @@
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.label_codec import OUTPUT_MODES, PALETTES, rgb2label, write_mask
+
+
+# write throughput and disk usage of the write_mask output modes, on a folder of predicted
+# masks (e.g. the -o folder of vaihingen_test.py / potsdam_test.py) or on synthetic masks
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--mask_path", default=None, help="folder of label or rgb masks")
+    parser.add_argument("-d", "--dataset", default="pv", choices=list(PALETTES))
+    parser.add_argument("--bgr", action='store_true', help="masks were written with label2rgb(bgr=True)")
+    parser.add_argument("--synthetic", type=int, default=20, help="number of synthetic masks when -i is not given")
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--ext", default=".png", choices=[".png", ".tif"])
+    return parser.parse_args()
+
+
+def load_masks(args):
+    palette = PALETTES[args.dataset]
+    if args.mask_path is None:
+        rng = np.random.RandomState(42)
+        masks = []
+        for _ in range(args.synthetic):
+            # blocky masks compress like real predictions, uniform noise would not
+            coarse = rng.randint(0, len(palette), (args.size // 32, args.size // 32)).astype(np.uint8)
+            masks.append(cv2.resize(coarse, (args.size, args.size), interpolation=cv2.INTER_NEAREST))
+        return masks
+    masks = []
+    for path in sorted(glob.glob(os.path.join(args.mask_path, '*'))):
+        mask = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if mask is None:
+            continue
+        if mask.ndim == 3:
+            mask = rgb2label(mask[..., ::-1] if args.bgr else mask, palette)
+        masks.append(mask)
+    return masks
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    masks = load_masks(args)
+    megapixels = sum(m.size for m in masks) / 1e6
+    print('{} masks, {:.1f} MP'.format(len(masks), megapixels))
+    print('mode       MP/s    MB on disk  vs rgb')
+    rgb_bytes = None
+    for mode in OUTPUT_MODES:
+        out_dir = tempfile.mkdtemp()
+        try:
+            t0 = time.time()
+            for k, mask in enumerate(masks):
+                write_mask(os.path.join(out_dir, '{}{}'.format(k, args.ext)), mask, PALETTES[args.dataset],
+                           mode=mode, bgr=args.bgr)
+            elapsed = time.time() - t0
+            size = sum(os.path.getsize(os.path.join(out_dir, f)) for f in os.listdir(out_dir))
+        finally:
+            shutil.rmtree(out_dir)
+        rgb_bytes = rgb_bytes or size
+        print('{:8s} {:7.1f} {:10.2f} {:7.2%}'.format(mode, megapixels / elapsed, size / 2 ** 20, size / rgb_bytes))
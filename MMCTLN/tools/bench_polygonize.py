@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.polygonize import polygonize
+
+
+# worker sweep of polygonize() on a synthetic scene; every run is checked for one polygon per
+# 4-connected region and polygon areas (shoelace, holes subtracted) equal to the pixel counts
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=8192, help="scene side in pixels")
+    parser.add_argument("--num-classes", type=int, default=6)
+    parser.add_argument("--block", type=int, default=24, help="mean object size in pixels")
+    parser.add_argument("--band-rows", type=int, default=512)
+    parser.add_argument("--workers", default="1,2,4,8", help="worker counts to compare")
+    return parser.parse_args()
+
+
+def synthetic_scene(size, num_classes, block):
+    rng = np.random.RandomState(42)
+    coarse = rng.randint(0, num_classes, (size // block + 1, size // block + 1)).astype(np.uint8)
+    # smooth, irregular borders like real predictions, with holes and islands
+    mask = cv2.resize(coarse, (size, size), interpolation=cv2.INTER_LINEAR)
+    noise = rng.randint(0, num_classes, (size // 4, size // 4)).astype(np.uint8)
+    noise = cv2.resize(noise, (size, size), interpolation=cv2.INTER_NEAREST)
+    return np.where(rng.rand(size // 4, size // 4).repeat(4, 0).repeat(4, 1) < 0.05, noise, mask)
+
+
+def ring_area(ring):
+    ring = np.asarray(ring, dtype=np.float64)
+    return 0.5 * abs(np.dot(ring[:-1, 0], ring[1:, 1]) - np.dot(ring[1:, 0], ring[:-1, 1]))
+
+
+def check(path, mask, num_features):
+    areas = np.zeros(256)
+    with open(path) as f:
+        for line in f:
+            feature = json.loads(line)
+            rings = feature['geometry']['coordinates']
+            area = ring_area(rings[0]) - sum(ring_area(r) for r in rings[1:])
+            assert area == feature['properties']['area']
+            areas[feature['properties']['class']] += area
+    num_regions = sum(cv2.connectedComponents((mask == c).astype(np.uint8), connectivity=4)[0] - 1
+                      for c in np.unique(mask))
+    assert num_features == num_regions, (num_features, num_regions)
+    assert (areas == np.bincount(mask.ravel(), minlength=256)).all()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    mask = synthetic_scene(args.size, args.num_classes, args.block)
+    megapixels = mask.size / 1e6
+    print('scene {0}x{0} ({1:.1f} MP), band rows {2}'.format(args.size, megapixels, args.band_rows))
+    print('workers  seconds   MP/s   features/s')
+    path = os.path.join(tempfile.mkdtemp(), 'scene.geojsonl')
+    for workers in [int(w) for w in args.workers.split(',')]:
+        t0 = time.time()
+        with open(path, 'w') as f:
+            num_features = polygonize(mask, f, band_rows=args.band_rows, num_workers=workers)
+        elapsed = time.time() - t0
+        print('{:7d}  {:7.2f}  {:5.2f}  {:11.0f}'.format(workers, elapsed, megapixels / elapsed,
+                                                        num_features / elapsed))
+        check(path, mask, num_features)
+    print('{} polygons, {:.1f} MB of GeoJSON, areas match pixel counts'.format(num_features, os.path.getsize(path) / 2 ** 20))
+    os.remove(path)
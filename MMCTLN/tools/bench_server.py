@@ -0,0 +1,76 @@
+import argparse
+import http.client
+import json
+import socket
+import threading
+import time
+import cv2
+import numpy as np
+
+
+# load generator for inference_server.py: closed-loop clients posting synthetic tiles
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", default=None)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="total number of requests")
+    parser.add_argument("--tile-size", type=int, default=512)
+    return parser.parse_args()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def connect(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket)
+    return http.client.HTTPConnection(args.host, args.port)
+
+
+def client(args, body, num_requests, latencies):
+    conn = connect(args)
+    for _ in range(num_requests):
+        t0 = time.time()
+        conn.request('POST', '/predict', body=body, headers={'Content-Type': 'image/png'})
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError('server answered {}'.format(response.status))
+        latencies.append(time.time() - t0)
+    conn.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    tile = np.random.RandomState(42).randint(0, 256, (args.tile_size, args.tile_size, 3), dtype=np.uint8)
+    body = cv2.imencode('.png', tile)[1].tobytes()
+    per_client = [args.requests // args.concurrency + (i < args.requests % args.concurrency)
+                  for i in range(args.concurrency)]
+
+    latencies = []
+    threads = [threading.Thread(target=client, args=(args, body, n, latencies)) for n in per_client]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+
+    latencies = np.array(latencies) * 1000
+    print('requests: {}, concurrency: {}'.format(len(latencies), args.concurrency))
+    print('latency p50: {:.1f} ms, p99: {:.1f} ms'.format(np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    print('throughput: {:.2f} req/s, {:.3f} MP/s'.format(
+        len(latencies) / elapsed, len(latencies) * args.tile_size ** 2 / 1e6 / elapsed))
+
+    conn = connect(args)
+    conn.request('GET', '/stats')
+    print('server: {}'.format(json.loads(conn.getresponse().read())))
@@ -0,0 +1,93 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from pathlib import Path
+import albumentations as albu
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.cfg import py2cfg
+from tools.cpu_pool import tile_coords
+from tools.label_codec import PALETTES, rgb2label
+from tools.metric import Evaluator
+from tools.temporal import KeyframeFeatureCache
+from inference_uavid import get_img_padded, load_model
+
+
+# keyframe feature reuse on the UAVid val split (seq*/Images + seq*/Labels): model time and
+# mIoU for a range of keyframe intervals, interval 1 runs the whole backbone on every frame
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--image_path", type=Path, default='data/uavid/uavid_val')
+    parser.add_argument("-c", "--config_path", type=Path, required=True)
+    parser.add_argument("-ph", "--patch-height", type=int, default=1152)
+    parser.add_argument("-pw", "--patch-width", type=int, default=1024)
+    parser.add_argument("-b", "--batch-size", type=int, default=2)
+    parser.add_argument("--intervals", default="1,2,3,5,10")
+    parser.add_argument("--reuse-stages", type=int, default=2, choices=[1, 2, 3])
+    parser.add_argument("--drift", type=float, default=None, help="--keyframe-drift of inference_uavid.py")
+    return parser.parse_args()
+
+
+def load_frame(img_path, patch_size):
+    normalize = albu.Normalize()
+    img = cv2.cvtColor(cv2.imread(img_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    img_pad, _, _ = get_img_padded(img, patch_size)
+    coords = tile_coords(img_pad.shape[0], img_pad.shape[1], patch_size)
+    tiles = [normalize(image=img_pad[m:m + patch_size[0], n:n + patch_size[1]])['image'] for (m, n) in coords]
+    return torch.from_numpy(np.stack(tiles)).permute(0, 3, 1, 2).float(), coords, img_pad.shape[:2], img.shape[:2]
+
+
+def run_sequence(model, img_paths, patch_size, batch_size, device, evaluator):
+    model.start_sequence()
+    elapsed = 0.0
+    for img_path in img_paths:
+        tiles, coords, pad_shape, shape = load_frame(img_path, patch_size)
+        model.start_frame()
+        labels = []
+        with torch.no_grad():
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            t0 = time.time()
+            for i in range(0, len(tiles), batch_size):
+                labels.append(model(tiles[i:i + batch_size].to(device)).argmax(dim=1).cpu())
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed += time.time() - t0
+        labels = torch.cat(labels).numpy()
+        mask = np.zeros(pad_shape, dtype=np.uint8)
+        for (m, n), label in zip(coords, labels):
+            mask[m:m + patch_size[0], n:n + patch_size[1]] = label
+        gt_path = img_path.replace(os.sep + 'Images' + os.sep, os.sep + 'Labels' + os.sep)
+        gt = rgb2label(cv2.cvtColor(cv2.imread(gt_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB), PALETTES['uavid'])
+        evaluator.add_batch(pre_image=mask[-shape[0]:, -shape[1]:], gt_image=gt)
+    return elapsed
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = py2cfg(args.config_path)
+    device = torch.device('cuda:{}'.format(config.gpus[0]) if torch.cuda.is_available() else 'cpu')
+    base = load_model(config, on_cpu=device.type == 'cpu')
+    patch_size = (args.patch_height, args.patch_width)
+    sequences = [sorted(glob.glob(os.path.join(args.image_path, seq, 'Images', '*.png')))
+                 for seq in sorted(os.listdir(args.image_path))]
+    sequences = [s for s in sequences if s]
+    print('{} sequences, {} frames'.format(len(sequences), sum(len(s) for s in sequences)))
+
+    with torch.no_grad():
+        base(load_frame(sequences[0][0], patch_size)[0][:args.batch_size].to(device))
+    print('interval  model s  speedup  mIoU   reused')
+    baseline = None
+    for interval in [int(k) for k in args.intervals.split(',')]:
+        model = KeyframeFeatureCache(base, interval, reuse_stages=args.reuse_stages, drift_threshold=args.drift)
+        evaluator = Evaluator(num_class=config.num_classes)
+        elapsed = sum(run_sequence(model, s, patch_size, args.batch_size, device, evaluator) for s in sequences)
+        baseline = baseline or elapsed
+        print('{:8d}  {:7.1f}  {:6.2f}x  {:.4f}  {:.1%}'.format(
+            interval, elapsed, baseline / elapsed, np.nanmean(evaluator.Intersection_over_Union()),
+            model.num_reused / max(model.num_tiles, 1)))
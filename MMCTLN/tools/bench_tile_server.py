@@ -0,0 +1,62 @@
+import argparse
+import http.client
+import json
+import threading
+import time
+import numpy as np
+
+
+# panning load for tile_server.py: every client walks a viewport of tiles across the deepest zoom
+# level, so later views overlap earlier ones and the neighbours the server prefetched
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--clients", type=int, default=2)
+    parser.add_argument("--views", type=int, default=30, help="viewports requested per client")
+    parser.add_argument("--viewport", default="4x3", help="tiles per view, WxH")
+    return parser.parse_args()
+
+
+def get(conn, path):
+    conn.request('GET', path)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def client(args, seed, max_zoom, latencies):
+    rng = np.random.RandomState(seed)
+    vw, vh = [int(v) for v in args.viewport.split('x')]
+    conn = http.client.HTTPConnection(args.host, args.port)
+    x, y = 0, 0
+    for _ in range(args.views):
+        for ty in range(y, y + vh):
+            for tx in range(x, x + vw):
+                t0 = time.time()
+                status, _ = get(conn, '/tiles/{}/{}/{}.png'.format(max_zoom, tx, ty))
+                if status == 200:
+                    latencies.append(time.time() - t0)
+        # pan by one tile, mostly forward
+        dx, dy = [(1, 0), (0, 1), (-1, 0), (0, -1)][rng.choice(4, p=[0.4, 0.3, 0.15, 0.15])]
+        x, y = max(0, x + dx), max(0, y + dy)
+    conn.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = http.client.HTTPConnection(args.host, args.port)
+    max_zoom = json.loads(get(conn, '/stats')[1])['max_zoom']
+    latencies = []
+    threads = [threading.Thread(target=client, args=(args, seed, max_zoom, latencies)) for seed in range(args.clients)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+
+    latencies = np.array(latencies) * 1000
+    print('tiles: {}, clients: {}, {:.1f} tiles/s'.format(len(latencies), args.clients, len(latencies) / elapsed))
+    print('latency p50: {:.1f} ms, p99: {:.1f} ms'.format(np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    stats = json.loads(get(conn, '/stats')[1])
+    print('server: hit rate {:.1%}, {}'.format(stats['hit_rate'], stats))
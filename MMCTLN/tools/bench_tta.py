@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import argparse
+import ttach as tta
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mmctln_main.models.MMCTLN import mmctln_base, mmctln_small, mmctln_tiny
+from tools.tta import TTAEngine, geometry_product
+
+ARCHS = {'tiny': mmctln_tiny, 'small': mmctln_small, 'base': mmctln_base}
+
+# (ttach transforms, TTAEngine kwargs) for the modes of inference_huge_image.py
+PRESETS = {
+    'lr': (lambda: tta.Compose([tta.HorizontalFlip(), tta.VerticalFlip()]),
+           dict(geometries=geometry_product(hflip=True, vflip=True))),
+    'd4': (lambda: tta.Compose([tta.HorizontalFlip(), tta.Scale(scales=[0.75, 1, 1.25, 1.5, 1.75])]),
+           dict(geometries=geometry_product(hflip=True), scales=[0.75, 1, 1.25, 1.5, 1.75])),
+}
+
+
+# TTAEngine against ttach.SegmentationTTAWrapper on random tiles, weights are random
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", default="tiny", choices=list(ARCHS))
+    parser.add_argument("--mode", default="lr", choices=list(PRESETS))
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--budget-mb", type=float, default=None)
+    return parser.parse_args()
+
+
+def run(model, x, iters):
+    with torch.no_grad():
+        output = model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        t0 = time.time()
+        for _ in range(iters):
+            output = model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if x.is_cuda else float('nan')
+    return output, (time.time() - t0) / iters, peak
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = ARCHS[args.arch](pretrained=False).to(device).eval()
+    x = torch.randn(args.batch_size, 3, args.tile_size, args.tile_size, device=device)
+    transforms, kwargs = PRESETS[args.mode]
+
+    reference, t_ttach, m_ttach = run(tta.SegmentationTTAWrapper(model, transforms()), x, args.iters)
+    output, t_engine, m_engine = run(TTAEngine(model, memory_budget_mb=args.budget_mb, **kwargs), x, args.iters)
+
+    print('mode {}, {} tiles of {}px on {}'.format(args.mode, args.batch_size, args.tile_size, device))
+    print('ttach:      {:.3f} s/batch, peak {:.0f} MB'.format(t_ttach, m_ttach))
+    print('TTAEngine:  {:.3f} s/batch, peak {:.0f} MB ({:.2f}x)'.format(t_engine, m_engine, t_ttach / t_engine))
+    print('max |logit diff|: {:.2e}, label agreement: {:.4%}'.format(
+        (output - reference).abs().max().item(), (output.argmax(1) == reference.argmax(1)).float().mean().item()))
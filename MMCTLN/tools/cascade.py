@@ -0,0 +1,76 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from tools.tta import pixel_uncertainty
+
+
+class CascadeModel(nn.Module):
+    """Small model on every tile, large model only where the small one is unsure.
+
+    With `window=None` a whole tile is escalated when its mean uncertainty exceeds `threshold`.
+    Otherwise the tile is split into `window` x `window` cells; every uncertain cell is re-predicted
+    from a crop of `window + 2 * context` pixels (shifted to stay inside the tile) and only the
+    cell itself is written back, so the large model sees the surroundings of what it replaces.
+    The crop size has to be one the large model accepts.
+    """
+
+    def __init__(self, small, large, threshold, metric='entropy', window=None, context=0, large_batch_size=8):
+        super().__init__()
+        self.small = small
+        self.large = large
+        self.threshold = threshold
+        self.metric = metric
+        self.window = window
+        self.context = context
+        self.large_batch_size = large_batch_size
+        self.total_pixels = 0
+        self.escalated_pixels = 0
+        self.num_escalated = 0
+
+    def forward(self, x):
+        logits = self.small(x)
+        n, _, h, w = x.shape
+        self.total_pixels += n * h * w
+        uncertainty = pixel_uncertainty(logits, self.metric)
+
+        if self.window is None:
+            selected = (uncertainty.flatten(1).mean(dim=1) > self.threshold).nonzero(as_tuple=True)[0]
+            for i in range(0, len(selected), self.large_batch_size):
+                chunk = selected[i:i + self.large_batch_size]
+                logits[chunk] = self.large(x[chunk])
+            self.num_escalated += len(selected)
+            self.escalated_pixels += len(selected) * h * w
+            return logits
+
+        cells = F.avg_pool2d(uncertainty[:, None], self.window, ceil_mode=True)[:, 0] > self.threshold
+        crop_h = min(self.window + 2 * self.context, h)
+        crop_w = min(self.window + 2 * self.context, w)
+        crops, boxes = [], []
+        for b, i, j in cells.nonzero().tolist():
+            y0, x0 = i * self.window, j * self.window
+            y1, x1 = min(y0 + self.window, h), min(x0 + self.window, w)
+            cy = min(max(y0 - self.context, 0), h - crop_h)
+            cx = min(max(x0 - self.context, 0), w - crop_w)
+            crops.append(x[b, :, cy:cy + crop_h, cx:cx + crop_w])
+            boxes.append((b, y0, y1, x0, x1, cy, cx))
+            self.escalated_pixels += (y1 - y0) * (x1 - x0)
+        for i in range(0, len(crops), self.large_batch_size):
+            outputs = self.large(torch.stack(crops[i:i + self.large_batch_size]))
+            for output, (b, y0, y1, x0, x1, cy, cx) in zip(outputs, boxes[i:i + self.large_batch_size]):
+                logits[b, :, y0:y1, x0:x1] = output[:, y0 - cy:y1 - cy, x0 - cx:x1 - cx]
+        self.num_escalated += len(crops)
+        return logits
+
+    def reset_stats(self):
+        self.total_pixels = 0
+        self.escalated_pixels = 0
+        self.num_escalated = 0
+
+    @property
+    def escalation_rate(self):
+        return self.escalated_pixels / max(self.total_pixels, 1)
+
+    def summary(self):
+        return 'cascade: {} {} escalated to the large model, {:.1%} of pixels'.format(
+            self.num_escalated, 'tiles' if self.window is None else 'windows', self.escalation_rate)
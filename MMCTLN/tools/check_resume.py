@@ -0,0 +1,114 @@
+import os
+import sys
+import glob
+import time
+import signal
+import filecmp
+import argparse
+import subprocess
+import tempfile
+
+import numpy as np
+
+
+# SIGKILLs an `inference_huge_image.py --resume` run every --kill-after newly finished tiles, restarts it
+# until it completes and byte-compares its outputs with an uninterrupted run of the same arguments:
+#   python MMCTLN/tools/check_resume.py --kill-after 20 --kills 3 -- -i <images> -c <config> -t lr -d pv
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--kill-after", type=int, default=10, help="tiles finished by a run before it is killed")
+    parser.add_argument("--kills", type=int, default=2, help="number of runs killed before one may finish")
+    parser.add_argument("--work-dir", default=None, help="where both outputs go, a temporary folder by default")
+    parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                         'inference_huge_image.py'))
+    parser.add_argument("--poll", type=float, default=0.05, help="seconds between progress checks")
+    parser.add_argument("inference_args", nargs=argparse.REMAINDER,
+                        help="arguments of inference_huge_image.py after --, without -o/--resume")
+    args = parser.parse_args()
+    if args.inference_args[:1] == ['--']:
+        args.inference_args = args.inference_args[1:]
+    return args
+
+
+class TileProgress(object):
+    """Tiles marked done in a --resume output folder. Counts of finished images are kept after
+    their done flags are removed."""
+
+    def __init__(self, output_path):
+        self.pattern = os.path.join(output_path, '.manifest', '*.done.npy')
+        self.counts = {}
+
+    def __call__(self):
+        for path in glob.glob(self.pattern):
+            try:
+                self.counts[path] = max(self.counts.get(path, 0), int(np.load(path, mmap_mode='r').sum()))
+            except (ValueError, OSError):
+                # created but header not written yet, or removed meanwhile
+                pass
+        return sum(self.counts.values())
+
+
+def run(cmd, progress=None, kill_after=None, poll=0.05):
+    """Run `cmd` and return its exit code; SIGKILL it once `progress()` grew by `kill_after`."""
+    proc = subprocess.Popen(cmd)
+    if kill_after is None:
+        return proc.wait()
+    start = progress()
+    while proc.poll() is None:
+        if progress() - start >= kill_after:
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.wait()
+            print('killed after {} tiles'.format(progress() - start))
+            break
+        time.sleep(poll)
+    return proc.returncode
+
+
+def compare_outputs(reference, resumed):
+    """Relative paths of files that differ or exist in only one of the folders, .manifest excluded."""
+    def files(root):
+        found = set()
+        for directory, dirs, names in os.walk(root):
+            dirs[:] = [d for d in dirs if d != '.manifest']
+            found.update(os.path.relpath(os.path.join(directory, name), root) for name in names)
+        return found
+
+    reference_files, resumed_files = files(reference), files(resumed)
+    mismatches = sorted(reference_files ^ resumed_files)
+    for name in sorted(reference_files & resumed_files):
+        if not filecmp.cmp(os.path.join(reference, name), os.path.join(resumed, name), shallow=False):
+            mismatches.append(name)
+    return mismatches, len(reference_files)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='check_resume_')
+    reference, resumed = os.path.join(work_dir, 'reference'), os.path.join(work_dir, 'resumed')
+    base_cmd = [sys.executable, args.script] + args.inference_args
+
+    t0 = time.time()
+    if run(base_cmd + ['-o', reference]) != 0:
+        sys.exit('uninterrupted run failed')
+    print('uninterrupted run spends: {} s'.format(time.time() - t0))
+
+    t0 = time.time()
+    progress = TileProgress(resumed)
+    resume_cmd = base_cmd + ['-o', resumed, '--resume']
+    num_killed = 0
+    while True:
+        kill_after = args.kill_after if num_killed < args.kills else None
+        code = run(resume_cmd, progress, kill_after, args.poll)
+        if code == -signal.SIGKILL and kill_after is not None:
+            num_killed += 1
+            continue
+        if code != 0:
+            sys.exit('resumed run failed with exit code {}'.format(code))
+        break
+    print('{} killed runs, resumed run spends: {} s'.format(num_killed, time.time() - t0))
+
+    mismatches, num_files = compare_outputs(reference, resumed)
+    if mismatches:
+        print('{} of {} outputs differ: {}'.format(len(mismatches), num_files, ', '.join(mismatches)))
+        sys.exit(1)
+    print('all {} outputs are byte-identical ({})'.format(num_files, work_dir))
@@ -0,0 +1,71 @@
+import albumentations as albu
+import cv2
+import numpy as np
+import torch
+
+from tools.cpu_pool import tile_coords
+from tools.tta import pixel_uncertainty
+
+
+def predict_coarse(model, image, scale, patch_size, batch_size=2, device='cpu', metric='entropy', regions=None):
+    """Labels and pixel uncertainty of `image` predicted at `scale`, resized back to the size of `image`,
+    and the number of coarse tiles predicted.
+
+    With `regions` ((y0, x0, y1, x1) boxes of `image`), only the coarse tiles under them are predicted;
+    inside the boxes the result is the same as for the whole image, elsewhere it may be 0.
+    """
+    height, width = image.shape[0], image.shape[1]
+    small = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    ph, pw = patch_size
+    # pad at the top-left like get_img_padded
+    pad_h, pad_w = -small.shape[0] % ph, -small.shape[1] % pw
+    sy, sx = small.shape[0] / height, small.shape[1] / width
+    small = np.pad(small, ((pad_h, 0), (pad_w, 0), (0, 0)))
+    labels = np.zeros(small.shape[:2], dtype=np.uint8)
+    uncertainty = np.zeros(small.shape[:2], dtype=np.float32)
+
+    coords = tile_coords(small.shape[0], small.shape[1], patch_size)
+    if regions is not None:
+        needed = np.zeros((small.shape[0] // ph, small.shape[1] // pw), dtype=bool)
+        for y0, x0, y1, x1 in regions:
+            # one coarse pixel of slack each side for the interpolation back to full size
+            m0 = max(0, int(np.floor(y0 * sy)) - 1 + pad_h) // ph
+            m1 = min(small.shape[0] - 1, int(np.ceil(y1 * sy)) + pad_h) // ph
+            n0 = max(0, int(np.floor(x0 * sx)) - 1 + pad_w) // pw
+            n1 = min(small.shape[1] - 1, int(np.ceil(x1 * sx)) + pad_w) // pw
+            needed[m0:m1 + 1, n0:n1 + 1] = True
+        coords = [(m, n) for (m, n) in coords if needed[m // ph, n // pw]]
+
+    normalize = albu.Normalize()
+    with torch.no_grad():
+        for i in range(0, len(coords), batch_size):
+            batch = coords[i:i + batch_size]
+            x = np.stack([normalize(image=small[m:m + ph, n:n + pw])['image'] for (m, n) in batch])
+            logits = model(torch.from_numpy(x).permute(0, 3, 1, 2).float().to(device))
+            batch_labels = logits.argmax(dim=1).to(torch.uint8).cpu().numpy()
+            batch_uncertainty = pixel_uncertainty(logits, metric).cpu().numpy()
+            for j, (m, n) in enumerate(batch):
+                labels[m:m + ph, n:n + pw] = batch_labels[j]
+                uncertainty[m:m + ph, n:n + pw] = batch_uncertainty[j]
+
+    labels, uncertainty = labels[pad_h:, pad_w:], uncertainty[pad_h:, pad_w:]
+    return (cv2.resize(labels, (width, height), interpolation=cv2.INTER_NEAREST),
+            cv2.resize(uncertainty, (width, height), interpolation=cv2.INTER_LINEAR), len(coords))
+
+
+def refine_zone(labels, uncertainty, threshold, margin=0, valid=None):
+    """Pixels that need a full-resolution prediction: class boundaries grown by `margin`,
+    plus pixels whose uncertainty exceeds `threshold`, restricted to `valid`."""
+    edges = np.zeros(labels.shape, dtype=np.uint8)
+    vertical = labels[1:] != labels[:-1]
+    horizontal = labels[:, 1:] != labels[:, :-1]
+    edges[1:] |= vertical
+    edges[:-1] |= vertical
+    edges[:, 1:] |= horizontal
+    edges[:, :-1] |= horizontal
+    if margin > 0:
+        edges = cv2.dilate(edges, np.ones((2 * margin + 1, 2 * margin + 1), dtype=np.uint8))
+    zone = (edges > 0) | (uncertainty > threshold)
+    if valid is not None:
+        zone &= valid
+    return zone
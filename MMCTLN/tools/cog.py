@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# GeoTIFF tags: ModelPixelScale, ModelTiepoint, ModelTransformation, GeoKeyDirectory,
+# GeoDoubleParams, GeoAsciiParams. GDAL_METADATA (band scale/offset) and GDAL_NODATA describe
+# the source pixels, not the labels, so they are not copied.
+GEO_TAGS = (33550, 33922, 34264, 34735, 34736, 34737)
+
+
+def read_geotags(path):
+    """The georeferencing tags of a GeoTIFF as tifffile `extratags`, empty for other files."""
+    if tifffile is None or not str(path).lower().endswith(('.tif', '.tiff')):
+        return []
+    with tifffile.TiffFile(str(path)) as tif:
+        tags = tif.pages[0].tags
+        return [(code, int(tags[code].dtype), tags[code].count, tags[code].value, True)
+                for code in GEO_TAGS if code in tags]
+
+
+def mode_downsample(labels):
+    """Halve a label image, every 2x2 block becomes its most frequent label (top-left on ties)."""
+    if labels.shape[0] % 2 or labels.shape[1] % 2:
+        labels = np.pad(labels, ((0, labels.shape[0] % 2), (0, labels.shape[1] % 2)), mode='edge')
+    blocks = (labels[0::2, 0::2], labels[0::2, 1::2], labels[1::2, 0::2], labels[1::2, 1::2])
+    best, best_count = blocks[0], None
+    for v in blocks:
+        count = sum((v == u).view(np.uint8) for u in blocks)
+        if best_count is None:
+            best_count = count
+            continue
+        better = count > best_count
+        best = np.where(better, v, best)
+        best_count = np.maximum(count, best_count)
+    return best
+
+
+def _band_overviews(band, num_levels):
+    levels = []
+    for _ in range(num_levels):
+        band = mode_downsample(band)
+        levels.append(band)
+    return levels
+
+
+def build_overviews(labels, min_size=512, num_workers=None):
+    """Mode-resampled 1/2, 1/4, ... levels down to `min_size` pixels on the longer side.
+
+    Bands whose height is a multiple of every level's factor are reduced in parallel and
+    concatenated, which gives the same levels as reducing the whole image.
+    """
+    num_levels = 0
+    size = max(labels.shape)
+    while size > min_size:
+        size = (size + 1) // 2
+        num_levels += 1
+    if num_levels == 0:
+        return []
+    factor = 2 ** num_levels
+    band_rows = factor * max(1, 1024 // factor)
+    bands = [labels[y:y + band_rows] for y in range(0, labels.shape[0], band_rows)]
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        results = list(executor.map(lambda band: _band_overviews(band, num_levels), bands))
+    return [np.concatenate([r[k] for r in results]) for k in range(num_levels)]
+
+
+def write_cog(path, labels, colormap=None, geotags=(), tile=512, compression='zlib', num_workers=None):
+    """Write a label image as a tiled, compressed GeoTIFF with internal mode-resampled overviews.
+
+    `colormap` (256x3 uint8 RGB) stores the labels as a palette image, `geotags` come from
+    `read_geotags` of the source raster. Overviews follow the full-resolution image as
+    reduced-resolution pages, as in GDAL's COG layout.
+    """
+    if tifffile is None:
+        raise ImportError('writing COG masks needs tifffile (pip install tifffile)')
+    labels = np.asarray(labels).astype(np.uint8, copy=False)
+    options = dict(tile=(tile, tile), compression=compression, metadata=None, maxworkers=num_workers)
+    if colormap is not None:
+        options.update(photometric='palette', colormap=np.asarray(colormap, dtype=np.uint16).T * 257)
+    else:
+        options.update(photometric='minisblack')
+    overviews = build_overviews(labels, min_size=tile, num_workers=num_workers)
+    with tifffile.TiffWriter(path, bigtiff=labels.nbytes > 2 ** 30) as tif:
+        tif.write(labels, extratags=list(geotags), **options)
+        for level in overviews:
+            tif.write(level, subfiletype=1, **options)
@@ -0,0 +1,92 @@
+import queue
+
+import albumentations as albu
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def tile_coords(height, width, patch_size):
+    return [(y, x) for y in range(0, height, patch_size[0]) for x in range(0, width, patch_size[1])]
+
+
+def _worker_loop(model, num_threads, batch_size, tasks, done):
+    # every worker gets its own intra-op thread budget, otherwise N workers x all cores oversubscribe the node
+    torch.set_num_threads(num_threads)
+    normalize = albu.Normalize()
+    with torch.no_grad():
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            image, output, coords, patch_size = task
+            ph, pw = patch_size
+            image_np = image.numpy()
+            for i in range(0, len(coords), batch_size):
+                batch = coords[i:i + batch_size]
+                tiles = [normalize(image=image_np[y:y + ph, x:x + pw])['image'] for (y, x) in batch]
+                tiles = torch.from_numpy(np.stack(tiles)).permute(0, 3, 1, 2).float()
+                predictions = model(tiles).argmax(dim=1).to(torch.uint8)
+                for (y, x), prediction in zip(batch, predictions):
+                    output[y:y + ph, x:x + pw] = prediction
+            done.put(coords)
+
+
+class CPUWorkerPool(object):
+    """Forked CPU workers sharing one copy of the model weights.
+
+    The padded image and the output mask live in shared memory, so the work queue only
+    carries tile ranges and workers write their predictions in place.
+    """
+
+    def __init__(self, model, num_workers, num_threads=1, batch_size=2, chunk_size=8):
+        self.chunk_size = chunk_size
+        model = model.cpu().eval()
+        model.share_memory()
+        ctx = mp.get_context('fork')
+        self.tasks = ctx.Queue()
+        self.done = ctx.Queue()
+        self.workers = [ctx.Process(target=_worker_loop,
+                                    args=(model, num_threads, batch_size, self.tasks, self.done),
+                                    daemon=True)
+                        for _ in range(num_workers)]
+        for w in self.workers:
+            w.start()
+
+    def predict(self, image_pad, patch_size, coords=None, callback=None):
+        """Predict the tiles at `coords` (all tiles by default).
+
+        `callback(finished_coords, output)` runs in the parent each time a chunk of tiles is written.
+        """
+        height, width = image_pad.shape[0], image_pad.shape[1]
+        image = torch.from_numpy(np.ascontiguousarray(image_pad)).share_memory_()
+        output = torch.zeros((height, width), dtype=torch.uint8).share_memory_()
+        if coords is None:
+            coords = tile_coords(height, width, patch_size)
+        for i in range(0, len(coords), self.chunk_size):
+            self.tasks.put((image, output, coords[i:i + self.chunk_size], patch_size))
+
+        finished = 0
+        while finished < len(coords):
+            try:
+                finished_coords = self.done.get(timeout=1.0)
+            except queue.Empty:
+                if not all(w.is_alive() for w in self.workers):
+                    raise RuntimeError('a CPU inference worker exited unexpectedly')
+                continue
+            finished += len(finished_coords)
+            if callback is not None:
+                callback(finished_coords, output.numpy())
+        return output.numpy()
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for w in self.workers:
+            w.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,248 @@
+import os
+import sys
+import copy
+import glob
+import json
+import time
+import hashlib
+import argparse
+import albumentations as albu
+import cv2
+import numpy as np
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mmctln_main.models.MMCTLN import mmctln_base, mmctln_small, mmctln_tiny
+
+ARCHS = {'tiny': mmctln_tiny, 'small': mmctln_small, 'base': mmctln_base}
+
+
+# golden-output regression check for execution modes of MMCTLN: `--record` stores the eager fp32 labels
+# and logit statistics of a fixed tile set, later runs compare every mode in `--modes` against it and
+# exit non-zero when one is outside its tolerances. With `--arch` the weights are seeded random ones, so
+# the golden file is only reproducible on the same torch version; `-c` uses the trained checkpoint
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config_path", default=None, help="config whose checkpoint is checked")
+    parser.add_argument("--arch", default="tiny", choices=list(ARCHS), help="seeded random weights without -c")
+    parser.add_argument("--golden", default="golden.npz")
+    parser.add_argument("--record", action='store_true', help="write the golden reference with the eager mode")
+    parser.add_argument("--modes", default="eager,channels_last,fuse_conv_bn,autocast,int8_dynamic,compile")
+    parser.add_argument("--samples", default=None, help="folder of sample images, center crops are added")
+    parser.add_argument("--num-samples", type=int, default=4)
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=3, help="timed passes over the tile set")
+    parser.add_argument("--min-agreement", default="0.999,autocast:0.99,int8_dynamic:0.98",
+                        help="pixel label agreement with the golden labels, per mode as mode:value")
+    parser.add_argument("--min-class-agreement", default="0.99,autocast:0.95,int8_dynamic:0.9",
+                        help="agreement on the pixels of each golden class (classes with >= 0.1%% of pixels)")
+    parser.add_argument("--logit-tol", default="1e-3,autocast:0.05,int8_dynamic:0.1",
+                        help="largest difference of per-class logit mean/std, relative to the golden logit std")
+    parser.add_argument("--allow-skip", action='store_true',
+                        help="do not fail when a mode cannot be built or run here (e.g. compile on torch < 2.0)")
+    return parser.parse_args()
+
+
+def parse_tolerance(value):
+    """'0.999,int8_dynamic:0.98' -> {None: 0.999, 'int8_dynamic': 0.98}"""
+    tolerance = {}
+    for item in value.split(','):
+        mode, _, number = item.rpartition(':')
+        tolerance[mode or None] = float(number)
+    return tolerance
+
+
+def synthetic_tiles(size, seed=0):
+    """Named uint8 RGB tiles covering flat, periodic, smooth and noisy content."""
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    tiles = {
+        'gray': np.full((size, size, 3), 128, dtype=np.uint8),
+        'noise': rng.randint(0, 256, (size, size, 3)).astype(np.uint8),
+        'blobs': cv2.GaussianBlur(rng.randint(0, 256, (size, size, 3)).astype(np.uint8), (0, 0), size / 32),
+        'gradient': np.stack([xx * 255 // size, yy * 255 // size, (xx + yy) * 255 // (2 * size)],
+                             axis=2).astype(np.uint8),
+        'stripes': np.repeat((((xx // 16) % 2) * 255).astype(np.uint8)[..., None], 3, axis=2),
+        'checker': np.repeat(((((xx // 64) + (yy // 64)) % 2) * 200 + 30).astype(np.uint8)[..., None], 3, axis=2),
+    }
+    rects = np.full((size, size, 3), 90, dtype=np.uint8)
+    for _ in range(24):
+        y, x = rng.randint(0, size, 2)
+        h, w = rng.randint(size // 16, size // 4, 2)
+        rects[y:y + h, x:x + w] = rng.randint(0, 256, 3)
+    tiles['rectangles'] = rects
+    return tiles
+
+
+def sample_tiles(folder, size, num_samples):
+    tiles = {}
+    paths = sorted(p for ext in ('*.tif', '*.png', '*.jpg') for p in glob.glob(os.path.join(folder, ext)))
+    for path in paths[:num_samples]:
+        img = cv2.cvtColor(cv2.imread(path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        img = albu.PadIfNeeded(min_height=size, min_width=size, border_mode=0)(image=img)['image']
+        y, x = (img.shape[0] - size) // 2, (img.shape[1] - size) // 2
+        tiles[os.path.basename(path)] = img[y:y + size, x:x + size]
+    return tiles
+
+
+def fuse_conv_bn(model):
+    """Fold every BatchNorm2d that directly follows a Conv2d inside an nn.Sequential into the conv."""
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules)
+        for a, b in zip(names, names[1:]):
+            conv, bn = module._modules[a], module._modules[b]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module._modules[a] = torch.nn.utils.fusion.fuse_conv_bn_eval(conv, bn)
+                module._modules[b] = nn.Identity()
+    return model
+
+
+def build_mode(name, model, device):
+    """(forward, note) of an execution mode, forward takes and returns NCHW float tensors."""
+    if name == 'eager':
+        return model, ''
+    if name == 'channels_last':
+        variant = copy.deepcopy(model).to(memory_format=torch.channels_last)
+        return lambda x: variant(x.contiguous(memory_format=torch.channels_last)), ''
+    if name == 'fuse_conv_bn':
+        return fuse_conv_bn(copy.deepcopy(model)), ''
+    if name == 'autocast':
+        dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+        def forward(x):
+            with torch.autocast(device_type=device.type, dtype=dtype):
+                return model(x).float()
+        return forward, str(dtype).replace('torch.', '')
+    if name == 'int8_dynamic':
+        if device.type != 'cpu':
+            raise RuntimeError('dynamic quantization runs on CPU only')
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8), ''
+    if name == 'compile':
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError('needs torch >= 2.0')
+        return torch.compile(copy.deepcopy(model)), ''
+    raise ValueError('unknown mode {}'.format(name))
+
+
+def run_mode(forward, x, batch_size, iters, device):
+    """Logits of every tile (first pass, also the warm-up) and the median seconds per tile."""
+    with torch.no_grad():
+        logits = torch.cat([forward(x[i:i + batch_size].to(device)).float().cpu()
+                            for i in range(0, len(x), batch_size)])
+        times = []
+        for _ in range(iters):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            t0 = time.time()
+            for i in range(0, len(x), batch_size):
+                forward(x[i:i + batch_size].to(device))
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append((time.time() - t0) / len(x))
+    return logits, float(np.median(times)) if times else float('nan')
+
+
+def summarize(logits):
+    labels = logits.argmax(dim=1).numpy().astype(np.uint8)
+    flat = logits.transpose(0, 1).reshape(logits.shape[1], len(logits), -1)
+    return dict(labels=labels,
+                checksums=[hashlib.sha1(label.tobytes()).hexdigest() for label in labels],
+                logit_mean=flat.mean(dim=2).T.numpy(), logit_std=flat.std(dim=2).T.numpy(),
+                logit_min=flat.min(dim=2).values.T.numpy(), logit_max=flat.max(dim=2).values.T.numpy())
+
+
+def compare(result, golden, num_classes):
+    labels, reference = result['labels'], golden['labels']
+    class_agreement = []
+    for c in range(num_classes):
+        selected = reference == c
+        if selected.mean() >= 1e-3:
+            class_agreement.append(float((labels[selected] == c).mean()))
+    scale = np.maximum(golden['logit_std'], 1e-6)
+    drift = max(np.abs(result['logit_mean'] - golden['logit_mean']).max() / scale.max(),
+                (np.abs(result['logit_std'] - golden['logit_std']) / scale).max())
+    return dict(identical=sum(a == b for a, b in zip(result['checksums'], golden['checksums'])),
+                agreement=float((labels == reference).mean()),
+                class_agreement=min(class_agreement) if class_agreement else 1.0,
+                logit_drift=float(drift))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.config_path is not None:
+        from tools.cfg import py2cfg
+        from inference_huge_image import load_model
+        config = py2cfg(args.config_path)
+        # only the net runs at inference, the lightning module also holds the (unpicklable) config
+        model = load_model(config, on_cpu=device.type == 'cpu').net
+        name = '{}:{}'.format(args.config_path, config.test_weights_name)
+    else:
+        torch.manual_seed(0)
+        model = ARCHS[args.arch](pretrained=False).to(device).eval()
+        name = 'random:{}'.format(args.arch)
+
+    tiles = synthetic_tiles(args.tile_size)
+    if args.samples is not None:
+        tiles.update(sample_tiles(args.samples, args.tile_size, args.num_samples))
+    normalize = albu.Normalize()
+    x = torch.from_numpy(np.stack([normalize(image=t)['image'] for t in tiles.values()])).permute(0, 3, 1, 2).float()
+
+    if args.record:
+        logits, latency = run_mode(model, x, args.batch_size, args.iters, device)
+        golden = summarize(logits)
+        meta = dict(model=name, tiles=list(tiles), tile_size=args.tile_size, torch=torch.__version__,
+                    device=str(device), latency=latency, checksums=golden.pop('checksums'))
+        np.savez_compressed(args.golden, meta=json.dumps(meta), **golden)
+        print('recorded {} tiles of {} to {}, eager {:.1f} ms/tile'.format(len(tiles), name, args.golden,
+                                                                          latency * 1000))
+        sys.exit(0)
+
+    data = np.load(args.golden)
+    meta = json.loads(str(data['meta']))
+    if meta['model'] != name or meta['tiles'] != list(tiles) or meta['tile_size'] != args.tile_size:
+        sys.exit('{} was recorded for {} on tiles {} of {}px, record it again'.format(
+            args.golden, meta['model'], meta['tiles'], meta['tile_size']))
+    golden = {k: data[k] for k in data.files if k != 'meta'}
+    golden['checksums'] = meta['checksums']
+    tolerances = [parse_tolerance(args.min_agreement), parse_tolerance(args.min_class_agreement),
+                  parse_tolerance(args.logit_tol)]
+
+    print('{} tiles of {}px, {} on {}, golden recorded with torch {} on {}'.format(
+        len(tiles), args.tile_size, name, device, meta['torch'], meta['device']))
+    print('mode           ms/tile  speedup  identical  agreement  min class  logit drift  result')
+    failed, skipped = [], []
+    # speedups are relative to eager, which is timed even when it is not in --modes
+    eager_logits, baseline = run_mode(model, x, args.batch_size, args.iters, device)
+    for mode in args.modes.split(','):
+        if mode == 'eager':
+            logits, latency, note = eager_logits, baseline, ''
+        else:
+            try:
+                forward, note = build_mode(mode, model, device)
+                logits, latency = run_mode(forward, x, args.batch_size, args.iters, device)
+            except Exception as e:
+                print('{:13s}  skipped: {}'.format(mode, str(e).splitlines()[0] if str(e) else type(e).__name__))
+                skipped.append(mode)
+                continue
+        result = compare(summarize(logits), golden, logits.shape[1])
+        limits = [t.get(mode, t[None]) for t in tolerances]
+        ok = result['agreement'] >= limits[0] and result['class_agreement'] >= limits[1] and \
+            result['logit_drift'] <= limits[2]
+        if not ok:
+            failed.append(mode)
+        print('{:13s}  {:7.1f}  {:6.2f}x  {:9s}  {:9.4%}  {:9.4%}  {:11.2e}  {}{}'.format(
+            mode, latency * 1000, baseline / latency, '{}/{}'.format(result['identical'], len(tiles)),
+            result['agreement'], result['class_agreement'], result['logit_drift'], 'PASS' if ok else 'FAIL',
+            ' ({})'.format(note) if note else ''))
+    errors = []
+    if failed:
+        errors.append('outside tolerances: {}'.format(', '.join(failed)))
+    if skipped and not args.allow_skip:
+        errors.append('could not run: {} (--allow-skip to ignore)'.format(', '.join(skipped)))
+    if errors:
+        sys.exit('; '.join(errors))
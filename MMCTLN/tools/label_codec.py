@@ -0,0 +1,153 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from tools.cog import write_cog
+
+# colors as written by the inference scripts, index = label
+PALETTES = {
+    'pv': [[255, 255, 255], [255, 0, 0], [255, 255, 0], [0, 255, 0], [0, 204, 255], [0, 0, 255]],
+    'landcoverai': [[233, 193, 133], [255, 0, 0], [0, 255, 0], [255, 255, 255]],
+    'uavid': [[128, 0, 0], [128, 64, 128], [0, 128, 0], [128, 128, 0],
+              [64, 0, 128], [192, 0, 192], [64, 64, 0], [0, 0, 0]],
+    'building': [[255, 255, 255], [0, 0, 0]],
+    'loveda': [[255, 255, 255], [255, 0, 0], [255, 255, 0], [0, 0, 255],
+               [159, 129, 183], [0, 255, 0], [255, 195, 128]],
+}
+
+# ground-truth colors as stored in the datasets' mask files (RGB), index = label; labels beyond the
+# model's classes (the ISPRS eroded-boundary black) are ignored by the evaluators. These are the
+# patch_split MASK_PALETTE constants, which are matched against BGR arrays.
+GT_PALETTES = {
+    'pv': [[255, 255, 255], [0, 0, 255], [0, 255, 255], [0, 255, 0], [255, 255, 0], [255, 0, 0], [0, 0, 0]],
+    'uavid': PALETTES['uavid'],
+}
+
+# how write_mask stores a prediction
+OUTPUT_MODES = ('rgb', 'palette', 'label', 'cog')
+
+# below this many pixels the thread pool costs more than it saves
+MIN_PIXELS_PER_THREAD = 1 << 20
+
+
+def _palette_items(palette):
+    if isinstance(palette, dict):
+        return tuple((int(k), tuple(int(c) for c in v)) for k, v in palette.items())
+    return tuple((k, tuple(int(c) for c in v)) for k, v in enumerate(palette))
+
+
+@lru_cache(maxsize=None)
+def _color_lut(items, bgr):
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    for label, color in items:
+        lut[label] = color[::-1] if bgr else color
+    return lut
+
+
+@lru_cache(maxsize=8)
+def _label_lut(items, default):
+    # one byte per packed 24-bit color, 16 MB per palette
+    lut = np.full(1 << 24, default, dtype=np.uint8)
+    for label, (r, g, b) in items:
+        lut[(r << 16) | (g << 8) | b] = label
+    return lut
+
+
+def _run_row_blocks(fn, height, width, num_threads):
+    if num_threads is None:
+        num_threads = min(8, os.cpu_count() or 1)
+    num_threads = max(1, min(num_threads, height * width // MIN_PIXELS_PER_THREAD))
+    if num_threads == 1:
+        fn(0, height)
+        return
+    step = -(-height // num_threads)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(fn, y, min(y + step, height)) for y in range(0, height, step)]
+        for f in futures:
+            f.result()
+
+
+def label2rgb(mask, palette, bgr=False, num_threads=None):
+    """Map an HxW label mask to HxWx3 uint8 colors. Labels missing from the palette become black."""
+    lut = _color_lut(_palette_items(palette), bgr)
+    mask = np.asarray(mask)
+    h, w = mask.shape[0], mask.shape[1]
+    mask_rgb = np.empty((h, w, 3), dtype=np.uint8)
+
+    def convert(y0, y1):
+        np.take(lut, mask[y0:y1], axis=0, out=mask_rgb[y0:y1])
+
+    _run_row_blocks(convert, h, w, num_threads)
+    return mask_rgb
+
+
+def rgb2label(mask_rgb, palette, default=0, num_threads=None):
+    """Map an HxWx3 color mask to HxW uint8 labels. Colors missing from the palette become `default`."""
+    lut = _label_lut(_palette_items(palette), default)
+    mask_rgb = np.asarray(mask_rgb)
+    h, w = mask_rgb.shape[0], mask_rgb.shape[1]
+    label = np.empty((h, w), dtype=np.uint8)
+
+    def convert(y0, y1):
+        block = mask_rgb[y0:y1]
+        key = block[..., 0].astype(np.uint32) << 16
+        key |= block[..., 1].astype(np.uint32) << 8
+        key |= block[..., 2]
+        np.take(lut, key, out=label[y0:y1])
+
+    _run_row_blocks(convert, h, w, num_threads)
+    return label
+
+
+def display_palette(palette, bgr=False):
+    """256x3 RGB colors a viewer shows for each label of a `label2rgb(..., bgr=bgr)` image written by cv2."""
+    return _color_lut(_palette_items(palette), not bgr)
+
+
+def write_palette_sidecar(directory, palette, bgr=False):
+    """Write <directory>/palette.json ({label: [r, g, b]}) once per folder."""
+    path = os.path.join(directory, 'palette.json')
+    if os.path.exists(path):
+        return
+    colors = display_palette(palette, bgr)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({str(label): colors[label].tolist() for label, _ in _palette_items(palette)}, f)
+    os.replace(tmp_path, path)
+
+
+def write_mask(path, mask, palette, mode='rgb', bgr=False, geotags=()):
+    """Write an HxW label mask as 'rgb' (3-channel colors, as before), 'palette' (single-channel
+    PNG/TIFF with the palette embedded, same colors on screen), 'label' (raw uint8 labels plus
+    a palette.json sidecar) or 'cog' (tiled palette GeoTIFF with overviews, always written as
+    .tif, georeferenced by `geotags` from `tools.cog.read_geotags`).
+
+    'palette' and 'label' masks must be lossless, so they keep a .tif/.tiff extension and are
+    written as .png otherwise (a .jpg input gives a .png mask). Returns the path written."""
+    mask = np.asarray(mask).astype(np.uint8, copy=False)
+    if mode in ('palette', 'label') and not path.lower().endswith(('.tif', '.tiff', '.png')):
+        path = os.path.splitext(path)[0] + '.png'
+    elif mode == 'cog':
+        path = os.path.splitext(path)[0] + '.tif'
+    if mode == 'rgb':
+        cv2.imwrite(path, label2rgb(mask, palette, bgr=bgr))
+    elif mode == 'palette':
+        image = Image.fromarray(mask, mode='P')
+        image.putpalette(display_palette(palette, bgr).tobytes())
+        if path.lower().endswith(('.tif', '.tiff')):
+            image.save(path, compression='tiff_lzw')
+        else:
+            image.save(path, compress_level=1)
+    elif mode == 'label':
+        cv2.imwrite(path, mask)
+        write_palette_sidecar(os.path.dirname(path) or '.', palette, bgr)
+    elif mode == 'cog':
+        write_cog(path, mask, display_palette(palette, bgr), geotags=geotags)
+    else:
+        raise ValueError('unknown output mode {}, expected one of {}'.format(mode, OUTPUT_MODES))
+    return path
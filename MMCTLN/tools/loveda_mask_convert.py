@@ -1,5 +1,6 @@
 import glob
 import os
+import sys
 import numpy as np
 import cv2
 import multiprocessing.pool as mpp
@@ -9,6 +10,9 @@ import argparse
 import torch
 import random
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.label_codec import label2rgb
+
 SEED = 42
 
 CLASSES = ('background', 'building', 'road', 'water', 'barren', 'forest',
@@ -42,28 +46,13 @@ def convert_label(mask):
     return mask
 
 
-def label2rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [255, 0, 0]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [255, 255, 0]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [0, 0, 255]
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = [159, 129, 183]
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = [0, 255, 0]
-    mask_rgb[np.all(mask_convert == 6, axis=0)] = [255, 195, 128]
-    return mask_rgb
-
-
 def patch_format(inp):
     (mask_path, masks_output_dir) = inp
     # print(mask_path, masks_output_dir)
     mask_filename = os.path.splitext(os.path.basename(mask_path))[0]
     mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
     label = convert_label(mask)
-    rgb_label = label2rgb(label.copy())
-    rgb_label = cv2.cvtColor(rgb_label, cv2.COLOR_RGB2BGR)
+    rgb_label = label2rgb(label, PALETTE, bgr=True)
     out_mask_path_rgb = os.path.join(masks_output_dir + '_rgb', "{}.png".format(mask_filename))
     cv2.imwrite(out_mask_path_rgb, rgb_label)
 
@@ -0,0 +1,59 @@
+import multiprocessing as mp
+import multiprocessing.pool as mpp
+import threading
+import time
+
+
+class MaskWriterPool(object):
+    """Writes masks in worker processes while inference goes on.
+
+    At most `max_pending` masks are queued or being written: `submit` blocks once that many are in
+    flight, so memory stays flat whatever the size of the test set. `wait_time` is the time the
+    caller spent blocked on the writers (full queue plus the final drain), i.e. what writing adds
+    to the run. The first error of a writer is raised by the next `submit` or by `close`.
+    """
+
+    def __init__(self, writer, num_workers=None, max_pending=None):
+        self.writer = writer
+        num_workers = num_workers or mp.cpu_count()
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * num_workers)
+        self.pool = mpp.Pool(processes=num_workers)
+        self.error = None
+        self.num_written = 0
+        self.wait_time = 0.0
+
+    def _done(self, _):
+        self.num_written += 1
+        self.slots.release()
+
+    def _failed(self, error):
+        self.error = self.error or error
+        self.slots.release()
+
+    def _check(self):
+        if self.error is not None:
+            self.pool.terminate()
+            raise self.error
+
+    def submit(self, item):
+        self._check()
+        t0 = time.time()
+        self.slots.acquire()
+        self.wait_time += time.time() - t0
+        self.pool.apply_async(self.writer, (item,), callback=self._done, error_callback=self._failed)
+
+    def close(self):
+        t0 = time.time()
+        self.pool.close()
+        self.pool.join()
+        self.wait_time += time.time() - t0
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.metric import Evaluator
+
+
+# combine the --eval-state files of sharded test runs (vaihingen/potsdam/loveda_test.py --shard K/N)
+# and print the metrics of the whole test set
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("states", nargs='+', help="--eval-state JSON files")
+    parser.add_argument("--classes", default=None, help="comma separated class names")
+    parser.add_argument("--ignore-last", action='store_true',
+                        help="leave the last class (clutter) out of the means, as vaihingen/potsdam_test.py")
+    parser.add_argument("-o", "--output", default=None, help="write the merged state to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    evaluator = None
+    for path in args.states:
+        with open(path) as f:
+            shard = Evaluator.from_state_dict(json.load(f))
+        evaluator = shard if evaluator is None else evaluator.merge(shard)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(evaluator.state_dict(), f)
+
+    iou_per_class = evaluator.Intersection_over_Union()
+    f1_per_class = evaluator.F1()
+    names = args.classes.split(',') if args.classes else [str(c) for c in range(evaluator.num_class)]
+    for class_name, class_iou, class_f1 in zip(names, iou_per_class, f1_per_class):
+        print('F1_{}:{}, IOU_{}:{}'.format(class_name, class_f1, class_name, class_iou))
+    end = -1 if args.ignore_last else None
+    print('F1:{}, mIOU:{}, OA:{}'.format(np.nanmean(f1_per_class[:end]), np.nanmean(iou_per_class[:end]),
+                                        evaluator.OA()))
+    print('{} shards, {} pixels'.format(len(args.states), evaluator.confusion_matrix.sum()))
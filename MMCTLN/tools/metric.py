@@ -1,10 +1,12 @@
 import numpy as np
+import torch
+import torch.distributed as dist
 
 
 class Evaluator(object):
     def __init__(self, num_class):
         self.num_class = num_class
-        self.confusion_matrix = np.zeros((self.num_class,) * 2)
+        self.confusion_matrix = np.zeros((self.num_class,) * 2, dtype=np.int64)
         self.eps = 1e-8
 
     def get_tp_fp_tn_fn(self):
@@ -69,7 +71,102 @@ class Evaluator(object):
         self.confusion_matrix += self._generate_matrix(gt_image, pre_image)
 
     def reset(self):
-        self.confusion_matrix = np.zeros((self.num_class,) * 2)
+        self.confusion_matrix = np.zeros((self.num_class,) * 2, dtype=np.int64)
+
+    def merge(self, other):
+        """Add the counts of another evaluator (e.g. of another shard) to this one."""
+        assert other.num_class == self.num_class, 'cannot merge {} classes into {}'.format(other.num_class,
+                                                                                           self.num_class)
+        self.confusion_matrix += np.asarray(other.confusion_matrix, dtype=np.int64)
+        return self
+
+    def state_dict(self):
+        """JSON-serializable counts, see `from_state_dict`."""
+        return {'num_class': self.num_class, 'confusion_matrix': np.asarray(self.confusion_matrix).tolist()}
+
+    def load_state_dict(self, state):
+        assert state['num_class'] == self.num_class, 'state has {} classes, expected {}'.format(state['num_class'],
+                                                                                                self.num_class)
+        self.confusion_matrix = np.array(state['confusion_matrix'], dtype=np.int64)
+        return self
+
+    @classmethod
+    def from_state_dict(cls, state):
+        return cls(state['num_class']).load_state_dict(state)
+
+    def all_reduce(self, group=None):
+        """Sum the counts over the ranks of a torch.distributed job, a no-op outside one."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return self
+        device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend(group) == 'nccl' else 'cpu'
+        counts = torch.from_numpy(np.asarray(self.confusion_matrix, dtype=np.int64)).to(device)
+        dist.all_reduce(counts, op=dist.ReduceOp.SUM, group=group)
+        self.confusion_matrix = counts.cpu().numpy()
+        return self
+
+
+class TorchEvaluator(Evaluator):
+    """Evaluator whose int64 counts stay on the device of the labels.
+
+    `add_batch` takes whole label tensors (NxHxW or HxW, numpy arrays work too) and counts with
+    torch.bincount where they live, so a training or test loop no longer copies every sample to
+    the host. Ground truth outside [0, num_class) and `ignore_index` is left out. The metric
+    methods are the Evaluator ones, on a host copy of the matrix made once after each update.
+    """
+
+    def __init__(self, num_class, ignore_index=None):
+        self.ignore_index = ignore_index
+        self._matrix = torch.zeros(num_class * num_class, dtype=torch.int64)
+        self._host = None
+        super(TorchEvaluator, self).__init__(num_class)
+
+    @property
+    def confusion_matrix(self):
+        if self._host is None:
+            self._host = self._matrix.view(self.num_class, self.num_class).cpu().numpy().copy()
+        return self._host
+
+    @confusion_matrix.setter
+    def confusion_matrix(self, value):
+        value = torch.as_tensor(np.asarray(value))
+        if value.is_floating_point():
+            # integer round is not implemented on older torch
+            value = value.round()
+        value = value.to(torch.int64).reshape(-1)
+        self._matrix = value.to(self._matrix.device)
+        self._host = None
+
+    def add_batch(self, gt_image, pre_image):
+        gt_image, pre_image = torch.as_tensor(gt_image), torch.as_tensor(pre_image)
+        assert gt_image.shape == pre_image.shape, 'pre_image shape {}, gt_image shape {}'.format(pre_image.shape,
+                                                                                                 gt_image.shape)
+        device = pre_image.device
+        if self._matrix.device != device:
+            self._matrix = self._matrix.to(device)
+        gt = gt_image.to(device, dtype=torch.int32, non_blocking=True).reshape(-1)
+        index = gt * self.num_class + pre_image.to(torch.int32).reshape(-1)
+        invalid = (gt < 0) | (gt >= self.num_class)
+        if self.ignore_index is not None:
+            invalid |= gt == self.ignore_index
+        # invalid pixels go to an extra bin instead of being selected out, which would sync with the host
+        index.masked_fill_(invalid, self.num_class ** 2)
+        self._matrix += torch.bincount(index, minlength=self.num_class ** 2 + 1)[:self.num_class ** 2]
+        self._host = None
+
+    def reset(self):
+        self._matrix = torch.zeros_like(self._matrix)
+        self._host = None
+
+    def all_reduce(self, group=None):
+        if not (dist.is_available() and dist.is_initialized()):
+            return self
+        counts = self._matrix
+        if dist.get_backend(group) == 'nccl' and counts.device.type != 'cuda':
+            counts = counts.to(torch.device('cuda', torch.cuda.current_device()))
+        dist.all_reduce(counts, op=dist.ReduceOp.SUM, group=group)
+        self._matrix = counts.to(self._matrix.device)
+        self._host = None
+        return self
 
 
 if __name__ == '__main__':
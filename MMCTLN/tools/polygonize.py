@@ -0,0 +1,246 @@
+import json
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from tools.postprocess import _label_band, label_regions
+
+# segment directions, clockwise on screen (y down); a boundary segment has its region on the left
+E, S, W, N = 0, 1, 2, 3
+
+
+def read_geotransform(path):
+    """(x0, dx, y0, dy) of a north-up GeoTIFF from its pixel scale and tie point tags, None otherwise."""
+    if tifffile is None or not str(path).lower().endswith(('.tif', '.tiff')):
+        return None
+    with tifffile.TiffFile(str(path)) as tif:
+        tags = tif.pages[0].tags
+        if 'ModelPixelScaleTag' not in tags or 'ModelTiepointTag' not in tags:
+            return None
+        sx, sy = tags['ModelPixelScaleTag'].value[:2]
+        i, j, _, x, y = tags['ModelTiepointTag'].value[:5]
+    return x - i * sx, sx, y + j * sy, -sy
+
+
+def _row_runs(edge, region):
+    """(row, x0, x1, region) of every maximal run of boundary pixels with one region along a row."""
+    same = region[:, 1:] == region[:, :-1]
+    starts = edge.copy()
+    starts[:, 1:] &= ~(edge[:, :-1] & same)
+    ends = edge.copy()
+    ends[:, :-1] &= ~(edge[:, 1:] & same)
+    ys, x0 = np.nonzero(starts)
+    _, x1 = np.nonzero(ends)
+    return ys, x0, x1 + 1, region[ys, x0]
+
+
+def _segments(band, above, below, region, keep, y0):
+    """Boundary segments of a band: start/end vertices, direction and region, merged into straight runs."""
+    h, w = band.shape
+    padded = np.full((h + 2, w + 2), -1, dtype=np.int16)
+    padded[1:-1, 1:-1] = band
+    if above is not None:
+        padded[0, 1:-1] = above
+    if below is not None:
+        padded[-1, 1:-1] = below
+    cls = padded[1:-1, 1:-1]
+    kept = keep[band]
+    top = (cls != padded[:-2, 1:-1]) & kept
+    bottom = (cls != padded[2:, 1:-1]) & kept
+    left = (cls != padded[1:-1, :-2]) & kept
+    right = (cls != padded[1:-1, 2:]) & kept
+
+    parts = []
+    y, xa, xb, reg = _row_runs(top, region)
+    parts.append((xb, y, xa, y, W, reg))
+    y, xa, xb, reg = _row_runs(bottom, region)
+    parts.append((xa, y + 1, xb, y + 1, E, reg))
+    x, ya, yb, reg = _row_runs(left.T, region.T)
+    parts.append((x, ya, x, yb, S, reg))
+    x, ya, yb, reg = _row_runs(right.T, region.T)
+    parts.append((x + 1, yb, x + 1, ya, N, reg))
+
+    sx = np.concatenate([p[0] for p in parts])
+    sy = np.concatenate([p[1] for p in parts]) + y0
+    ex = np.concatenate([p[2] for p in parts])
+    ey = np.concatenate([p[3] for p in parts]) + y0
+    direction = np.concatenate([np.full(len(p[5]), p[4]) for p in parts])
+    reg = np.concatenate([p[5] for p in parts])
+    return sx, sy, ex, ey, direction, reg
+
+
+def _pick(candidates, incoming, first_dir):
+    # left turn first, then straight, then right: keeps diagonal-only contacts apart (4-connectivity)
+    for turn in ((incoming - 1) % 4, incoming, (incoming + 1) % 4):
+        for c in candidates:
+            if first_dir(c) == turn:
+                return c
+    raise RuntimeError('broken region boundary')
+
+
+def _simplify(ring):
+    """Drop vertices in the middle of straight lines; `ring` is closed (first == last)."""
+    pts = ring[:-1]
+    prev, nxt = np.roll(pts, 1, axis=0), np.roll(pts, -1, axis=0)
+    cross = (pts[:, 0] - prev[:, 0]) * (nxt[:, 1] - pts[:, 1]) - (pts[:, 1] - prev[:, 1]) * (nxt[:, 0] - pts[:, 0])
+    pts = pts[cross != 0]
+    return np.vstack([pts, pts[:1]])
+
+
+def _signed_area(pts):
+    return 0.5 * float(np.dot(pts[:-1, 0], pts[1:, 1]) - np.dot(pts[1:, 0], pts[:-1, 1]))
+
+
+def _feature(label, rings, transform, class_names):
+    areas = [_signed_area(r) for r in rings]
+    # exterior rings run counter-clockwise on screen, i.e. negative area with y pointing down
+    order = np.argsort(areas)
+    pixel_area = -sum(areas)
+    coordinates = []
+    for k in order:
+        pts = rings[k]
+        if transform is not None:
+            x0, dx, y0, dy = transform
+            pts = np.stack([x0 + pts[:, 0] * dx, y0 + pts[:, 1] * dy], axis=1)
+        # RFC 7946: exterior counter-clockwise, holes clockwise, in output coordinates
+        if (_signed_area(pts) > 0) != (k == order[0]):
+            pts = pts[::-1]
+        coordinates.append(pts.tolist())
+    properties = {'class': int(label), 'area': int(round(pixel_area))}
+    if class_names is not None and label < len(class_names):
+        properties['name'] = class_names[label]
+    return json.dumps({'type': 'Feature', 'properties': properties,
+                       'geometry': {'type': 'Polygon', 'coordinates': coordinates}}, separators=(',', ':'))
+
+
+def _polygonize_band(task):
+    band, above, below, roots, y0, open_lines, keep, transform, class_names = task
+    h, w = band.shape
+    ids, _ = _label_band(band, 4)
+    sx, sy, ex, ey, direction, reg = _segments(band, above, below, roots[ids], keep, y0)
+    n = len(sx)
+    if n == 0:
+        return [], {}
+    # the pixel on the left of the first step of each segment
+    seg_class = band[sy - y0 - ((direction == E) | (direction == N)), sx - ((direction == W) | (direction == N))]
+
+    # successor of every segment: the one of the same region starting where it ends
+    start_key = (reg * (h + 1) + sy - y0) * (w + 1) + sx
+    end_key = (reg * (h + 1) + ey - y0) * (w + 1) + ex
+    order = np.argsort(start_key, kind='stable')
+    sorted_key = start_key[order]
+    pos = np.minimum(np.searchsorted(sorted_key, end_key), n - 1)
+    is_open = np.isin(ey, list(open_lines))
+    nxt = np.where(is_open, -1, order[pos])
+    saddle = np.flatnonzero(~is_open & (pos + 1 < n) & (sorted_key[np.minimum(pos + 1, n - 1)] == end_key))
+    if len(saddle):
+        a, b = order[pos[saddle]], order[pos[saddle] + 1]
+        # left turn first: regions touching only at a corner stay apart (4-connectivity)
+        nxt[saddle] = np.where(direction[a] == (direction[saddle] - 1) % 4, a, b)
+
+    nxt = nxt.tolist()
+    seen = bytearray(n)
+    rings, pieces, label = {}, {}, {}
+
+    def walk(i):
+        chain = []
+        while i != -1 and not seen[i]:
+            seen[i] = 1
+            chain.append(i)
+            i = nxt[i]
+        idx = np.array(chain)
+        r = int(reg[idx[0]])
+        label[r] = int(seg_class[idx[0]])
+        return r, idx
+
+    # pieces cut by a band seam are followed from the seam first, what is left are closed rings
+    for i in np.flatnonzero(np.isin(sy, list(open_lines))).tolist():
+        if not seen[i]:
+            r, idx = walk(i)
+            pts = np.stack([np.append(sx[idx], ex[idx[-1]]), np.append(sy[idx], ey[idx[-1]])], axis=1)
+            pieces.setdefault(r, []).append((pts, int(direction[idx[0]]), int(direction[idx[-1]])))
+    for i in range(n):
+        if not seen[i]:
+            r, idx = walk(i)
+            idx = np.append(idx, idx[0])
+            rings.setdefault(r, []).append(np.stack([sx[idx], sy[idx]], axis=1))
+
+    lines = [_feature(label[r], rs, transform, class_names) for r, rs in rings.items() if r not in pieces]
+    open_regions = {r: (label[r], rings.get(r, []), ps) for r, ps in pieces.items()}
+    return lines, open_regions
+
+
+def _stitch(pieces):
+    """Join the seam-cut pieces of one region into closed rings."""
+    starts = {}
+    for k, (pts, _, _) in enumerate(pieces):
+        starts.setdefault(tuple(pts[0]), []).append(k)
+    used = [False] * len(pieces)
+    rings = []
+    for k in range(len(pieces)):
+        if used[k]:
+            continue
+        first, ring = k, [pieces[k][0]]
+        used[k] = True
+        while True:
+            k = _pick(starts[tuple(ring[-1][-1])], pieces[k][2], lambda c: pieces[c][1])
+            if k == first:
+                break
+            used[k] = True
+            ring.append(pieces[k][0][1:])
+        # straight lines crossing a seam are split there
+        rings.append(_simplify(np.concatenate(ring)))
+    return rings
+
+
+def polygonize(mask, out, band_rows=512, num_workers=None, classes=None, class_names=None, transform=None):
+    """Vectorize every 4-connected region of a label mask into one GeoJSON Polygon feature per
+    line of `out` (line-delimited GeoJSON), holes included.
+
+    Bands of `band_rows` rows are traced in a process pool; regions inside one band are written
+    as soon as their band is done, regions crossing band seams are joined at the end. Polygons
+    follow pixel edges, in pixel coordinates or mapped by `transform` = (x0, dx, y0, dy).
+    `classes` limits the output to these labels. Returns the number of features written.
+    """
+    height = mask.shape[0]
+    bands, offsets, root = label_regions(mask, band_rows, connectivity=4, num_workers=num_workers)
+    keep = np.zeros(256, dtype=bool)
+    keep[list(range(256)) if classes is None else list(classes)] = True
+
+    def task(k):
+        y0, y1 = bands[k]
+        open_lines = {y for y in (y0, y1) if 0 < y < height}
+        return (np.asarray(mask[y0:y1]), None if y0 == 0 else np.asarray(mask[y0 - 1]),
+                None if y1 == height else np.asarray(mask[y1]), root[offsets[k]:offsets[k + 1]], y0,
+                open_lines, keep, transform, class_names)
+
+    num_workers = num_workers or mp.cpu_count()
+    num_features = 0
+    open_regions = {}
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context('fork')) as executor:
+        # a bounded number of bands in flight keeps memory flat on huge scenes
+        in_flight = deque()
+        next_band = 0
+        while next_band < len(bands) or in_flight:
+            while next_band < len(bands) and len(in_flight) < 2 * num_workers:
+                in_flight.append(executor.submit(_polygonize_band, task(next_band)))
+                next_band += 1
+            lines, regions = in_flight.popleft().result()
+            for line in lines:
+                out.write(line + '\n')
+            num_features += len(lines)
+            for r, (label, rings, pieces) in regions.items():
+                entry = open_regions.setdefault(r, (label, [], []))
+                entry[1].extend(rings)
+                entry[2].extend(pieces)
+
+    for label, rings, pieces in open_regions.values():
+        out.write(_feature(label, rings + _stitch(pieces), transform, class_names) + '\n')
+    return num_features + len(open_regions)
@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+def parse_min_area(text):
+    """'64' -> every class 64 px; '0:64,4:16' -> per class. Returns a 256-entry array."""
+    min_area = np.zeros(256, dtype=np.int64)
+    for item in text.split(','):
+        label, _, area = item.strip().rpartition(':')
+        if label:
+            min_area[int(label)] = int(area)
+        else:
+            min_area[:] = int(area)
+    return min_area
+
+
+def _label_band(band, connectivity):
+    """Band-local component ids (0..n-1, every pixel belongs to one) and the class of each id."""
+    ids = np.empty(band.shape, dtype=np.int32)
+    classes = []
+    n = 0
+    for c in np.flatnonzero(np.bincount(band.ravel(), minlength=256)):
+        count, lab = cv2.connectedComponents((band == c).astype(np.uint8), connectivity=connectivity,
+                                             ltype=cv2.CV_32S)
+        inside = lab > 0
+        ids[inside] = lab[inside] + (n - 1)
+        classes.append(np.full(count - 1, c, dtype=np.uint8))
+        n += count - 1
+    return ids, np.concatenate(classes)
+
+
+def _neighbour_counts(ids_a, cls_a, ids_b, cls_b):
+    """(component, neighbouring class) keys for every adjacent pixel pair of different classes."""
+    differ = cls_a != cls_b
+    return np.concatenate([ids_a[differ].astype(np.int64) * 256 + cls_b[differ],
+                           ids_b[differ].astype(np.int64) * 256 + cls_a[differ]])
+
+
+def _scan_band(mask, y0, y1, connectivity, neighbours=True):
+    band = np.asarray(mask[y0:y1])
+    ids, classes = _label_band(band, connectivity)
+    scan = dict(classes=classes, area=np.bincount(ids.ravel(), minlength=len(classes)),
+                top=(ids[0], band[0]), bottom=(ids[-1], band[-1]))
+    if neighbours:
+        keys = np.concatenate([_neighbour_counts(ids[:, :-1], band[:, :-1], ids[:, 1:], band[:, 1:]),
+                               _neighbour_counts(ids[:-1], band[:-1], ids[1:], band[1:])])
+        scan['keys'], scan['counts'] = np.unique(keys, return_counts=True)
+    return scan
+
+
+def _find_roots(parent):
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent = grand
+
+
+def _union_seams(scans, offsets, connectivity):
+    """Global region of every band component (union-find across band seams), plus the
+    cross-seam (component, neighbouring class) keys and counts."""
+    keys, counts = [], []
+    parent = np.arange(offsets[-1])
+    for k in range(len(scans) - 1):
+        ids_a, cls_a = scans[k]['bottom']
+        ids_b, cls_b = scans[k + 1]['top']
+        ids_a = ids_a.astype(np.int64) + offsets[k]
+        ids_b = ids_b.astype(np.int64) + offsets[k + 1]
+        links = [(ids_a, cls_a, ids_b, cls_b)]
+        if connectivity == 8:
+            links += [(ids_a[:-1], cls_a[:-1], ids_b[1:], cls_b[1:]), (ids_a[1:], cls_a[1:], ids_b[:-1], cls_b[:-1])]
+        pairs = set()
+        for la, ca, lb, cb in links:
+            pairs.update(zip(la[ca == cb].tolist(), lb[ca == cb].tolist()))
+        for a, b in pairs:
+            ra, rb = a, b
+            while parent[ra] != ra:
+                ra = parent[ra]
+            while parent[rb] != rb:
+                rb = parent[rb]
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+        seam_keys, seam_counts = np.unique(_neighbour_counts(ids_a, cls_a, ids_b, cls_b), return_counts=True)
+        keys.append(seam_keys)
+        counts.append(seam_counts)
+    root = _find_roots(parent)
+    return root, keys, counts
+
+
+def label_regions(mask, band_rows=512, connectivity=4, num_workers=None):
+    """Connected regions of a label mask, labeled band by band.
+
+    Returns the (y0, y1) bands, the offset of every band's component ids and the global region
+    of every component: region of pixel p in band k = root[offsets[k] + _label_band(band k)[0][p]].
+    """
+    height = mask.shape[0]
+    bands = [(y, min(y + band_rows, height)) for y in range(0, height, band_rows)]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        scans = list(executor.map(lambda b: _scan_band(mask, b[0], b[1], connectivity, neighbours=False), bands))
+    offsets = np.cumsum([0] + [len(s['classes']) for s in scans])
+    root, _, _ = _union_seams(scans, offsets, connectivity)
+    return bands, offsets, root
+
+
+def remove_small_regions(mask, min_area, band_rows=512, connectivity=4, num_workers=None, out=None,
+                         ignore_label=None):
+    """Relabel every connected region smaller than `min_area[class]` to the class it shares the longest
+    border with (holes are regions of another class, so they are filled the same way).
+
+    Regions of `ignore_label` (e.g. the fill outside an area of interest) are never relabeled and
+    their borders do not vote; a small region bordered only by them keeps its class.
+
+    The mask is processed in bands of `band_rows` rows, in parallel: regions are labeled per band,
+    merged across band seams with a union-find, then relabeled band by band, so only a few bands of
+    int32 ids are ever in memory. `mask` may be a np.memmap; the result goes to `out` (a new array
+    by default, `out=mask` works in place).
+    """
+    min_area = np.asarray(min_area)
+    if ignore_label is not None:
+        min_area = min_area.copy()
+        min_area[ignore_label] = 0
+    height = mask.shape[0]
+    bands = [(y, min(y + band_rows, height)) for y in range(0, height, band_rows)]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        scans = list(executor.map(lambda b: _scan_band(mask, b[0], b[1], connectivity), bands))
+
+        offsets = np.cumsum([0] + [len(s['classes']) for s in scans])
+        classes = np.concatenate([s['classes'] for s in scans])
+        area = np.concatenate([s['area'] for s in scans])
+        keys = [s['keys'] + offsets[k] * 256 for k, s in enumerate(scans)]
+        counts = [s['counts'] for s in scans]
+
+        root, seam_keys, seam_counts = _union_seams(scans, offsets, connectivity)
+        keys += seam_keys
+        counts += seam_counts
+
+        region_area = np.bincount(root, weights=area, minlength=len(classes))
+        small = region_area[root] < min_area[classes]
+
+        # per region, the neighbouring class with the longest shared border
+        keys, weight = np.concatenate(keys), np.concatenate(counts)
+        if ignore_label is not None:
+            voting = keys % 256 != ignore_label
+            keys, weight = keys[voting], weight[voting]
+        pair, inverse = np.unique(root[keys // 256] * 256 + keys % 256, return_inverse=True)
+        pair = pair[np.lexsort((np.bincount(inverse, weights=weight), pair // 256))]
+        replacement = np.full(len(classes), -1, dtype=np.int64)
+        if len(pair):
+            last = np.r_[pair[1:] // 256 != pair[:-1] // 256, True]
+            replacement[pair[last] // 256] = pair[last] % 256
+        labels = classes.copy()
+        relabel = small & (replacement[root] >= 0)
+        labels[relabel] = replacement[root][relabel]
+
+        if out is None:
+            out = np.empty(mask.shape, dtype=np.uint8)
+
+        def write_band(k):
+            # a band is labeled again from its own rows only, so writing bands in place is safe
+            y0, y1 = bands[k]
+            ids, _ = _label_band(np.asarray(mask[y0:y1]), connectivity)
+            out[y0:y1] = labels[ids + offsets[k]]
+
+        list(executor.map(write_band, range(len(bands))))
+    return out
@@ -0,0 +1,136 @@
+import cv2
+import numpy as np
+
+from tools.label_codec import rgb2label
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+class RowReader(object):
+    """Rows of a label raster read top to bottom, `rows(y0, y1)` with non-decreasing y0.
+
+    Uncompressed TIFFs and .npy files are memory-mapped, compressed strip/tiled TIFFs are decoded
+    one strip or tile row at a time and only the rows not yet returned are kept. Other formats are
+    read whole. 3-channel rasters come back RGB whichever reader is used (tifffile keeps the stored
+    RGB order, cv2 reads are converted).
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.array = None
+        self._segments = None
+        if self.path.lower().endswith('.npy'):
+            self.array = np.load(self.path, mmap_mode='r')
+        elif tifffile is not None and self.path.lower().endswith(('.tif', '.tiff')):
+            try:
+                self.array = tifffile.memmap(self.path, mode='r')
+            except ValueError:
+                self._tif = tifffile.TiffFile(self.path)
+                page = self._tif.pages[0]
+                if page.planarconfig == 1 or page.samplesperpixel == 1:
+                    self.shape = page.shape
+                    self._segments = page.segments(sort=True)
+                    self._buffer = np.zeros((0,) + self.shape[1:], dtype=page.dtype)
+                    self._top = 0
+                else:
+                    self.array = page.asarray()
+                    self._tif.close()
+        if self.array is None and self._segments is None:
+            image = cv2.imread(self.path, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                raise ValueError('could not read {}'.format(self.path))
+            if image.ndim == 3:
+                image = cv2.cvtColor(image[..., :3], cv2.COLOR_BGR2RGB)
+            self.array = image
+        if self.array is not None:
+            self.shape = self.array.shape
+
+    def _decode_row(self):
+        """Append the next strip or row of tiles to the buffer, False at the end of the file."""
+        h, w = self.shape[:2]
+        rows = None
+        for segment, index, _ in self._segments:
+            y, x = index[2], index[3]
+            segment = segment[0].reshape(segment.shape[1:3] + self.shape[2:])
+            if rows is None:
+                rows = np.zeros((min(segment.shape[0], h - y), w) + self.shape[2:], dtype=segment.dtype)
+            segment = segment[:rows.shape[0], :w - x]
+            rows[:, x:x + segment.shape[1]] = segment
+            if x + segment.shape[1] >= w:
+                break
+        if rows is None:
+            return False
+        self._buffer = np.concatenate([self._buffer, rows])
+        return True
+
+    def rows(self, y0, y1):
+        y1 = min(y1, self.shape[0])
+        if self.array is not None:
+            return np.asarray(self.array[y0:y1])
+        drop = y0 - self._top
+        if drop > 0:
+            self._buffer = self._buffer[drop:]
+            self._top = y0
+        while self._top + len(self._buffer) < y1 and self._decode_row():
+            pass
+        return self._buffer[y0 - self._top:y1 - self._top]
+
+    def close(self):
+        if self._segments is not None:
+            self._tif.close()
+
+
+def boundary_mask(labels, width):
+    """Pixels within `width` pixels (Chebyshev) of a label change."""
+    kernel = np.ones((2 * width + 1, 2 * width + 1), dtype=np.uint8)
+    return cv2.dilate(labels, kernel) != cv2.erode(labels, kernel)
+
+
+def evaluate_streaming(evaluator, prediction, gt_path, band_rows=512, ignore_path=None, boundary=0, palette=None):
+    """Accumulate the confusion matrix of `prediction` (HxW labels) against the ground truth in
+    `gt_path` band by band, so the ground truth is never held whole.
+
+    3-channel ground truth is converted with `palette`, its RGB colors (see `GT_PALETTES`); colors
+    missing from it are left out and counted in a warning. Pixels labelled >= num_class in either
+    mask (e.g. outside an AOI), nonzero in the raster at `ignore_path` or within `boundary` pixels
+    of a ground-truth class boundary are left out.
+    """
+    gt_reader = RowReader(gt_path)
+    num_unknown = 0
+    ignore_reader = None if ignore_path is None else RowReader(ignore_path)
+    try:
+        if gt_reader.shape[:2] != prediction.shape[:2]:
+            raise ValueError('ground truth {} is {}x{}, the prediction {}x{}'.format(
+                gt_path, gt_reader.shape[1], gt_reader.shape[0], prediction.shape[1], prediction.shape[0]))
+        h = prediction.shape[0]
+        for y0 in range(0, h, band_rows):
+            y1 = min(y0 + band_rows, h)
+            # boundary pixels need `boundary` rows of context above and below the band
+            top = max(y0 - boundary, 0)
+            gt = gt_reader.rows(top, min(y1 + boundary, h))
+            if gt.ndim == 3:
+                if palette is None:
+                    raise ValueError('{} is a color mask, but no ground-truth palette was given'.format(gt_path))
+                gt = rgb2label(gt[..., :3], palette, default=255)
+                num_unknown += int((gt[y0 - top:y1 - top] == 255).sum())
+            gt = np.array(gt, dtype=np.uint8)
+            if boundary > 0:
+                gt[boundary_mask(gt, boundary)] = 255
+            gt = gt[y0 - top:y0 - top + y1 - y0]
+            pred = prediction[y0:y1]
+            gt[pred >= evaluator.num_class] = 255
+            if ignore_reader is not None:
+                ignore = ignore_reader.rows(y0, y1)
+                gt[(ignore.max(axis=2) if ignore.ndim == 3 else ignore) > 0] = 255
+            evaluator.add_batch(gt_image=gt, pre_image=np.minimum(pred, evaluator.num_class - 1))
+    finally:
+        gt_reader.close()
+        if ignore_reader is not None:
+            ignore_reader.close()
+    if num_unknown:
+        print('warning: {} pixels of {} have colors outside the ground-truth palette, not evaluated'.format(
+            num_unknown, gt_path))
+    return evaluator
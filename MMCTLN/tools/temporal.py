@@ -0,0 +1,86 @@
+from torch import nn
+
+
+class KeyframeFeatureCache(nn.Module):
+    """Deep backbone features of video keyframes reused on the frames in between.
+
+    Every `interval`-th frame of a sequence is a keyframe and runs the whole backbone; its last
+    `reuse_stages` stage outputs (res3/res4 by default) are kept. The other frames run only the
+    shallow stages and the decoder on top of the kept features. Forwards are matched to the
+    keyframe by their order within the frame and their input shape, so every frame has to be
+    tiled and batched the same way; a forward without a match runs the whole backbone.
+
+    With `drift_threshold`, a forward whose last shallow features moved more than this (mean
+    absolute change relative to the keyframe) runs the whole backbone and refreshes its features.
+
+    Call `start_sequence()` before the first frame of a video and `start_frame()` before every
+    frame; until then the model runs unchanged.
+    """
+
+    def __init__(self, model, interval, reuse_stages=2, drift_threshold=None):
+        super().__init__()
+        net = getattr(model, 'net', model)
+        if not hasattr(net, 'backbone') or not hasattr(net, 'decoder'):
+            raise ValueError('feature reuse needs a model with a backbone and a decoder')
+        self.model = model
+        self.net = net
+        self.interval = interval
+        self.reuse_stages = reuse_stages
+        self.drift_threshold = drift_threshold
+        self.frame_index = None
+        self.call_index = 0
+        self.cache = {}
+        self.num_tiles = 0
+        self.num_reused = 0
+        self.num_refreshed = 0
+
+    def start_sequence(self):
+        self.frame_index = -1
+        self.cache = {}
+
+    def start_frame(self):
+        self.frame_index += 1
+        self.call_index = 0
+
+    @property
+    def is_keyframe(self):
+        return self.frame_index % self.interval == 0
+
+    def _full(self, x, key):
+        features = self.net.backbone(x)
+        shallow = len(features) - self.reuse_stages
+        self.cache[key] = (x.shape, features[shallow - 1].detach(), [f.detach() for f in features[shallow:]])
+        return features
+
+    def forward(self, x):
+        if self.frame_index is None:
+            return self.model(x)
+        h, w = x.size()[-2:]
+        key = self.call_index
+        self.call_index += 1
+        self.num_tiles += x.shape[0]
+        entry = self.cache.get(key)
+        if self.is_keyframe or entry is None or entry[0] != x.shape:
+            features = self._full(x, key)
+        else:
+            num_stages = len(self.net.backbone.layers) - self.reuse_stages
+            features = list(self.net.backbone(x, num_stages=num_stages)) + entry[2]
+            if self.drift_threshold is not None:
+                reference = entry[1]
+                drift = (features[num_stages - 1] - reference).abs().mean() / reference.abs().mean().clamp_min(1e-12)
+                if drift > self.drift_threshold:
+                    self.num_refreshed += x.shape[0]
+                    features = self._full(x, key)
+                else:
+                    self.num_reused += x.shape[0]
+            else:
+                self.num_reused += x.shape[0]
+        return self.net.decoder(*features, h, w)
+
+    def summary(self):
+        fraction = self.num_reused / max(self.num_tiles, 1)
+        text = 'feature reuse: {} of {} tiles reused keyframe features ({:.1%})'.format(
+            self.num_reused, self.num_tiles, fraction)
+        if self.drift_threshold is not None:
+            text += ', {} refreshed on drift'.format(self.num_refreshed)
+        return text
@@ -0,0 +1,246 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def tile_hash(tile):
+    tile = np.ascontiguousarray(tile)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(tile.shape).encode())
+    h.update(tile.data)
+    return h.digest()
+
+
+def is_nodata_tile(tile, nodata_value=0, threshold=1.0):
+    """True when at least `threshold` of the pixels equal `nodata_value` in every channel."""
+    nodata = tile == nodata_value
+    if nodata.ndim == 3:
+        nodata = nodata.all(axis=-1)
+    return nodata.mean() >= threshold
+
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class TileSkipper(object):
+    """Resolves tiles without running the model.
+
+    Tiles that are mostly `nodata_value` get `nodata_class`, tiles whose content was already
+    predicted come from a bounded LRU keyed by a content hash, and repeated tiles inside one
+    image are only inferred once. `plan` returns the per-tile outputs with None for the tiles
+    that still need the model, `finish` fills the repeats and caches the new predictions. Tiles
+    not in `include` (e.g. outside an area of interest) are left None and never pending.
+    """
+
+    def __init__(self, nodata_value=None, nodata_threshold=1.0, nodata_class=0, cache_size=0):
+        self.nodata_value = nodata_value
+        self.nodata_threshold = nodata_threshold
+        self.nodata_class = nodata_class
+        self.cache = LRUCache(cache_size)
+        self.num_tiles = 0
+        self.num_nodata = 0
+        self.num_cached = 0
+        self._keys = None
+        self._repeats = None
+
+    @property
+    def enabled(self):
+        return self.nodata_value is not None or self.cache.max_size > 0
+
+    def plan(self, tiles, include=None):
+        outputs = [None] * len(tiles)
+        self.num_tiles += len(tiles)
+        self._keys, self._repeats = {}, {}
+        included = range(len(tiles)) if include is None else [k for k in range(len(tiles)) if include[k]]
+        if not self.enabled:
+            return outputs, list(included)
+
+        pending = []
+        first_seen = {}
+        for k in included:
+            tile = tiles[k]
+            if self.nodata_value is not None and is_nodata_tile(tile, self.nodata_value, self.nodata_threshold):
+                outputs[k] = np.full(tile.shape[:2], self.nodata_class, dtype=np.uint8)
+                self.num_nodata += 1
+                continue
+            if self.cache.max_size <= 0:
+                pending.append(k)
+                continue
+            key = tile_hash(tile)
+            cached = self.cache.get(key)
+            if cached is not None:
+                outputs[k] = cached
+                self.num_cached += 1
+            elif key in first_seen:
+                self._repeats[k] = first_seen[key]
+                self.num_cached += 1
+            else:
+                first_seen[key] = k
+                self._keys[k] = key
+                pending.append(k)
+        return outputs, pending
+
+    def finish(self, outputs, exclude=()):
+        """Fill the repeats; tiles in `exclude` (e.g. coarse, not full-resolution predictions) are not cached."""
+        for k, key in self._keys.items():
+            if k not in exclude:
+                self.cache.put(key, outputs[k].astype(np.uint8))
+        for k, first in self._repeats.items():
+            outputs[k] = outputs[first]
+        return outputs
+
+    def saved_fraction(self):
+        return (self.num_nodata + self.num_cached) / max(self.num_tiles, 1)
+
+    def summary(self):
+        return 'tiles: {}, nodata: {}, cached: {}, model calls saved: {:.2%}'.format(
+            self.num_tiles, self.num_nodata, self.num_cached, self.saved_fraction())
+
+
+def tile_signature(tile, method='diff', downsample=8):
+    """Small fingerprint of an RGB tile for `signature_distance`.
+
+    'diff' is the tile in gray shrunk `downsample` times, 'phash' a 64-bit DCT perceptual hash.
+    """
+    gray = cv2.cvtColor(np.ascontiguousarray(tile), cv2.COLOR_RGB2GRAY).astype(np.float32)
+    if method == 'diff':
+        size = (max(1, gray.shape[1] // downsample), max(1, gray.shape[0] // downsample))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA) / 255.0
+    if method == 'phash':
+        low = cv2.dct(cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA))[:8, :8]
+        return low > np.median(low)
+    raise ValueError('unknown signature method {}'.format(method))
+
+
+def signature_distance(a, b):
+    """Mean absolute difference of 'diff' signatures, fraction of differing bits of 'phash' ones, in [0, 1]."""
+    if a.dtype == bool:
+        return float(np.mean(a != b))
+    return float(np.mean(np.abs(a - b)))
+
+
+class FrameDiffGate(object):
+    """Reuses the previous prediction of a video tile whose content barely changed.
+
+    Each tile is compared with the tile at the same position in the frame its current
+    prediction was made from, not the previous frame, so slow changes add up until the tile
+    is inferred again. A prediction is reused at most `max_skip` frames in a row. Same
+    `plan`/`finish` protocol as TileSkipper; call `reset` at the start of every sequence.
+    """
+
+    def __init__(self, threshold, method='diff', downsample=8, max_skip=10):
+        self.threshold = threshold
+        self.method = method
+        self.downsample = downsample
+        self.max_skip = max_skip
+        self.num_tiles = 0
+        self.num_skipped = 0
+        self.reset()
+
+    def reset(self):
+        self._reference = {}
+        self._signatures = None
+
+    def plan(self, tiles):
+        outputs = [None] * len(tiles)
+        pending = []
+        self._signatures = {}
+        self.num_tiles += len(tiles)
+        for k, tile in enumerate(tiles):
+            signature = tile_signature(tile, self.method, self.downsample)
+            reference = self._reference.get(k)
+            if reference is not None and reference[2] < self.max_skip and reference[0].shape == signature.shape \
+                    and signature_distance(signature, reference[0]) < self.threshold:
+                outputs[k] = reference[1]
+                self._reference[k] = (reference[0], reference[1], reference[2] + 1)
+                self.num_skipped += 1
+            else:
+                self._signatures[k] = signature
+                pending.append(k)
+        return outputs, pending
+
+    def finish(self, outputs):
+        for k, signature in self._signatures.items():
+            self._reference[k] = (signature, np.asarray(outputs[k], dtype=np.uint8), 0)
+        return outputs
+
+    def skip_rate(self):
+        return self.num_skipped / max(self.num_tiles, 1)
+
+    def summary(self):
+        return 'frame gate: {} of {} tiles reused the previous prediction ({:.1%})'.format(
+            self.num_skipped, self.num_tiles, self.skip_rate())
+
+
+class DiskLRUCache(object):
+    """Byte blobs stored as files under `directory`, least recently used first out beyond `max_bytes`.
+
+    Recency is kept in the file modification times, so the cache survives restarts.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        files = [e for e in os.scandir(directory) if e.is_file() and not e.name.endswith('.tmp')]
+        files.sort(key=lambda e: e.stat().st_mtime)
+        self.entries = OrderedDict((e.name, e.stat().st_size) for e in files)
+        self.size = sum(self.entries.values())
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.size -= self.entries.pop(key)
+            return None
+        os.utime(path)
+        self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = os.path.join(self.directory, key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.size += len(data) - self.entries.pop(key, 0)
+        self.entries[key] = len(data)
+        while self.size > self.max_bytes:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,152 @@
+import json
+import os
+
+import numpy as np
+
+
+def _atomic_json_dump(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ImageTileStore(object):
+    """Partial prediction of one padded image: a uint8 memmap plus one done flag per tile.
+
+    Tile data is flushed before its done flag, so a flagged tile is always on disk.
+    """
+
+    def __init__(self, root, name, shape, num_tiles):
+        self.mask_path = os.path.join(root, name + '.mask.npy')
+        self.done_path = os.path.join(root, name + '.done.npy')
+        shape = tuple(shape)
+        if os.path.exists(self.mask_path) and os.path.exists(self.done_path):
+            self.mask = np.load(self.mask_path, mmap_mode='r+')
+            self.done = np.load(self.done_path, mmap_mode='r+')
+            if self.mask.shape != shape or self.done.shape != (num_tiles,):
+                raise ValueError('partial prediction {} does not match the current tiling, '
+                                 'remove it to start this image again'.format(self.mask_path))
+        else:
+            self.mask = np.lib.format.open_memmap(self.mask_path, mode='w+', dtype=np.uint8, shape=shape)
+            self.done = np.lib.format.open_memmap(self.done_path, mode='w+', dtype=np.bool_, shape=(num_tiles,))
+
+    def load(self, coord, patch_size):
+        m, n = coord
+        return np.array(self.mask[m:m + patch_size[0], n:n + patch_size[1]])
+
+    def save(self, tiles, coords, patch_size):
+        """Persist {tile index: tile mask} and mark those tiles done."""
+        if not tiles:
+            return
+        for k, tile in tiles.items():
+            m, n = coords[k]
+            self.mask[m:m + patch_size[0], n:n + patch_size[1]] = tile
+        self.mask.flush()
+        self.done[list(tiles)] = True
+        self.done.flush()
+
+    def remove(self):
+        del self.mask, self.done
+        os.remove(self.mask_path)
+        os.remove(self.done_path)
+
+
+class JobManifest(object):
+    """Completed images of a huge-image inference job, kept next to its outputs.
+
+    `signature` holds the settings that change predictions or written outputs; resuming with
+    different settings is refused instead of mixing two runs in one output folder.
+    """
+
+    def __init__(self, root, signature):
+        self.root = root
+        self.path = os.path.join(root, 'manifest.json')
+        signature = json.loads(json.dumps(signature))
+        os.makedirs(root, exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.state = json.load(f)
+            if self.state['signature'] != signature:
+                raise ValueError('{} was written with different settings: {} (now {})'.format(
+                    self.path, self.state['signature'], signature))
+        else:
+            self.state = {'signature': signature, 'images': []}
+            _atomic_json_dump(self.state, self.path)
+        self.completed = set(self.state['images'])
+
+    def is_done(self, name):
+        return name in self.completed
+
+    def eval_state(self, name):
+        """What `mark_done` stored for a completed image, None if nothing was."""
+        return self.state.get('eval', {}).get(name)
+
+    def open_image(self, name, shape, num_tiles):
+        return ImageTileStore(self.root, name, shape, num_tiles)
+
+    def mark_done(self, name, store=None, eval_state=None):
+        """`eval_state` (e.g. the image's Evaluator state_dict) is kept for `eval_state(name)`."""
+        self.completed.add(name)
+        self.state['images'].append(name)
+        if eval_state is not None:
+            self.state.setdefault('eval', {})[name] = eval_state
+        _atomic_json_dump(self.state, self.path)
+        if store is not None:
+            store.remove()
+
+
+def _atomic_npy_save(array, path):
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+class IncrementalState(object):
+    """Per-tile content hashes and the stitched prediction of the last run over one image.
+
+    A later run over an updated version of the image only re-infers the tiles whose hash
+    changed, plus a halo of neighbouring tiles; the others keep their stored prediction.
+    A different tiling or `signature` (settings that change predictions) reuses nothing.
+    """
+
+    def __init__(self, root, name, signature):
+        os.makedirs(root, exist_ok=True)
+        self.meta_path = os.path.join(root, name + '.json')
+        self.hashes_path = os.path.join(root, name + '.hashes.npy')
+        self.prediction_path = os.path.join(root, name + '.prediction.npy')
+        self.signature = json.loads(json.dumps(signature))
+
+    def reusable(self, hashes, shape, grid, halo=1):
+        """(stored prediction or None, bool per tile: stored prediction still valid).
+
+        `hashes` is num_tiles x digest bytes in row-major tile order over a `grid` of tile rows x cols.
+        """
+        unchanged = np.zeros(len(hashes), dtype=bool)
+        if not os.path.exists(self.meta_path):
+            return None, unchanged
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        if meta['signature'] != self.signature or tuple(meta['shape']) != tuple(shape):
+            return None, unchanged
+        previous = np.load(self.hashes_path)
+        if previous.shape != hashes.shape:
+            return None, unchanged
+        changed = (previous != hashes).any(axis=1).reshape(grid)
+        if halo > 0:
+            padded = np.pad(changed, halo)
+            changed = np.zeros_like(changed)
+            for dy in range(2 * halo + 1):
+                for dx in range(2 * halo + 1):
+                    changed |= padded[dy:dy + grid[0], dx:dx + grid[1]]
+        return np.load(self.prediction_path, mmap_mode='r'), ~changed.ravel()
+
+    def save(self, hashes, prediction):
+        # the metadata goes last, so it never describes half-written arrays
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        _atomic_npy_save(hashes, self.hashes_path)
+        _atomic_npy_save(prediction, self.prediction_path)
+        _atomic_json_dump({'signature': self.signature, 'shape': list(prediction.shape)}, self.meta_path)
@@ -0,0 +1,237 @@
+import itertools
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from tools.metric import Evaluator
+
+
+def geometry_product(hflip=False, vflip=False, rot90=(0,)):
+    """All (hflip, vflip, k) combinations, matching a ttach.Compose of the same transforms.
+
+    As in ttach.Rotate90, the identity rotation is added when missing.
+    """
+    rot90 = list(rot90) if 0 in rot90 else [0] + list(rot90)
+    return list(itertools.product([False, True] if hflip else [False],
+                                  [False, True] if vflip else [False],
+                                  rot90))
+
+
+def apply_geometry(x, geometry):
+    hflip, vflip, k = geometry
+    if hflip:
+        x = x.flip(3)
+    if vflip:
+        x = x.flip(2)
+    if k:
+        x = torch.rot90(x, k, dims=(2, 3))
+    return x
+
+
+def undo_geometry(x, geometry):
+    hflip, vflip, k = geometry
+    if k:
+        x = torch.rot90(x, -k, dims=(2, 3))
+    if vflip:
+        x = x.flip(2)
+    if hflip:
+        x = x.flip(3)
+    return x
+
+
+class TTAEngine(nn.Module):
+    """Test time augmentation with batched forwards and a running-mean merge.
+
+    The input is resized once per scale and all geometric variants of the resized tensor are
+    stacked into as few forwards as the memory budget allows; no forward holds more samples
+    than the budget, splitting the tile batch when needed. The de-augmented logits are added
+    to one running sum, so only a single full-resolution accumulator is kept. Equals
+    ttach.SegmentationTTAWrapper (merge_mode='mean') over the product of the same
+    flips/rotations and ttach.Scale (scale 1 is added when missing) up to the resize order:
+    ttach resizes every flipped/rotated copy, which gives the same result for scale 1 and
+    for resizes that commute with flips.
+
+    Args:
+        model: segmentation model returning NxKxHxW logits.
+        geometries: list of (hflip, vflip, rot90 k), see `geometry_product`.
+        scales: input scale factors.
+        interpolation, align_corners: as in ttach.Scale.
+        memory_budget_mb: cap on the activation memory of one forward, None for no cap.
+        bytes_per_pixel: activation cost per input pixel used when it cannot be measured
+            (CPU); on CUDA it is measured once per input shape.
+    """
+
+    def __init__(self, model, geometries=None, scales=(1.0,), interpolation='nearest', align_corners=None,
+                 memory_budget_mb=None, bytes_per_pixel=4096):
+        super().__init__()
+        self.model = model
+        self.geometries = geometries if geometries is not None else geometry_product()
+        self.scales = list(scales) if 1 in scales else [1] + list(scales)
+        self.interpolation = interpolation
+        self.align_corners = align_corners
+        self.memory_budget = None if memory_budget_mb is None else memory_budget_mb * 2 ** 20
+        self.bytes_per_pixel = bytes_per_pixel
+        self._measured = {}
+
+    def _resize(self, x, scale):
+        if scale == 1:
+            return x
+        size = (int(x.shape[2] * scale), int(x.shape[3] * scale))
+        return F.interpolate(x, size=size, mode=self.interpolation, align_corners=self.align_corners)
+
+    def _sample_cost(self, x):
+        shape = tuple(x.shape[1:])
+        if shape in self._measured:
+            return self._measured[shape]
+        if x.is_cuda:
+            # the peak stats are not reset, a caller (e.g. autotune) may be measuring its own peak;
+            # a forward that stays below the current peak gets that peak as an upper bound
+            torch.cuda.synchronize(x.device)
+            base = torch.cuda.memory_allocated(x.device)
+            self.model(x[:1])
+            cost = torch.cuda.max_memory_allocated(x.device) - base
+        else:
+            cost = self.bytes_per_pixel * shape[-2] * shape[-1]
+        self._measured[shape] = max(cost, 1)
+        return self._measured[shape]
+
+    def _max_batch(self, x):
+        if self.memory_budget is None:
+            return None
+        return max(1, int(self.memory_budget // self._sample_cost(x)))
+
+    @property
+    def relative_cost(self):
+        """Forward cost of one TTA call in plain forwards (pixels processed)."""
+        return len(self.geometries) * sum(s ** 2 for s in self.scales)
+
+    def forward(self, x, base=None):
+        """`base`, the plain logits of x when already computed, stands in for the identity variant."""
+        n = x.shape[0]
+        merged = None if base is None else base.clone()
+        count = 0 if base is None else 1
+        for scale in self.scales:
+            # resize once per scale, then apply the geometries to the resized tensor
+            resized = self._resize(x, scale)
+            groups = {}
+            for geometry in self.geometries:
+                if base is not None and scale == 1 and geometry == (False, False, 0):
+                    continue
+                variant = apply_geometry(resized, geometry)
+                groups.setdefault(tuple(variant.shape), []).append((geometry, variant))
+
+            for variants in groups.values():
+                max_batch = self._max_batch(variants[0][1])
+                if max_batch is None:
+                    per_forward, tiles_per_forward = len(variants), n
+                elif max_batch >= n:
+                    per_forward, tiles_per_forward = max_batch // n, n
+                else:
+                    # fewer samples than tiles fit: one variant per forward, split over the tiles
+                    per_forward, tiles_per_forward = 1, max_batch
+                for i in range(0, len(variants), per_forward):
+                    chunk = variants[i:i + per_forward]
+                    for t in range(0, n, tiles_per_forward):
+                        output = self.model(torch.cat([v[t:t + tiles_per_forward] for _, v in chunk], dim=0))
+                        m = output.shape[0] // len(chunk)
+                        for j, (geometry, _) in enumerate(chunk):
+                            logits = undo_geometry(output[j * m:(j + 1) * m], geometry)
+                            logits = self._resize(logits, 1.0 / scale)
+                            if merged is None:
+                                merged = logits.new_zeros((n,) + tuple(logits.shape[1:]))
+                            merged[t:t + m] += logits
+                        del output
+                    count += len(chunk)
+        return merged / count
+
+
+def pixel_uncertainty(logits, metric='entropy'):
+    """NxHxW uncertainty in [0, 1] of NxKxHxW logits.
+
+    'entropy' is the softmax entropy divided by log(K), 'margin' is 1 - (p_top1 - p_top2).
+    """
+    probs = logits.softmax(dim=1)
+    if metric == 'entropy':
+        return -(probs * probs.clamp_min(1e-12).log()).sum(dim=1) / math.log(probs.shape[1])
+    if metric == 'margin':
+        top2 = probs.topk(2, dim=1).values
+        return 1 - (top2[:, 0] - top2[:, 1])
+    raise ValueError('unknown uncertainty metric {}'.format(metric))
+
+
+def tile_uncertainty(logits, metric='entropy'):
+    """Per-sample `pixel_uncertainty` averaged over pixels."""
+    return pixel_uncertainty(logits, metric).flatten(1).mean(dim=1)
+
+
+class AdaptiveTTA(nn.Module):
+    """Plain forward for every tile, the full TTA set only for tiles whose uncertainty exceeds `threshold`.
+
+    The plain logits are reused as the identity variant, so a gated tile costs exactly one TTA call.
+    """
+
+    def __init__(self, tta, threshold, metric='entropy'):
+        super().__init__()
+        self.tta = tta
+        self.threshold = threshold
+        self.metric = metric
+        self.num_tiles = 0
+        self.num_augmented = 0
+
+    def forward(self, x):
+        logits = self.tta.model(x)
+        selected = (tile_uncertainty(logits, self.metric) > self.threshold).nonzero(as_tuple=True)[0]
+        self.num_tiles += x.shape[0]
+        self.num_augmented += len(selected)
+        if len(selected) > 0:
+            logits[selected] = self.tta(x[selected], base=logits[selected])
+        return logits
+
+    def reset_stats(self):
+        self.num_tiles = 0
+        self.num_augmented = 0
+
+    def summary(self):
+        fraction = self.num_augmented / max(self.num_tiles, 1)
+        return 'adaptive TTA: {} of {} tiles augmented ({:.1%}), cost {:.2f}x of plain inference'.format(
+            self.num_augmented, self.num_tiles, fraction, 1 + fraction * (self.tta.relative_cost - 1))
+
+
+class TTACostCurve(object):
+    """Accuracy against TTA cost when only the most uncertain tiles are augmented.
+
+    Every tile is predicted both ways once; the curve then costs nothing per operating point,
+    because the confusion matrix of "top-k% augmented" is the plain matrix plus the
+    per-tile (TTA - plain) differences of the k% most uncertain tiles.
+    """
+
+    def __init__(self, num_class, relative_cost):
+        self.num_class = num_class
+        self.relative_cost = relative_cost
+        self.evaluator = Evaluator(num_class)
+        self.plain = np.zeros((num_class,) * 2)
+        self.uncertainties = []
+        self.deltas = []
+
+    def add(self, uncertainty, gt_image, plain_pred, tta_pred):
+        plain = self.evaluator._generate_matrix(gt_image, plain_pred)
+        self.plain += plain
+        self.uncertainties.append(float(uncertainty))
+        self.deltas.append(self.evaluator._generate_matrix(gt_image, tta_pred) - plain)
+
+    def rows(self, fractions=(0, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0)):
+        """(fraction, threshold, cost, Evaluator) per fraction; pass `threshold` to AdaptiveTTA."""
+        order = np.argsort(self.uncertainties)[::-1]
+        cumulative = np.cumsum([np.zeros_like(self.plain)] + [self.deltas[i] for i in order], axis=0)
+        rows = []
+        for fraction in fractions:
+            k = int(round(fraction * len(order)))
+            evaluator = Evaluator(self.num_class)
+            evaluator.confusion_matrix = self.plain + cumulative[k]
+            threshold = self.uncertainties[order[k]] if k < len(order) else 0.0
+            cost = 1 + k / max(len(order), 1) * (self.relative_cost - 1)
+            rows.append((fraction, threshold, cost, evaluator))
+        return rows
@@ -1,5 +1,6 @@
 import glob
 import os
+import sys
 import numpy as np
 import cv2
 import multiprocessing.pool as mpp
@@ -11,6 +12,9 @@ import albumentations as albu
 
 import random
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.label_codec import rgb2label
+
 def seed_everything(seed):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -32,6 +36,8 @@ Clutter = np.array([0, 0, 0]) # label 7
 Boundary = np.array([255, 255, 255]) # label 255
 
 num_classes = 8
+MASK_PALETTE = {0: Building, 1: Road, 2: Tree, 3: LowVeg, 4: Moving_Car, 5: Static_Car,
+                6: Human, 7: Clutter, 255: Boundary}
 
 
 # split huge RS image to small patches
@@ -48,36 +54,6 @@ def parse_args():
     return parser.parse_args()
 
 
-def label2rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = Building
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = Road
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = Tree
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = LowVeg
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = Moving_Car
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = Static_Car
-    mask_rgb[np.all(mask_convert == 6, axis=0)] = Human
-    mask_rgb[np.all(mask_convert == 7, axis=0)] = Clutter
-    mask_rgb[np.all(mask_convert == 255, axis=0)] = Boundary
-    return mask_rgb
-
-
-def rgb2label(label):
-    label_seg = np.zeros(label.shape[:2], dtype=np.uint8)
-    label_seg[np.all(label == Building, axis=-1)] = 0
-    label_seg[np.all(label == Road, axis=-1)] = 1
-    label_seg[np.all(label == Tree, axis=-1)] = 2
-    label_seg[np.all(label == LowVeg, axis=-1)] = 3
-    label_seg[np.all(label == Moving_Car, axis=-1)] = 4
-    label_seg[np.all(label == Static_Car, axis=-1)] = 5
-    label_seg[np.all(label == Human, axis=-1)] = 6
-    label_seg[np.all(label == Clutter, axis=-1)] = 7
-    label_seg[np.all(label == Boundary, axis=-1)] = 255
-    return label_seg
-
-
 def image_augment(image, mask, mode='train'):
     image_list = []
     mask_list = []
@@ -88,11 +64,11 @@ def image_augment(image, mask, mode='train'):
         image_list_train = [image]
         mask_list_train = [mask]
         for i in range(len(image_list_train)):
-            mask_tmp = rgb2label(mask_list_train[i])
+            mask_tmp = rgb2label(mask_list_train[i], MASK_PALETTE)
             image_list.append(image_list_train[i])
             mask_list.append(mask_tmp)
     else:
-        mask = rgb2label(mask.copy())
+        mask = rgb2label(mask, MASK_PALETTE)
         image_list.append(image)
         mask_list.append(mask)
     return image_list, mask_list
@@ -1,5 +1,6 @@
 import glob
 import os
+import sys
 import numpy as np
 import cv2
 from PIL import Image
@@ -13,6 +14,9 @@ from torchvision.transforms import (Pad, ColorJitter, Resize, FiveCrop, RandomCr
                                     RandomHorizontalFlip, RandomRotation, RandomVerticalFlip)
 import random
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.label_codec import PALETTES, label2rgb, rgb2label
+
 SEED = 42
 
 
@@ -34,6 +38,7 @@ Car = np.array([0, 255, 255]) # label 4
 Clutter = np.array([0, 0, 255]) # label 5
 Boundary = np.array([0, 0, 0]) # label 6
 num_classes = 6
+MASK_PALETTE = [ImSurf, Building, LowVeg, Tree, Car, Clutter, Boundary]
 
 
 # split huge RS image to small patches
@@ -73,19 +78,6 @@ def get_img_mask_padded(image, mask, patch_size, mode):
     return img_pad, mask_pad
 
 
-def pv2rgb(mask):
-    h, w = mask.shape[0], mask.shape[1]
-    mask_rgb = np.zeros(shape=(h, w, 3), dtype=np.uint8)
-    mask_convert = mask[np.newaxis, :, :]
-    mask_rgb[np.all(mask_convert == 3, axis=0)] = [0, 255, 0]
-    mask_rgb[np.all(mask_convert == 0, axis=0)] = [255, 255, 255]
-    mask_rgb[np.all(mask_convert == 1, axis=0)] = [255, 0, 0]
-    mask_rgb[np.all(mask_convert == 2, axis=0)] = [255, 255, 0]
-    mask_rgb[np.all(mask_convert == 4, axis=0)] = [0, 204, 255]
-    mask_rgb[np.all(mask_convert == 5, axis=0)] = [0, 0, 255]
-    return mask_rgb
-
-
 def car_color_replace(mask):
     mask = cv2.cvtColor(np.array(mask.copy()), cv2.COLOR_RGB2BGR)
     mask[np.all(mask == [0, 255, 255], axis=-1)] = [0, 204, 255]
@@ -93,19 +85,6 @@ def car_color_replace(mask):
     return mask
 
 
-def rgb_to_2D_label(_label):
-    _label = _label.transpose(2, 0, 1)
-    label_seg = np.zeros(_label.shape[1:], dtype=np.uint8)
-    label_seg[np.all(_label.transpose([1, 2, 0]) == ImSurf, axis=-1)] = 0
-    label_seg[np.all(_label.transpose([1, 2, 0]) == Building, axis=-1)] = 1
-    label_seg[np.all(_label.transpose([1, 2, 0]) == LowVeg, axis=-1)] = 2
-    label_seg[np.all(_label.transpose([1, 2, 0]) == Tree, axis=-1)] = 3
-    label_seg[np.all(_label.transpose([1, 2, 0]) == Car, axis=-1)] = 4
-    label_seg[np.all(_label.transpose([1, 2, 0]) == Clutter, axis=-1)] = 5
-    label_seg[np.all(_label.transpose([1, 2, 0]) == Boundary, axis=-1)] = 6
-    return label_seg
-
-
 def image_augment(image, mask, patch_size, mode='train', val_scale=1.0):
     image_list = []
     mask_list = []
@@ -144,14 +123,14 @@ def image_augment(image, mask, patch_size, mode='train', val_scale=1.0):
         # mask_list_train = [mask]
         for i in range(len(image_list_train)):
             image_tmp, mask_tmp = get_img_mask_padded(image_list_train[i], mask_list_train[i], patch_size, mode)
-            mask_tmp = rgb_to_2D_label(mask_tmp.copy())
+            mask_tmp = rgb2label(mask_tmp, MASK_PALETTE)
             image_list.append(image_tmp)
             mask_list.append(mask_tmp)
     else:
         rescale = Resize(size=(int(image_width * val_scale), int(image_height * val_scale)))
         image, mask = rescale(image.copy()), rescale(mask.copy())
         image, mask = get_img_mask_padded(image.copy(), mask.copy(), patch_size, mode)
-        mask = rgb_to_2D_label(mask.copy())
+        mask = rgb2label(mask, MASK_PALETTE)
         image_list.append(image)
         mask_list.append(mask)
     return image_list, mask_list
@@ -205,7 +184,7 @@ def vaihingen_format(inp):
         mask = mask_list[m]
         assert img.shape[0] == mask.shape[0] and img.shape[1] == mask.shape[1]
         if gt:
-            mask = pv2rgb(mask)
+            mask = label2rgb(mask, PALETTES['pv'])
 
         for y in range(0, img.shape[0], stride):
             for x in range(0, img.shape[1], stride):
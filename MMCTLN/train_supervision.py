@@ -9,7 +9,7 @@ import cv2
 import numpy as np
 import argparse
 from pathlib import Path
-from tools.metric import Evaluator
+from tools.metric import Evaluator, TorchEvaluator
 from pytorch_lightning.loggers import CSVLogger, TensorBoardLogger
 import random
 import io
@@ -41,8 +41,8 @@ class Supervision_Train(pl.LightningModule):
 
         self.loss = config.loss
 
-        self.metrics_train = Evaluator(num_class=config.num_classes)
-        self.metrics_val = Evaluator(num_class=config.num_classes)
+        self.metrics_train = TorchEvaluator(num_class=config.num_classes, ignore_index=config.ignore_index)
+        self.metrics_val = TorchEvaluator(num_class=config.num_classes, ignore_index=config.ignore_index)
 
     def forward(self, x):
         # only net is used in the prediction/inference
@@ -64,9 +64,7 @@ class Supervision_Train(pl.LightningModule):
             pre_mask = nn.Softmax(dim=1)(prediction)
 
         pre_mask = pre_mask.argmax(dim=1)
-        for i in range(mask.shape[0]):#i是batch_size
-
-            self.metrics_train.add_batch(mask[i].cpu().numpy(), pre_mask[i].cpu().numpy())
+        self.metrics_train.add_batch(mask, pre_mask)
 
         # supervision stage
         opt = self.optimizers(use_pl_optimizer=False)
@@ -82,6 +80,8 @@ class Supervision_Train(pl.LightningModule):
         return {"loss": loss}
 
     def training_epoch_end(self, outputs):
+        # under DDP every rank only saw its share of the batches
+        self.metrics_train.all_reduce()
         if 'vaihingen' in self.config.log_name:
             mIoU = np.nanmean(self.metrics_train.Intersection_over_Union()[:-1])
             F1 = np.nanmean(self.metrics_train.F1()[:-1])
@@ -122,13 +122,13 @@ class Supervision_Train(pl.LightningModule):
         prediction = self.forward(img)
         pre_mask = nn.Softmax(dim=1)(prediction)
         pre_mask = pre_mask.argmax(dim=1)
-        for i in range(mask.shape[0]):
-            self.metrics_val.add_batch(mask[i].cpu().numpy(), pre_mask[i].cpu().numpy())
+        self.metrics_val.add_batch(mask, pre_mask)
 
         loss_val = self.loss(prediction, mask)
         return {"loss_val": loss_val}
 
     def validation_epoch_end(self, outputs):
+        self.metrics_val.all_reduce()
         if 'vaihingen' in self.config.log_name:
             mIoU = np.nanmean(self.metrics_val.Intersection_over_Union()[:-1])
             F1 = np.nanmean(self.metrics_val.F1()[:-1])